@@ -47,6 +47,20 @@ BMSAPP_NAV_LINKS = (('Map', 'map'),
 # The number of hours before a sensor is considered to be inactive (not posting data).
 BMSAPP_SENSOR_INACTIVITY = 2.0   # Hours
 
+# If True, readings posted to the web server are queued in a spool on disk and
+# acknowledged right away; a background thread stores them in the reading database.
+# If False, the readings are stored before the post is acknowledged.
+BMSAPP_SPOOL_READINGS = True
+
+# If True, the Alert conditions of a sensor are checked as soon as its posted readings
+# are stored, instead of only when the alert check runs every 5 minutes.
+BMSAPP_INGEST_ALERTS = False
+
+# The number of Periodic Scripts run at once, and the number of Periodic Scripts that
+# gather data from the same host (e.g. the same Modbus device or web server) run at once.
+BMSAPP_PERIODIC_WORKERS = 8
+BMSAPP_PERIODIC_HOST_LIMIT = 2
+
 # This is the base URL where BMON Essential Energy Reports are located.
 # If Energy Reports are not being geneerated for this system, assign  None
 # to this variable.
@@ -13,6 +13,8 @@ from django.db import models
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
+import bmsapp.data_util
+from bmsapp.readingdb import bmsdata
 
 
 class BldgToSensorInline(admin.TabularInline):
@@ -209,10 +211,42 @@ class SensorAdmin(admin.ModelAdmin):
     inlines = (BldgToSensorInline2, AlertAdminInline)
     search_fields = ['sensor_id', 'title', 'tran_calc_function']
     list_filter = [BuildingSensorListFilter, SensorAlertExistsListFilter, 'is_calculated']
+    list_display = ('__str__', 'reading_count', 'last_reading')
     formfield_overrides = {
         models.TextField: {'widget': Textarea(attrs={'rows':6, 'cols':80})},
     }
 
+    def get_changelist_instance(self, request):
+        """Reads the reading statistics of all the sensors on the change list page with
+        one query, and attaches them to the Sensor objects for use by reading_stats().
+        """
+        cl = super().get_changelist_instance(request)
+        sensors = list(cl.result_list)     # the same objects are used to display the page
+        stats = bmsdata.BMSdata().sensor_stats([sensor.sensor_id for sensor in sensors])
+        for sensor in sensors:
+            sensor.page_reading_stats = stats.get(sensor.sensor_id)
+        return cl
+
+    def reading_stats(self, obj):
+        """Returns the reading statistics for the sensor from the catalog in the
+        reading database, or None if the sensor has no readings.
+        """
+        if hasattr(obj, 'page_reading_stats'):
+            return obj.page_reading_stats
+        return bmsdata.BMSdata().sensor_stats([obj.sensor_id]).get(obj.sensor_id)
+
+    def reading_count(self, obj):
+        stats = self.reading_stats(obj)
+        return '{:,}'.format(stats['count']) if stats else 0
+    reading_count.short_description = 'Readings'
+
+    def last_reading(self, obj):
+        stats = self.reading_stats(obj)
+        if stats and stats['last_ts']:
+            return bmsapp.data_util.ts_to_datetime(stats['last_ts']).strftime('%Y-%m-%d %H:%M')
+        return ''
+    last_reading.short_description = 'Last Reading'
+
 
 @admin.register(SensorGroup)
 class SensorGroupAdmin(admin.ModelAdmin):
@@ -28,3 +28,10 @@ class Cache:
                 return obj
         
         return None
+
+    def remove(self, key):
+        """
+        Removes the object having a key of 'key' from the cache.  No error occurs
+        if the key is not present.
+        """
+        self.cache.pop(key, None)
@@ -18,9 +18,59 @@ from bmsapp.models import Sensor, BldgToSensor
 # Make a logger for this module
 _logger = logging.getLogger('bms.' + __name__)
 
+def _interval_means(ts, vals, interval_seconds):
+    """Returns the time-weighted average of a step function in each 'interval_seconds'
+    wide interval, as (interval midpoint timestamps, averages) arrays.  The step function
+    takes the value 'vals[k]' from the integer timestamp 'ts[k]' until the next timestamp;
+    the last value lasts one second.  'ts' must be sorted and unique.  NaN values are
+    replaced by the prior value, and leading NaN values are excluded from the averages.
+    This gives the same results as averaging the step function sampled every second,
+    but the work is proportional to the number of readings and intervals.
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    vals = pd.Series(vals, dtype=np.float64).ffill().values
+    valid = ~np.isnan(vals)
+
+    # Integrals of the value and of the valid time at each reading timestamp and at the
+    # end of the last reading's second.
+    edges = np.append(ts, ts[-1] + 1)
+    durations = np.diff(edges)
+    cum_val = np.concatenate(([0.0], np.cumsum(np.where(valid, vals, 0.0) * durations)))
+    cum_valid = np.concatenate(([0.0], np.cumsum(valid * durations)))
+
+    def integrals(x):
+        # integrals of the value and of the valid time from the first timestamp to 'x'
+        k = np.searchsorted(edges, x, side='right') - 1
+        partial = x - edges[k]
+        k_val = np.minimum(k, len(vals) - 1)
+        at_end = k == len(vals)
+        val_int = cum_val[k] + np.where(at_end, 0.0, np.where(valid[k_val], vals[k_val], 0.0) * partial)
+        valid_int = cum_valid[k] + np.where(at_end, 0.0, valid[k_val] * partial)
+        return val_int, valid_int
+
+    # interval boundaries, limited to the span of the step function
+    starts = np.arange(ts[0] // interval_seconds, ts[-1] // interval_seconds + 1) * interval_seconds
+    lo = np.maximum(starts, edges[0])
+    hi = np.minimum(starts + interval_seconds, edges[-1])
+    val_lo, valid_lo = integrals(lo)
+    val_hi, valid_hi = integrals(hi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (val_hi - val_lo) / (valid_hi - valid_lo)
+
+    return starts + interval_seconds / 2, means
+
 class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
     """A set of functions that can be used to create calculated readings.  
     """
+
+    # lastCount() is not included, as the last raw count it reads changes even
+    # when no reading is stored.
+    SENSOR_ID_PARAMS = {
+        'runtimeFromOnOff': ('onOffID',),
+        'trueTimeAverage': ('sensorID',),
+        'OkoValueFromStatus': ('statusID',),
+        'genericCalc': ('A', 'B', 'C', 'D', 'E'),
+    }
     
     def fluidHeatFlow(self, flow, Thot, Tcold, multiplier, heat_recovery=0.0):
         """** One or more parameters must be an array of sensor readings **
@@ -236,36 +286,39 @@ class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
         are returned for times after the last stored runtime reading, subject to the reach_back
         constraint established in the constructor of this class.
         """
-        # determine the timestamp of the last entry in the database for this calculated field.
-        last_calc_rec = self.db.last_read(self.calc_id)
-        last_ts = int(last_calc_rec['ts']) if last_calc_rec else 0   # use 0 ts if no records
-        
-        # constrain this value to greater or equal to 'reach_back'
-        last_ts = max(last_ts, int(time.time() - self.reach_back))
+        # determine the timestamp after which runtimes are calculated
+        last_ts = self.calcStartTime()
+        end_ts = self.calcEndTime()
+        interval_seconds = runtimeInterval * 60
         
         # get the On/Off values starting two hours prior to this in order to capture at least
         # one state change prior to last_ts.  Put these in a Pandas series
-        ts_state = []
-        state = []
-        for rec in self.db.rowsForOneID(onOffID, start_tm=last_ts - 7200):
-            ts_state.append(rec['ts'])
-            if state_xform_func:
-                state.append(state_xform_func(rec['val']))
-            else:
-                state.append(rec['val'])
+        if end_ts is None:
+            ts_state, state = self.readingArrays(onOffID, last_ts - 7200)
+        else:
+            # Recalculating past runtimes: read from the state in effect before the first
+            # interval through the first state change after the last interval, so all of
+            # the intervals in the range are complete.
+            read_start = last_ts - 7200
+            read_start = min(read_start, self.db.prior_reading_ts(onOffID, read_start) or read_start)
+            read_end = self.db.next_reading_ts(onOffID, end_ts + interval_seconds)
+            ts_state, state = self.readingArrays(onOffID, read_start, read_end)
+        if state_xform_func:
+            state = np.array([state_xform_func(val) for val in state.tolist()], dtype=np.float64)
         states = pd.Series(state, index=ts_state)
         
         # must be at least two records to produce runtime data
         if len(states) < 2:
             return [], []
+
+        # All of the state changes read have been processed; a new state change is needed
+        # to complete another interval.
+        self.watermarks[onOffID] = int(ts_state[-1])
         
-        # turn this into one second data spanning from first entry to last
-        new_index = list(range(states.index[0], states.index[-1] + 1))
-        ser_one_sec = states.reindex(new_index).ffill()
-        
-        # average into bins of runtime data
-        interval_seconds = runtimeInterval * 60
-        ser_runtime = ser_one_sec.groupby(lambda t: int(t / interval_seconds) * interval_seconds + interval_seconds / 2).mean()
+        # average the On/Off states, which hold until the next state change, into bins of
+        # runtime data.
+        bin_ts, runtimes = _interval_means(states.index.values, states.values, interval_seconds)
+        ser_runtime = pd.Series(runtimes, index=bin_ts)
         
         # Drop the last row, since it most always includes only a partial interval of data
         ser_runtime = ser_runtime.drop( [ser_runtime.index[-1]] )
@@ -273,6 +326,8 @@ class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
         # only keep runtime values for intervals greater than the last recorded calculated
         # runtime.
         ser_runtime = ser_runtime[ser_runtime.index > last_ts]
+        if end_ts is not None:
+            ser_runtime = ser_runtime[ser_runtime.index <= end_ts]
         
         # return the timestamps and runtime values
         return ser_runtime.index.values, ser_runtime.values
@@ -461,12 +516,14 @@ class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
         calculated readings stored in the reading database.
         """
 
-        # determine the timestamp of the last entry in the database for this calculated field.
-        last_calc_rec = self.db.last_read(self.calc_id)
-        last_ts = int(last_calc_rec['ts']) if last_calc_rec else 0   # use 0 ts if no records
-        
-        # constrain this value to greater or equal to 'reach_back'
-        last_ts = max(last_ts, int(time.time() - self.reach_back))
+        # determine the timestamp after which readings are calculated.
+        last_ts = self.calcStartTime()
+
+        # When recalculating past readings, read enough readings beyond each end of
+        # the range so averaging and interpolation are complete within the range.
+        end_ts = self.calcEndTime()
+        go_back = averaging_hours * 3600 if averaging_hours else 3600
+        read_end = end_ts + go_back if end_ts is not None else None
 
         # IDs and variable names
         sensors = ((A, 'A'), (B, 'B'), (C, 'C'), (D, 'D'), (E, 'E'))
@@ -494,7 +551,8 @@ class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
                 # work, there needs to be a timezone, so default to Alaska.
                 tz = pytz.timezone('US/Alaska')
             # get a Dataframe with all the sensor data
-            df = self.db.dataframeForMultipleIDs(sensor_ids, col_names, start_ts=last_ts, tz=tz)
+            read_start = last_ts - go_back if end_ts is not None else last_ts
+            df = self.db.dataframeForMultipleIDs(sensor_ids, col_names, start_ts=read_start, end_ts=read_end, tz=tz)
             df = bmsapp.data_util.resample_timeseries(df, averaging_hours, drop_na=True)
             
             # Drop the last row as it is probably a partial interval
@@ -508,8 +566,7 @@ class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
             # Go back enough time before the last calculated timestamp so that a proper
             # rolling average can be calculated (if requested); if a rolling average is
             # not requested, provide enough readings so an interpolation can be performed.
-            go_back = averaging_hours * 3600 if averaging_hours else 3600
-            df = self.db.dataframeForMultipleIDs(sensor_ids, col_names, start_ts=last_ts-go_back)
+            df = self.db.dataframeForMultipleIDs(sensor_ids, col_names, start_ts=last_ts-go_back, end_ts=read_end)
 
             # interpolate values of B through D sensors, and then drop rows that
             # have any NAs (mostly rows where A sensor is NA, but also could be
@@ -550,6 +607,8 @@ class CalcReadingFuncs_01(calcreadings.CalcReadingFuncs_base):
         # only keep rows that are for timestamps after the last timestamp for 
         # this calculated field.
         df = df[df.index > last_ts]
+        if end_ts is not None:
+            df = df[df.index <= end_ts]
 
         # walk the rows, calculating the expression and adding timestamps and values to the list
         ts = []
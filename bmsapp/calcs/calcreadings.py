@@ -1,7 +1,8 @@
 """
 Code related to adding calculated fields to the sensor reading database.
 """
-import time, logging
+import time, logging, threading
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import yaml
@@ -9,6 +10,102 @@ import yaml
 # Make a logger for this module
 _logger = logging.getLogger('bms.' + __name__)
 
+# The default maximum number of readings held by an InputCache.  Each reading
+# takes 16 bytes of memory.
+MAX_CACHE_READINGS = 4000000
+
+
+class InputCache:
+    """
+    A cache of input sensor readings shared by the calculated readings processed in
+    one run, so that a sensor used as an input by several calculated readings is read
+    from the reading database once.  The readings of each sensor are held as NumPy
+    arrays covering all readings at or after the earliest start time requested so far;
+    a request for an earlier start time reads only the missing readings.  The least
+    recently used sensors are dropped when more than 'max_readings' readings are held.
+    Readings stored after a sensor is cached are not seen, so the cache should only 
+    live for one run, and the entry for a calculated reading must be invalidated when
+    new calculated readings are stored.  The cache can be used from multiple threads.
+    """
+
+    def __init__(self, max_readings=MAX_CACHE_READINGS):
+        self.max_readings = max_readings
+        self._entries = OrderedDict()  # sensor ID: (start ts, ts array, value array)
+        self._reading_count = 0
+        self._generation = 0           # incremented each time an entry is invalidated
+        self._lock = threading.Lock()
+
+        # statistics on the use of the cache
+        self.requests = 0
+        self.hits = 0
+        self.fetches = 0
+        self.readings_fetched = 0
+
+    def arrays(self, db, sensor_id, start_ts):
+        """Returns the readings of 'sensor_id' having timestamps greater than or equal 
+        to 'start_ts' as a two-tuple of NumPy arrays: (timestamps, values).  Readings not
+        in the cache are read from the bmsdata.BMSdata reading database 'db'.  The 
+        returned arrays must not be modified.
+        """
+        sensor_id = str(sensor_id)
+        start_ts = int(start_ts)
+        with self._lock:
+            self.requests += 1
+            generation = self._generation
+            entry = self._entries.get(sensor_id)
+            if entry is not None:
+                self._entries.move_to_end(sensor_id)
+                if start_ts >= entry[0]:
+                    self.hits += 1
+                    i = np.searchsorted(entry[1], start_ts)
+                    return entry[1][i:], entry[2][i:]
+
+        # read the readings that are not cached, outside of the lock so other threads
+        # can use the cache.
+        if entry is None:
+            ts, vals = db.arraysForOneID(sensor_id, start_tm=start_ts)
+            fetch_count = len(ts)
+        else:
+            pre_ts, pre_vals = db.arraysForOneID(sensor_id, start_tm=start_ts, end_tm=entry[0] - 1)
+            fetch_count = len(pre_ts)
+            ts = np.concatenate((pre_ts, entry[1]))
+            vals = np.concatenate((pre_vals, entry[2]))
+
+        with self._lock:
+            self.fetches += 1
+            self.readings_fetched += fetch_count
+            # don't replace an entry another thread has updated, or cache readings that
+            # may have been read before an invalidation.
+            if self._generation == generation and self._entries.get(sensor_id) is entry:
+                if entry is not None:
+                    self._reading_count -= len(entry[1])
+                self._entries[sensor_id] = (start_ts, ts, vals)
+                self._entries.move_to_end(sensor_id)
+                self._reading_count += len(ts)
+                while self._reading_count > self.max_readings and len(self._entries) > 1:
+                    _, (_, old_ts, _) = self._entries.popitem(last=False)
+                    self._reading_count -= len(old_ts)
+
+        return ts, vals
+
+    def invalidate(self, sensor_id):
+        """Drops the cached readings for 'sensor_id', which must be done when new readings
+        are stored for the sensor.
+        """
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.pop(str(sensor_id), None)
+            if entry is not None:
+                self._reading_count -= len(entry[1])
+
+    def log_stats(self):
+        """Logs the number of requests, the cache hit rate, and the number of database
+        reads made by the cache.
+        """
+        hit_pct = 100.0 * self.hits / self.requests if self.requests else 0.0
+        _logger.info('Input cache: %s requests, %.1f%% hits, %s database reads of %s readings, %s readings held' % 
+                     (self.requests, hit_pct, self.fetches, self.readings_fetched, self._reading_count))
+
 
 class CalculateReadings:
     """
@@ -18,7 +115,7 @@ class CalculateReadings:
     extensive documentation provided for that method.
     """
     
-    def __init__(self, calc_class_list, db, reach_back_mins):
+    def __init__(self, calc_class_list, db, reach_back_mins, input_cache=None):
         """Args:
             'calc_class_list': A list of classes (the actual class, not a string) 
                 that contain the functions to use to produce the calculated values.  
@@ -27,6 +124,7 @@ class CalculateReadings:
             'db': A bmsdata.BMSdata object holding the sensor reading database.
             'reach_back_mins' (number): Calculated values will not be created more 
                 than this number of minutes into the past.
+            'input_cache': An optional InputCache used to read input sensor readings.
         """
         self.db = db
         self.reach_back = reach_back_mins * 60   # store as seconds
@@ -34,23 +132,55 @@ class CalculateReadings:
         # instantiate each one of the calculation classes and save the list as 
         # an object property
         self.calc_objects = [cl(db, self.reach_back) for cl in calc_class_list]
+
+        self.set_input_cache(input_cache)
+
+    def set_input_cache(self, input_cache):
+        """Uses the InputCache 'input_cache' to read input sensor readings from now on.
+        If 'input_cache' is None, readings are read directly from the database.
+        """
+        self.input_cache = input_cache
+        for calc_obj in self.calc_objects:
+            calc_obj.input_cache = input_cache
         
-    def dataForID(self, sensorID, start_ts=0):
+    def inputIDs(self, calcFuncName, calcParams):
+        """
+        Returns a list of the Sensor IDs whose readings are inputs to a calculated reading
+        using the function named 'calcFuncName' with the YAML parameters 'calcParams'.
+        These are the 'id_' parameters plus any parameters listed for the function in the
+        SENSOR_ID_PARAMS attribute of the calculation class.  The list is empty for 
+        functions that do not use sensor readings, such as the Internet weather functions.
+        """
+        params = yaml.load(calcParams, Loader=yaml.FullLoader)
+        if params is None:
+            params = {}    # substitute empty dictionary for no parameters
+
+        ids = [str(id) for nm, id in params.items() if nm.startswith('id_')]
+
+        func_name = calcFuncName.strip()
+        for calc_obj in self.calc_objects:
+            if hasattr(calc_obj, func_name):
+                ids += [str(params[nm]) for nm in calc_obj.SENSOR_ID_PARAMS.get(func_name, ()) if params.get(nm)]
+                break
+
+        return ids
+
+    def dataForID(self, sensorID, start_ts=0, end_ts=None):
         """
         Returns timestamp and values numpy arrays for the sensor with an
-        ID of 'sensorID' and having timestamps greater than 'start_ts'.
+        ID of 'sensorID' and having timestamps greater than 'start_ts' and, if
+        'end_ts' is given, less than or equal to 'end_ts'.
         """
-        ts = []
-        vals = []
         # in statement below, need to add 1 second to start_ts because the
-        # 'rowsForOneID' method uses a >= test.
-        for flds in self.db.rowsForOneID(sensorID, start_tm=start_ts+1):
-            ts.append(flds['ts'])
-            vals.append(flds['val'])
-        return np.array(ts), np.array(vals)
+        # 'arraysForOneID' method uses a >= test.
+        if end_ts is not None:
+            return self.db.arraysForOneID(sensorID, start_tm=start_ts+1, end_tm=end_ts)
+        if self.input_cache:
+            return self.input_cache.arrays(self.db, sensorID, start_ts+1)
+        return self.db.arraysForOneID(sensorID, start_tm=start_ts+1)
 
     
-    def getDFofSyncedValues(self, input_ids, calc_id=None, earliest_time=0):
+    def getDFofSyncedValues(self, input_ids, calc_id=None, earliest_time=0, watermarks=None, latest_time=None):
         """
         This returns a DataFrame having columns for each of the 'input_ids', which is a list
         of sensor IDs that are inputs for the calculated ID.  The timestamps from the first
@@ -64,11 +194,25 @@ class CalculateReadings:
         interpolated to match up with the input_id[0] timestamps.  For rows where interpolation
         of any of the inputs cannot occur because the input data does not span the timestamp,
         the row is dropped from the DataFrame.
+        The watermark stored in the reading database for each input is the timestamp of
+        the last reading of that input processed.  The timestamps also start past the 
+        smallest watermark of the inputs, as the input_id[0] timestamps up to the last
+        reading of every input need no further processing: interpolation either succeeded
+        or is never possible.
+        If the dictionary 'watermarks' is passed, it is filled with the new watermarks for
+        the inputs; they should be stored after the calculated readings are stored.
+        If 'latest_time' is given, input_id[0] timestamps after 'latest_time' are not returned.
         """
         
         # determine the timestamp of the last entry in the database for this calculated field.
         last_calc_rec = self.db.last_read(calc_id)
         last_ts = int(last_calc_rec['ts']) if last_calc_rec else 0   # use 0 ts if no records
+
+        # The watermarks let the calculation resume after input readings that produced
+        # no calculated reading.
+        if calc_id is not None:
+            marks = self.db.calc_watermarks(calc_id)
+            last_ts = max(last_ts, min(marks.get(inp_id, 0) for inp_id in input_ids))
         
         # constrain this value to greater or equal to 'earliest_time'
         last_ts = max(last_ts, earliest_time)
@@ -76,29 +220,40 @@ class CalculateReadings:
         # get numpy ts and value arrays for the first input for records past this timestamp.
         # these timestamp values will be the common synchronized timestamps for all of the
         # inputs.
-        sync_ts, vals0 = self.dataForID(input_ids[0], last_ts)
+        sync_ts, vals0 = self.dataForID(input_ids[0], last_ts, latest_time)
         
         # if there is no data, we're done and return an empty DataFrame
         if len(sync_ts)==0:
             return pd.DataFrame()
         
-        # For the other inputs, start 70 minutes prior to first record in first input's Series
+        # For the other inputs, start up to 70 minutes prior to first record in first input's Series
         # in order that timestamps will span the input0 stamps so that interpolation can be 
-        # performed.
+        # performed.  Readings before the last one at or before the first record are not
+        # needed for the interpolation.
         inputs_ts_start = sync_ts[0] - 70 * 60
+        inputs_ts_end = sync_ts[-1] + 70 * 60 if latest_time is not None else None
         
         # accumulate all of the input values in a dictionary, keyed on the sensor ID
         input_series = {input_ids[0]: vals0}
+
+        # the last reading processed of each input
+        new_watermarks = {input_ids[0]: int(sync_ts[-1])}
         
         # Loop through the rest of the inputs, creating interpolated values for the synchrnonized
         # timestamps.
         for inp_id in input_ids[1:]:
     
-            ser_ts, ser_vals = self.dataForID(inp_id, inputs_ts_start)
+            prior_ts = self.db.prior_reading_ts(inp_id, sync_ts[0])
+            if prior_ts and prior_ts > inputs_ts_start:
+                ser_ts, ser_vals = self.dataForID(inp_id, prior_ts - 1, inputs_ts_end)
+            else:
+                ser_ts, ser_vals = self.dataForID(inp_id, inputs_ts_start, inputs_ts_end)
             
             # if this series is empty, we're toast.  Return with empty DataFrame
             if len(ser_ts)==0:
                 return pd.DataFrame()
+
+            new_watermarks[inp_id] = int(ser_ts[-1])
     
             # use this series as the x and y for interpolation of values
             # for the synchronized ts values.  Fill outside the interpolation
@@ -112,6 +267,9 @@ class CalculateReadings:
         # make a DataFrame from these series and drop any row with an NaN.
         df = pd.DataFrame(input_series, index=sync_ts)
         df = df.dropna()
+
+        if watermarks is not None:
+            watermarks.update(new_watermarks)
         
         return df
     
@@ -161,7 +319,40 @@ class CalculateReadings:
         list of timestamps and a list of calculated values, since there are no existing sensor
         timestamps to synchronize to.
         """
-        
+        # The last input timestamps processed, stored after the calculated readings are
+        # stored.
+        watermarks = {}
+
+        ts, vals = self.calcValues(calc_id, calcFuncName, calcParams, watermarks)
+
+        # insert the records into the database.
+        if ts:
+            self.db.insert_reading(ts, len(ts)*[calc_id], vals)  
+            if self.input_cache:
+                self.input_cache.invalidate(calc_id)
+
+        if watermarks:
+            self.db.set_calc_watermarks(calc_id, watermarks)
+            
+        return len(ts)
+
+    def calcValues(self, calc_id, calcFuncName, calcParams, watermarks=None, calc_range=None):
+        """
+        Returns the new readings for the calculated reading 'calc_id', which uses the 
+        function named 'calcFuncName' with the parameters 'calcParams', as a list of
+        timestamps and a list of values.  The readings are not stored; see processCalc()
+        for the description of the functions and parameters.  If the dictionary 
+        'watermarks' is passed, it is filled with the last timestamps processed of the
+        input sensors.
+        If 'calc_range' is given, it is a (start_ts, end_ts) tuple, and the readings with
+        timestamps greater than start_ts and less than or equal to end_ts are returned,
+        regardless of the calculated readings already stored and of reach_back.  This is 
+        used to recalculate past readings; a ValueError is raised if the function cannot
+        recalculate past readings, such as the Internet weather functions.
+        """
+        if watermarks is None:
+            watermarks = {}
+
         # Get the function parameters as a dictionary
         params = yaml.load(calcParams, Loader=yaml.FullLoader)
         if params is None:
@@ -197,18 +388,23 @@ class CalculateReadings:
         for calc_obj in self.calc_objects:
             if hasattr(calc_obj, func_name):
                 calc_obj.calc_id = calc_id   # calc object may need the calc_id
+                calc_obj.watermarks = watermarks    # and can record input watermarks
+                calc_obj.calc_range = calc_range
                 calc_func = getattr(calc_obj, func_name)
                 break
 
         if len(ids):
             # There are some sensors in the parameter list.  Get a DataFrame of 
             # synchronized readings for those sensors.
-            df = self.getDFofSyncedValues(ids, calc_id, time.time() - self.reach_back)
+            if calc_range:
+                df = self.getDFofSyncedValues(ids, None, calc_range[0], None, calc_range[1])
+            else:
+                df = self.getDFofSyncedValues(ids, calc_id, time.time() - self.reach_back, watermarks)
             
             # If there are no rows in the DataFrame, there are no records to add to the
             # database.
             if len(df)==0:
-                return 0
+                return [], []
             
             # Put the array of values for each sensor back into the main parameter dictionary
             for nm, id in list(id_dict.items()):
@@ -229,18 +425,23 @@ class CalculateReadings:
         else:
             # There were no sensor IDs in the parameter list.  This calculate function must
             # be the kind that returns a list of timestamps and a list of values for the 
-            # records it wants to add to the database.
+            # records it wants to add to the database.  Only the functions that read
+            # sensor readings can recalculate past readings.
+            if calc_range and func_name not in calc_obj.SENSOR_ID_PARAMS:
+                raise ValueError('%s cannot recalculate past readings.' % func_name)
             stamps, vals = calc_func(**params)
 
             # Had trouble inserting numpy data types, so convert to regular python data
             # types.
             ts = list(map(int, stamps))
             vals = list(map(float, vals))
-        
-        # insert the records into the database.
-        self.db.insert_reading(ts, len(ts)*[calc_id], vals)  
-            
-        return len(ts)
+
+            if calc_range:
+                recs = [(t, v) for t, v in zip(ts, vals) if calc_range[0] < t <= calc_range[1]]
+                ts = [t for t, v in recs]
+                vals = [v for t, v in recs]
+
+        return ts, vals
     
 
 class CalcReadingFuncs_base:
@@ -258,8 +459,16 @@ class CalcReadingFuncs_base:
     For the functions with none of the parameters being an array of sensor readings,
     the function must return two items: 1) a list (or numpy array) of timestamps
     (Unix seconds) and 2) a list/array of calculated values.
+
+    Functions of the second category that read sensor readings list the names of 
+    their Sensor ID parameters in SENSOR_ID_PARAMS, so that the readings can be
+    identified as inputs of the calculation.
     """
 
+    # Keys are function names, values are tuples of the names of the function's
+    # parameters that hold Sensor IDs.
+    SENSOR_ID_PARAMS = {}
+
     def __init__(self, db, reach_back_secs):
         """Args:
             db: A bmsdata.BMSdata object holding the sensor reading database.
@@ -274,5 +483,51 @@ class CalcReadingFuncs_base:
         # readings. This attribute should be set by the routine calling one of 
         # these functions as some functions need to know the id string to look up
         # past readings in the reading database.
-        self.calc_id = None    
+        self.calc_id = None
+
+        # A function can record the last timestamp of an input sensor it has processed in
+        # this dictionary, keyed on the input Sensor ID.  The routine calling the function
+        # stores these in the reading database after storing the calculated readings.  The
+        # stored values are available from the 'calc_watermarks' method of the database.
+        self.watermarks = {}
+
+        # An optional InputCache used by readingArrays() to read sensor readings; set
+        # by the CalculateReadings object holding this object.
+        self.input_cache = None
+
+        # When past readings are being recalculated, this is set to the (start_ts, end_ts)
+        # range of timestamps to recalculate by the routine calling one of these functions.
+        # Functions use calcStartTime() and calcEndTime() to find the readings to calculate.
+        self.calc_range = None
+
+    def readingArrays(self, sensor_id, start_tm, end_tm=None):
+        """Returns the readings of 'sensor_id' having timestamps greater than or equal 
+        to 'start_tm' and, if given, less than or equal to 'end_tm', as a two-tuple of 
+        NumPy arrays: (timestamps, values).  The input cache is used if there is one and
+        'end_tm' is not given; the arrays must not be modified.
+        """
+        if self.input_cache and end_tm is None:
+            return self.input_cache.arrays(self.db, sensor_id, start_tm)
+        return self.db.arraysForOneID(sensor_id, start_tm=start_tm, end_tm=end_tm)
+
+    def calcStartTime(self):
+        """Returns the timestamp after which readings are to be calculated: the start of
+        the range being recalculated, or else the timestamp of the last calculated reading
+        stored in the database, constrained to be no earlier than 'reach_back'.
+        """
+        if self.calc_range:
+            return int(self.calc_range[0])
+
+        # determine the timestamp of the last entry in the database for this calculated field.
+        last_calc_rec = self.db.last_read(self.calc_id)
+        last_ts = int(last_calc_rec['ts']) if last_calc_rec else 0   # use 0 ts if no records
+        
+        # constrain this value to greater or equal to 'reach_back'
+        return max(last_ts, int(time.time() - self.reach_back))
+
+    def calcEndTime(self):
+        """Returns the end of the range of timestamps being recalculated, or None if new
+        readings are being calculated.
+        """
+        return int(self.calc_range[1]) if self.calc_range else None    
 
@@ -6,11 +6,61 @@ Transform functions for scaling and transforming sensor readings
 from math import *
 import sys
 import logging
+import functools
 import yaml
+import numpy as np
+from django.db.models.signals import post_save, post_delete
+import bmsapp.models
+from .cache import Cache
 
 # Make a logger for this module
 _logger = logging.getLogger('bms.' + __name__)
 
+# Cache of the transform function and parsed parameters for each Sensor ID, so that
+# the Sensor object and its YAML parameters are not read again for each reading.
+# Entries are dropped when the Sensor is saved or deleted in this process; the
+# timeout bounds how long other processes can use a stale entry.
+_transform_cache = Cache(timeout=300)
+
+def get_transform(sensor_id):
+    """Returns a two-tuple (transform function name, parameter dictionary) for the
+    Sensor with the ID of 'sensor_id'.  The function name is an empty string if
+    there is no transform function or no Sensor object with that ID.  Results are
+    cached so the Sensor object is only queried on the first reading for a sensor.
+    """
+    sensor_id = str(sensor_id)    # make sure ID is a string
+    transform = _transform_cache.get(sensor_id)
+    if transform is None:
+        sensors = bmsapp.models.Sensor.objects.filter(sensor_id=sensor_id)
+        if len(sensors) > 0 and len(sensors[0].tran_calc_function.strip()):
+            # Take first sensor in list ( should be only one ) and get transform function & parameters
+            params = yaml.load(sensors[0].function_parameters, Loader=yaml.FullLoader)
+            if params is None:
+                params = {}    # substitute an empty dictionary for empty parameter string
+            transform = (sensors[0].tran_calc_function.strip(), params)
+        else:
+            # no transform function, or no sensor with the requested ID was found.
+            transform = ('', {})
+        _transform_cache.store(sensor_id, transform)
+
+    return transform
+
+def _drop_cached_transform(sender, instance, **kwargs):
+    """Signal handler that removes a Sensor's transform from the cache when the
+    Sensor is saved or deleted.
+    """
+    _transform_cache.remove(instance.sensor_id)
+
+post_save.connect(_drop_cached_transform, sender=bmsapp.models.Sensor)
+post_delete.connect(_drop_cached_transform, sender=bmsapp.models.Sensor)
+
+@functools.lru_cache(maxsize=1000)
+def _compile_expression(expr_clean):
+    """Returns a code object for the transform expression 'expr_clean', so that
+    an expression is only compiled once per process.
+    """
+    return compile(expr_clean, '<transform>', 'eval')
+
 
 class Transformer:
 
@@ -37,12 +87,62 @@ class Transformer:
         params = yaml.load(trans_params, Loader=yaml.FullLoader)
         if params is None:
             params = {}    # substitute an empty dictionary for empty parameter string
+        return self.transform_parsed(ts, id, val, trans_func, params)
+
+    def transform_parsed(self, ts, id, val, trans_func, params):
+        '''
+        Same as transform_value() except that the parameters to the transform function
+        are passed as the already parsed dictionary 'params'.
+        '''
         if hasattr(self, trans_func.strip()):
             the_func = getattr(self, trans_func.strip())
             return the_func(ts, id, val, **params)
         else:
             # the transform must be a general expression.
             return self._eval_expression(ts, id, val, trans_func, **params)
+
+    def transform_batch(self, id, ts, val, trans_func, params):
+        '''
+        Transforms a batch of readings from the sensor 'id' in one pass.  'ts' and 'val'
+        are sequences of timestamps and values; the readings are put in timestamp order
+        before being transformed.  'trans_func' and 'params' are the same as for
+        transform_parsed().  The 'linear' function and general expressions, including
+        expressions using the counter 'rate', are computed with NumPy array math.
+        Other transform functions are applied one reading at a time.
+        Returns a three-tuple: (NumPy array of timestamps, list of sensor IDs, NumPy array
+        of values).  Readings rejected by the transform are not included.  Only transform
+        functions applied one reading at a time can change the sensor ID.
+        '''
+        ts = np.asarray(ts, dtype=np.int64)
+        val = np.asarray(val, dtype=np.float64)
+        order = np.argsort(ts, kind='mergesort')
+        ts = ts[order]
+        val = val[order]
+        if len(ts) == 0:
+            return ts, [], val
+
+        func_name = trans_func.strip()
+        if func_name == 'linear':
+            # array math works directly in this function
+            _, _, new_val = self.linear(ts, id, val, **params)
+            return ts, [id] * len(ts), new_val
+
+        elif hasattr(self, func_name):
+            new_ts = []
+            new_ids = []
+            new_val = []
+            for one_ts, one_val in zip(ts.tolist(), val.tolist()):
+                one_ts, one_id, one_val = self.transform_parsed(one_ts, id, one_val, func_name, params)
+                if one_val is not None:
+                    new_ts.append(one_ts)
+                    new_ids.append(one_id)
+                    new_val.append(one_val)
+            return np.array(new_ts, dtype=np.int64), new_ids, np.array(new_val, dtype=np.float64)
+
+        else:
+            # the transform must be a general expression.
+            new_ts, new_val = self._eval_expression_batch(ts, id, val, func_name, **params)
+            return new_ts, [id] * len(new_ts), new_val
             
     def _eval_expression(self, ts, id, val, expression, 
                          rollover=2**16,
@@ -74,6 +174,7 @@ class Transformer:
         'ignore_negative' indicates whether a negative change should be ignored.
         """
         expr_clean = expression.strip().lower()
+        expr_code = _compile_expression(expr_clean)
         
         if 'rate' in expr_clean:
             # A count rate is used in the expression.  Determine it so the
@@ -116,7 +217,7 @@ class Transformer:
                 
                 # Stamp the reading at the average of the current and last
                 # timestamp.
-                return int((ts + last_ts)/2.0), id, eval(expr_clean)
+                return int((ts + last_ts)/2.0), id, eval(expr_code)
                 
             else:
                 # there was no last reading in database
@@ -125,9 +226,110 @@ class Transformer:
             
         else:
             # Just a simple transformation of the value
-            return ts, id, eval(expr_clean)
+            return ts, id, eval(expr_code)
         
 
+    def _eval_expression_batch(self, ts, id, val, expression,
+                               rollover=2**16,
+                               max_rate=5.0,
+                               min_interval=30,
+                               ignore_zero=True,
+                               ignore_negative=True):
+        """Array version of _eval_expression().  'ts' and 'val' are timestamp ordered
+        NumPy arrays of readings from the sensor 'id'.  Returns a two-tuple of NumPy
+        arrays (timestamps, values) holding the transformed readings; readings that
+        _eval_expression() would reject are dropped.  For counter 'rate' expressions,
+        the last raw reading is read once from the database before the calculation, 
+        and the last reading of the batch becomes the new last raw reading.  It is stored
+        in the same transaction as the transformed readings (see BMSdata.defer_last_raw()),
+        so it is unchanged if the readings are not stored.
+        """
+        expr_clean = expression.strip().lower()
+        expr_code = _compile_expression(expr_clean)
+
+        # the names visible to the expression, as in _eval_expression()
+        namespace = {'self': self, 'id': id, 'expression': expression, 'expr_clean': expr_clean,
+                     'expr_code': expr_code, 'rollover': rollover, 'max_rate': max_rate,
+                     'min_interval': min_interval, 'ignore_zero': ignore_zero,
+                     'ignore_negative': ignore_negative}
+
+        if 'rate' in expr_clean:
+            # Get the last raw reading with timestamp, and replace it with the
+            # newest reading in this batch.  Each of the other readings is paired
+            # with the reading just before it.
+            last_ts, last_val = self.db.last_raw(id)
+            self.db.defer_last_raw(id, int(ts[-1]), float(val[-1]))
+            prev_ts = np.concatenate(([last_ts or 0], ts[:-1]))
+            prev_val = np.concatenate(([last_val if last_val is not None else np.nan], val[:-1]))
+
+            interval = ts - prev_ts
+            count_chg = val - prev_val
+
+            # Determine the readings that are rejected for each of the reasons
+            # tested in _eval_expression()
+            rejects = (
+                ('Counter value is zero and requested to be ignored',
+                    (val == 0) if ignore_zero else np.zeros(len(val), dtype=bool)),
+                ('No last reading available to determine rate', prev_ts == 0),
+            )
+            if ignore_negative:
+                rejects += (('Counter value move backwards and is requested to be ignored', count_chg < 0), )
+            else:
+                # Allow the negative change but check for a possible rollover.
+                rolled = (count_chg < 0) & (np.abs(count_chg) > 0.5 * rollover)
+                count_chg = np.where(rolled, count_chg + rollover, count_chg)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate = count_chg / interval.astype(np.float64)
+            rejects += (
+                ('Too short of interval to calculate rate', interval < min_interval),
+                ('Too high of counter rate', np.abs(rate) > max_rate),
+            )
+
+            keep = np.ones(len(val), dtype=bool)
+            for reason, rejected in rejects:
+                rejected = rejected & keep
+                if rejected.any():
+                    _logger.warn('%s: id=%s, %s readings, first ts=%s' % (reason, id, rejected.sum(), ts[rejected][0]))
+                keep &= ~rejected
+
+            # Stamp the reading at the average of the current and last
+            # timestamp.
+            new_ts = ((ts[keep] + prev_ts[keep]) / 2.0).astype(np.int64)
+            namespace.update({'ts': ts[keep], 'val': val[keep], 'rate': rate[keep],
+                              'last_ts': prev_ts[keep], 'last_val': prev_val[keep],
+                              'interval': interval[keep], 'count_chg': count_chg[keep]})
+            return new_ts, self._eval_array(expr_code, namespace, keep.sum())
+
+        else:
+            # Just a simple transformation of the value
+            namespace.update({'ts': ts, 'val': val})
+            return ts, self._eval_array(expr_code, namespace, len(val))
+
+    def _eval_array(self, expr_code, namespace, n):
+        """Evaluates the compiled expression 'expr_code' using the variables in the
+        dictionary 'namespace', some of which are NumPy arrays of length 'n'.  Returns
+        an array of 'n' values.  Expressions that cannot operate on arrays, such as
+        those using functions from the math module, max(), or 'if' tests of the value,
+        are evaluated one element at a time.
+        """
+        try:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = eval(expr_code, globals(), namespace)
+            return np.broadcast_to(np.asarray(result, dtype=np.float64), (n,)).copy()
+        except Exception:
+            vals = np.empty(n)
+            for i in range(n):
+                one_namespace = {k: (v[i] if isinstance(v, np.ndarray) else v) for k, v in namespace.items()}
+                try:
+                    vals[i] = eval(expr_code, globals(), one_namespace)
+                except Exception:
+                    # the reading will not be stored, as with a reading transformed alone.
+                    _logger.exception('Error transforming reading: ts=%s, id=%s, val=%s' %
+                                      (one_namespace.get('ts'), one_namespace.get('id'), one_namespace.get('val')))
+                    vals[i] = np.nan
+            return vals
+
     # ******** Add Transform Functions below Here *********
     #
     # Transform functions must accept the ts, id, and val components of the sensor reading
@@ -6,6 +6,7 @@ from datetime import datetime
 import pytz, calendar, time, math
 from dateutil import parser
 import numpy as np
+import pandas as pd
 from django.conf import settings
 
 
@@ -100,6 +101,9 @@ def resample_timeseries(pandas_dataframe, averaging_hours, drop_na=True):
     interval.  If the 'averaging_hours' parameter is fractional, the averaging time 
     period is truncated to the lesser minute.
     If 'drop_na' is True, rows with any NaN values are dropped.
+    The dataframe can also hold hourly rollups from the reading database (it has a 
+    'count' column); in that case, the 'ts' and 'val' averages are computed from the 
+    rollup sums and the averaging time period must be a whole number of hours.
     
     For some reason the pandas resampling sometimes fails if the datetime index is timezone aware...
     '''
@@ -117,7 +121,12 @@ def resample_timeseries(pandas_dataframe, averaging_hours, drop_na=True):
         }
     params = interval_lookup.get(averaging_hours, {'rule':str(int(averaging_hours * 60)) + 'min', 'loffset':str(int(averaging_hours * 30)) + 'min'})
 
-    new_df = pandas_dataframe.resample(rule=params['rule'], loffset=params['loffset'],label='left').mean()
+    if 'count' in pandas_dataframe.columns:
+        sums = pandas_dataframe[['count', 'sum', 'ts_sum']].resample(rule=params['rule'], loffset=params['loffset'],label='left').sum()
+        new_df = pd.DataFrame({'ts': sums['ts_sum'] / sums['count'], 'val': sums['sum'] / sums['count']},
+                              index=sums.index, columns=['ts', 'val'])
+    else:
+        new_df = pandas_dataframe.resample(rule=params['rule'], loffset=params['loffset'],label='left').mean()
     if drop_na:
         new_df = new_df.dropna()
 
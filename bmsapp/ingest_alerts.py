@@ -0,0 +1,156 @@
+'''
+Checks the value Alert conditions of sensors as soon as their readings are stored by
+the ingest path (storereads.store_recs), instead of waiting for the next run of the
+check_alerts script.  Used if the BMSAPP_INGEST_ALERTS setting is True.
+
+An index from Sensor ID to the sensor's active value conditions is kept in memory
+and reloaded every INDEX_SECS seconds, so changes made in the Admin pages take effect.
+The recent readings needed by the conditions are read from the reading database, after
+the new readings are stored, with a few queries for all of the sensors.  The readings
+are not buffered in memory, as the readings of a sensor can be stored by different
+processes, such as the web server processes and the process draining the ingest spool.
+Inactive sensor conditions are left to the check_alerts script.
+
+The conditions are checked, and the notifications claimed (see
+AlertCondition.notify_recipients()), after the readings are committed.  The messages
+are then sent by a background thread, so a slow mail or Pushover server does not hold
+up the storing of readings.
+'''
+
+import os
+import time
+import math
+import queue
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import models
+from . import notifications
+
+# Make a logger for this module
+_logger = logging.getLogger('bms.' + __name__)
+
+# seconds between reloads of the condition index
+INDEX_SECS = 60.0
+
+_lock = threading.Lock()
+_index = {}           # Sensor ID: list of AlertCondition objects
+_bldg_titles = {}     # Sensor primary key: list of building titles
+_read_counts = {}     # Sensor ID: the number of recent readings needed by its conditions
+_index_time = 0.0     # when the index was loaded
+
+# notifications.Dispatcher objects waiting to be sent by the sender thread
+_send_queue = queue.Queue()
+_sender_pid = None    # the process that started the sender thread
+
+
+def enabled():
+    '''Returns True if Alert conditions should be checked as readings are stored.
+    '''
+    return getattr(settings, 'BMSAPP_INGEST_ALERTS', False)
+
+def _load_index():
+    '''Loads the condition index and the building titles of the indexed sensors from
+    the Django database.
+    '''
+    global _index, _bldg_titles, _read_counts, _index_time
+
+    index = {}
+    for condx in models.AlertCondition.objects.filter(active=True).exclude(condition='inactive') \
+            .select_related('sensor__unit', 'only_if_bldg', 'only_if_bldg_mode').prefetch_related('recipients'):
+        index.setdefault(condx.sensor.sensor_id, []).append(condx)
+
+    # a subquery selects the sensors, so there is no limit on their number.
+    condx_sensors = models.AlertCondition.objects.filter(active=True).exclude(condition='inactive').values('sensor')
+    bldg_titles = {}
+    for btos in models.BldgToSensor.objects.filter(sensor__in=condx_sensors).select_related('building'):
+        bldg_titles.setdefault(btos.sensor_id, []).append(btos.building.title)
+
+    # the readings needed for the condition needing the most readings.
+    read_counts = {sensor_id: max(condx.read_count for condx in conds) for sensor_id, conds in index.items()}
+
+    _index, _bldg_titles, _read_counts, _index_time = index, bldg_titles, read_counts, time.time()
+
+def _sender():
+    '''Sends the queued notifications.  Runs in a daemon thread.
+    '''
+    while True:
+        dispatcher = _send_queue.get()
+        try:
+            dispatcher.send()
+        except:
+            _logger.exception('Error sending alert notifications.')
+        finally:
+            # the thread does not end with a request, so release the Django connection
+            close_old_connections()
+            _send_queue.task_done()
+
+def _send_later(dispatcher):
+    '''Queues the notifications in 'dispatcher' to be sent by the sender thread, starting
+    the thread if it is not already running in this process.
+    '''
+    global _sender_pid
+    with _lock:
+        if _sender_pid != os.getpid():
+            _sender_pid = os.getpid()
+            threading.Thread(target=_sender, name='ingest-alert-sender', daemon=True).start()
+    _send_queue.put(dispatcher)
+
+@atexit.register
+def _wait_for_sends():
+    '''Lets the queued notifications be sent before the process exits, as they have
+    already been claimed.
+    '''
+    if _sender_pid == os.getpid():
+        _send_queue.join()
+
+def readings_stored(reading_db, ts_lst, reading_id_lst, val_lst):
+    '''Checks the value Alert conditions of the sensors having new readings, and queues
+    the notifications of the conditions that are true, which are sent by a background
+    thread.  'ts_lst', 'reading_id_lst' and 'val_lst' are the readings just stored in
+    the reading database 'reading_db'.  Returns the number of conditions that are true.
+    '''
+    # find the sensors having conditions and new readings
+    with _lock:
+        if time.time() - _index_time > INDEX_SECS:
+            _load_index()
+        index, bldg_titles, read_counts = _index, _bldg_titles, _read_counts
+
+    new_ids = set()
+    for reading_id, val in zip(reading_id_lst, val_lst):
+        reading_id = str(reading_id)
+        if reading_id in index and val is not None and math.isfinite(val):
+            new_ids.add(reading_id)
+    if not new_ids:
+        return 0
+
+    # make the list of conditions to check, with the sensor's recent readings, newest first.
+    recent_reads = reading_db.recent_reads({sensor_id: read_counts[sensor_id] for sensor_id in new_ids})
+    checks = []
+    for sensor_id in new_ids:
+        for condx in index[sensor_id]:
+            checks.append((condx, recent_reads.get(sensor_id, [])))
+
+    # check the conditions and queue the notifications
+    true_count = 0
+    dispatcher = notifications.Dispatcher()
+    now = time.time()
+    for condx, recent in checks:
+        try:
+            if now < condx.last_notified + condx.wait_before_next * 3600.0:
+                continue
+            subject_msg = condx.check_condition(reading_db, recent, bldg_titles.get(condx.sensor_id, []))
+            if subject_msg:
+                true_count += 1
+                condx.notify_recipients(subject_msg[0], subject_msg[1], dispatcher)
+        except:
+            _logger.exception('Error checking alert %s' % condx.pk)
+    if dispatcher.done_funcs:
+        # some notifications were claimed and queued
+        _send_later(dispatcher)
+
+    return true_count
@@ -0,0 +1,274 @@
+'''Runs the BMON background tasks from one long-running process, in place of the
+cron job that runs the main_cron.py script every 5 minutes.  Start it with:
+
+    manage.py run_scheduler
+
+and keep it running with a process supervisor such as systemd.  Do not also run the
+main_cron cron job.
+
+The next run time of each task and each Periodic Script is kept in a priority queue.
+The tasks run at the same times of day as they do from main_cron.  Periodic Scripts
+run at multiples of their period, which may be shorter than 5 minutes, and the list
+of scripts is reloaded every RELOAD_SECS seconds so changes made in the Admin pages
+take effect.  A task or script that missed one or more runs, because the process was
+stopped or busy, is run once as soon as possible.  The start time of each task's last
+run is saved in the STATE_FILE file, and the last run of a Periodic Script is found from
+its results, so runs missed while the process was stopped are made up when it starts.
+Python, Django and the analysis
+libraries are imported once, when the process starts.
+'''
+
+import os
+import json
+import heapq
+import logging
+import signal
+import threading
+import time
+from datetime import datetime
+
+import yaml
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import bmsapp.models
+import bmsapp.storereads
+from bmsapp.scripts import calc_readings
+from bmsapp.scripts import daily_status
+from bmsapp.scripts import backup_django_db
+from bmsapp.scripts import backup_readingdb
+from bmsapp.scripts import rebuild_rollups
+from bmsapp.scripts import check_alerts
+from bmsapp.scripts import run_periodic_scripts
+
+# make a logger object
+logger = logging.getLogger('bms.run_scheduler')
+
+# seconds between reloads of the list of Periodic Scripts
+RELOAD_SECS = 60.0
+
+# The file holding the UNIX timestamp of the start of the last run of each task.
+STATE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+                          'readingdb', 'data', 'scheduler_state.json')
+
+# The tasks run in addition to the Periodic Scripts:
+#     (name, function, period in seconds, offset in seconds from local midnight)
+# A task runs at the local times that are its offset plus a multiple of its period.
+TASKS = (
+    # store any readings left in the ingest spool
+    ('drain_spool', bmsapp.storereads.drain_spool, 300, 0),
+    # at the 15 and 45 minute marks in the hour
+    ('calc_readings', calc_readings.run, 1800, 900),
+    # a minute into each 5 minutes, so the fresh calculated readings are available
+    ('check_alerts', check_alerts.run, 300, 60),
+    # 5 minutes after midnight
+    ('daily_status', daily_status.run, 86400, 300),
+    # at 2:30 am every day
+    ('backup_django_db', backup_django_db.run, 86400, 9000),
+    # at 2:30 am every three days
+    ('backup_readingdb', backup_readingdb.run, 3 * 86400, 9000),
+    # at 3:00 am every day
+    ('rebuild_rollups', rebuild_rollups.run, 86400, 10800),
+)
+
+def next_run_time(period, offset, after, local=True):
+    '''Returns the first UNIX timestamp later than 'after' that is 'offset' seconds plus
+    a multiple of 'period' seconds from midnight.  If 'local' is True, the multiples
+    are counted from local midnight, otherwise from UTC midnight.
+    '''
+    def first_after(utc_offset):
+        secs = after + utc_offset
+        return secs - (secs - offset) % period + period - utc_offset
+
+    if not local:
+        return first_after(0)
+
+    # The UTC offset can change before the run time, at a daylight saving time change.
+    # The run time is then found with the offset in effect after the change, unless that
+    # time does not exist in local time.
+    utc_offset = time.localtime(after).tm_gmtoff
+    run_time = first_after(utc_offset)
+    run_offset = time.localtime(run_time).tm_gmtoff
+    if run_offset != utc_offset:
+        changed_time = first_after(run_offset)
+        if time.localtime(changed_time).tm_gmtoff == run_offset:
+            run_time = changed_time
+    return run_time
+
+def last_start_time(script):
+    '''Returns the UNIX timestamp of the start of the last run of the models.PeriodicScript
+    'script', from its results, or None if not known.
+    '''
+    try:
+        results = yaml.load(script.script_results, Loader=yaml.FullLoader)
+        start = datetime.strptime(results['script_start_time'], '%Y-%m-%d %H:%M:%S UTC')
+        return (start - datetime(1970, 1, 1)).total_seconds()
+    except:
+        return None
+
+def load_task_starts():
+    '''Returns a dictionary of the UNIX timestamps of the starts of the last runs of the
+    tasks, keyed on task name, from the STATE_FILE file.  The dictionary is empty if the
+    file does not exist or cannot be read.
+    '''
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_task_starts(task_starts):
+    '''Saves the dictionary 'task_starts' of the starts of the last task runs to the
+    STATE_FILE file.  A new file is written and renamed, so the file is never partly
+    written.
+    '''
+    try:
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        temp_name = STATE_FILE + '.tmp'
+        with open(temp_name, 'w') as f:
+            json.dump(task_starts, f)
+        os.replace(temp_name, STATE_FILE)
+    except OSError:
+        logger.exception('Error saving the task run times.')
+
+
+class TaskScheduler:
+    '''
+    Runs the tasks and Periodic Scripts at their scheduled times until stopped.
+    '''
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+
+        # Priority queue of (run time, kind, key) entries.  'kind' is 'task' or 'script';
+        # 'key' is the task name or the PeriodicScript primary key.  An entry whose run
+        # time no longer matches the 'next_runs' dictionary is out of date and ignored.
+        self.queue = []
+        self.next_runs = {}
+
+        self.tasks = {name: (func, period, offset) for name, func, period, offset in TASKS}
+        self.task_threads = {}     # task name: the thread last running the task
+        self.task_starts = {}      # task name: UNIX timestamp of the start of the last run
+        self.scripts = {}          # PeriodicScript primary key: PeriodicScript object
+        self.script_runner = run_periodic_scripts.Scheduler(persistent=True)
+
+    def schedule(self, kind, key, run_time):
+        '''Sets the next run time of the task or script 'kind', 'key' to 'run_time'.
+        '''
+        self.next_runs[(kind, key)] = run_time
+        heapq.heappush(self.queue, (run_time, kind, key))
+
+    def load_scripts(self):
+        '''Loads the enabled Periodic Scripts, scheduling new scripts and scripts whose
+        period changed, and dropping deleted and disabled scripts.
+        '''
+        now = time.time()
+        scripts = {script.pk: script for script in bmsapp.models.PeriodicScript.objects.exclude(period=0)}
+        for pk, script in scripts.items():
+            old_script = self.scripts.get(pk)
+            if old_script is None or old_script.period != script.period:
+                # if a run was missed, run the script now.
+                last_start = last_start_time(script)
+                run_time = next_run_time(script.period, 0, last_start, local=False) if last_start else now
+                self.schedule('script', pk, max(run_time, now))
+        for pk in set(self.scripts) - set(scripts):
+            self.next_runs.pop(('script', pk), None)
+        self.scripts = scripts
+
+    def run_task(self, name):
+        '''Runs the task 'name' in a new thread, unless it is still running from its
+        last run.
+        '''
+        thread = self.task_threads.get(name)
+        if thread and thread.is_alive():
+            logger.warning('%s task is still running from its last run, so it was not started.' % name)
+            return
+
+        def run():
+            start = time.time()
+            try:
+                self.tasks[name][0]()
+                logger.debug('%s task completed in %.1f seconds' % (name, time.time() - start))
+            except:
+                logger.exception('Error running %s task.' % name)
+            finally:
+                close_old_connections()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.task_threads[name] = thread
+        thread.start()
+        self.task_starts[name] = time.time()
+        save_task_starts(self.task_starts)
+
+    def run_due(self, now):
+        '''Runs the tasks and scripts due by the time 'now' and schedules their next runs.
+        '''
+        due_scripts = []
+        while self.queue and self.queue[0][0] <= now:
+            run_time, kind, key = heapq.heappop(self.queue)
+            if self.next_runs.get((kind, key)) != run_time:
+                continue     # out of date entry
+
+            if kind == 'task':
+                func, period, offset = self.tasks[key]
+                self.run_task(key)
+                next_time = next_run_time(period, offset, max(run_time, now))
+            else:
+                script = self.scripts[key]
+                period = script.period
+                due_scripts.append(script)
+                next_time = next_run_time(period, 0, max(run_time, now), local=False)
+
+            missed = int((now - run_time) // period)
+            if missed:
+                logger.warning('%s %s missed %s runs; it was run once.' % (kind, key, missed))
+            self.schedule(kind, key, next_time)
+
+        if due_scripts:
+            self.script_runner.add(due_scripts, now)
+
+    def run(self):
+        '''Runs the tasks and scripts until stop() is called.
+        '''
+        # if a run was missed while the process was stopped, run the task now.
+        now = time.time()
+        self.task_starts = load_task_starts()
+        for name, func, period, offset in TASKS:
+            last_start = self.task_starts.get(name)
+            run_time = next_run_time(period, offset, last_start) if last_start else next_run_time(period, offset, now)
+            self.schedule('task', name, max(run_time, now))
+        self.script_runner.start()
+
+        reload_time = 0.0
+        while not self.stop_event.is_set():
+            now = time.time()
+            if now >= reload_time:
+                try:
+                    close_old_connections()
+                    self.load_scripts()
+                except:
+                    logger.exception('Error loading the Periodic Scripts.')
+                reload_time = now + RELOAD_SECS
+
+            self.run_due(now)
+
+            # wait until the next run or reload
+            wake_time = min(self.queue[0][0], reload_time) if self.queue else reload_time
+            self.stop_event.wait(max(wake_time - time.time(), 0.0))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class Command(BaseCommand):
+    help = 'Runs the BMON background tasks and Periodic Scripts, in place of the main_cron cron job.'
+
+    def handle(self, *args, **options):
+        scheduler = TaskScheduler()
+        signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+        logger.info('Scheduler started.')
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
+        logger.info('Scheduler stopped.')
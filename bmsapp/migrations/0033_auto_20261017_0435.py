@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 04:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bmsapp', '0032_auto_20190926_1206'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='periodicscript',
+            name='period',
+            field=models.IntegerField(choices=[(0, 'Disabled'), (10, '10 sec'), (30, '30 sec'), (60, '1 min'), (120, '2 min'), (300, '5 min'), (600, '10 min'), (900, '15 min'), (1800, '30 min'), (3600, '1 hr'), (7200, '2 hr'), (14400, '4 hr'), (21600, '6 hr'), (43200, '12 hr'), (86400, '24 hr')], default=3600, verbose_name='How often should script run'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-17 04:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bmsapp', '0033_auto_20261017_0435'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodicScriptState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=80)),
+                ('value', models.BinaryField()),
+                ('script', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bmsapp.PeriodicScript')),
+            ],
+            options={
+                'unique_together': {('script', 'key')},
+            },
+        ),
+    ]
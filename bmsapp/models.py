@@ -1,14 +1,13 @@
 ﻿import time
-import json
 import logging
+import operator
 from django.db import models
 from django.core.validators import RegexValidator
 from django.conf import settings
-from django.core.mail import send_mail
-import requests
 import bmsapp.data_util
 import bmsapp.formatters
 from . import sms_gateways
+from . import notifications
 import yaml
 
 
@@ -127,7 +126,13 @@ class Sensor(models.Model):
         activity interval specified in the settings file.  'reading_db' is a sensor reading
         database, an instance of bmsapp.readingdb.bmsdata.BMSdata.
         '''
-        last_read = self.last_read(reading_db)
+        return self.is_recent(self.last_read(reading_db))
+
+    def is_recent(self, last_read):
+        '''Returns True if the reading dictionary 'last_read', the last reading of this
+        sensor, was posted within the sensor activity interval specified in the settings
+        file.  'last_read' is None if the sensor has no readings.
+        '''
         if last_read is not None:
             # get inactivity setting from settings file
             inactivity_hrs = getattr(settings, 'BMSAPP_SENSOR_INACTIVITY', 2.0)
@@ -625,55 +630,11 @@ class AlertRecipient(models.Model):
          service, 'pushover_priority' gives the priority string for the message
          (e.g. '0', '1', etc.)
          Retuns the number of successful messages sent.
+         To send many notifications together, use a bmsapp.notifications.Dispatcher.
         '''
-        if not self.active:
-            return 0
-
-        msgs_sent = 0     # tracks successful messages sent.
-
-        email_addrs = []
-        if self.notify_email:
-            email_addrs.append(self.email_address)
-        if self.notify_cell:
-            email_addrs.append('%s@%s' % (self.cell_number, self.cell_sms_gateway))
-
-        if email_addrs:
-            # The FROM email address
-            from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', '')
-            if from_email:
-                try:
-                    if send_mail(subject, message, from_email, email_addrs):
-                        msgs_sent += len(email_addrs)
-                except:
-                    _logger.exception('Error sending mail to alert recipients.')
-            else:
-                _logger.exception('No From Email address configured in Settings file.')
-
-        if self.notify_pushover:
-            # Get the Pushover API key out of the settings file, setting it to None
-            # if it is not present in the file.
-            pushover_api_key = getattr(settings, 'BMSAPP_PUSHOVER_APP_TOKEN', None)
-            if pushover_api_key:
-                url = 'https://api.pushover.net/1/messages.json'
-                payload = {'token': pushover_api_key,
-                    'user': self.pushover_id,
-                    'priority': pushover_priority,
-                    'title': subject,
-                    'message': message}
-                if pushover_priority=='2':
-                    # emergency priority requires a retry and expire parameter
-                    payload['retry'] = 300
-                    payload['expire'] = 7200
-                resp = json.loads(requests.post(url, data=payload).text)
-                if resp['status'] != 0:
-                    msgs_sent += 1
-                else:
-                    _logger.exception(', '.join(resp['errors']))
-
-            else:
-                _logger.exception('No Pushover API Token Key configured in Settings file.')
-
-        return msgs_sent
+        dispatcher = notifications.Dispatcher()
+        dispatcher.add([self], subject, message, pushover_priority)
+        return dispatcher.send()
 
 
 class AlertCondition(models.Model):
@@ -698,6 +659,16 @@ class AlertCondition(models.Model):
     # conditional type to evaluate for the sensor value
     condition = models.CharField('Notify when the Sensor value is', max_length=20, default='>', choices=CONDITION_CHOICES)
 
+    # the functions that test a sensor value against the test value for each condition
+    CONDITION_OPERATORS = {
+        '>': operator.gt,
+        '>=': operator.ge,
+        '<': operator.lt,
+        '<=': operator.le,
+        '==': operator.eq,
+        '!=': operator.ne,
+    }
+
     # the value to test the current sensor value against
     test_value = models.FloatField(verbose_name='this value', blank=True, null=True)
 
@@ -750,12 +721,16 @@ class AlertCondition(models.Model):
         return '%s %s %s, %s in %s mode' % \
             (self.sensor.title, self.condition, self.test_value, self.only_if_bldg, self.only_if_bldg_mode)
 
-    def check_condition(self, reading_db):
+    def check_condition(self, reading_db, recent_reads=None, bldg_titles=None):
         '''This method checks to see if the alert condition is in effect, and if so,
         returns a (subject, message) tuple describing the alert.  If the condition is 
         not in effect, None is returned.  'reading_db' is a sensor reading database, an 
         instance ofbmsapp.readingdb.bmsdata.BMSdata.  If the alert condition is not active, 
         None is returned.
+        To check many conditions with few queries, the caller can provide the sensor's
+        most recent readings, newest first, in the list 'recent_reads' (at least 
+        'read_count' readings if the sensor has that many), and the titles of the 
+        sensor's buildings in the list 'bldg_titles'.  Otherwise, they are queried.
         '''
 
         if not self.active:
@@ -763,14 +738,18 @@ class AlertCondition(models.Model):
 
         # Make a description of the sensor that includes the building(s) it is
         # associated with.
-        bldgs = [btos.building.title for btos in BldgToSensor.objects.filter(sensor__pk=self.sensor.pk)]
-        bldgs_str = ', '.join(bldgs)
+        if bldg_titles is None:
+            bldg_titles = [btos.building.title for btos in BldgToSensor.objects.filter(sensor__pk=self.sensor.pk)]
+        bldgs_str = ', '.join(bldg_titles)
         sensor_desc = '%s sensor in %s' % (self.sensor.title, bldgs_str)
 
         # get the most current reading for the sensor (last_read), and
         # also fill out a list of all the recent readings that need to
         # be evaluated to determine if the alert condition is true (last_reads).
-        if self.read_count==1:
+        if recent_reads is not None:
+            last_reads = recent_reads[:self.read_count]
+            last_read = last_reads[0] if len(last_reads) else None
+        elif self.read_count==1:
             last_read = self.sensor.last_read(reading_db)  # will be None if no readings
             last_reads = [last_read] if last_read else []
         else:
@@ -784,7 +763,7 @@ class AlertCondition(models.Model):
         # if the condition test is for an inactive sensor, do that test now.
         # Do not consider the building mode test for this test.
         if self.condition=='inactive':
-            if self.sensor.is_active(reading_db):
+            if self.sensor.is_recent(last_read):
                 # Sensor is active, no alert
                 return None
             else:
@@ -813,15 +792,16 @@ class AlertCondition(models.Model):
         # Loop through the requested number of last readings, testing whether
         # the alert conditions are satisfied for all the readings.
         # First see if there was a building mode test requested and test it.
-        if self.only_if_bldg is not None and self.only_if_bldg_mode is not None:
-            if self.only_if_bldg.current_mode != self.only_if_bldg_mode:
+        if self.only_if_bldg_id is not None and self.only_if_bldg_mode_id is not None:
+            if self.only_if_bldg.current_mode_id != self.only_if_bldg_mode_id:
                 # Failed building mode test
                 return None
 
         # Alert condition must be true for each of the requested readings
+        test_func = AlertCondition.CONDITION_OPERATORS[self.condition]
         for read in last_reads:
             # Evaluate the numeric test condition
-            if not eval( '%s %s %s' % (read['val'], self.condition, self.test_value) ):
+            if not test_func(read['val'], self.test_value):
                 # Failed value test
                 return None
 
@@ -851,6 +831,40 @@ class AlertCondition(models.Model):
 
         return subject, msg
 
+    def notify_recipients(self, subject, msg, dispatcher=None):
+        '''Sends the alert 'subject' and 'msg' to the recipients of this condition, unless
+        a notification was sent less than 'wait_before_next' hours ago, possibly by another
+        process checking alerts.  'last_notified' is updated if at least one message was
+        sent.  If a bmsapp.notifications.Dispatcher 'dispatcher' is given, the messages are
+        queued in it and are sent by its send() method; otherwise they are sent now.
+        Returns the number of messages sent now.
+        '''
+        recipients = [recip for recip in self.recipients.all() if recip.active]
+        if not recipients:
+            return 0
+
+        now = time.time()
+        prior_notified = self.last_notified
+
+        # Claim this notification in the database, so alert checks running at the same
+        # time in other processes do not also send it.
+        if not AlertCondition.objects.filter(pk=self.pk, last_notified__lte=now - self.wait_before_next * 3600.0).update(last_notified=now):
+            return 0
+
+        def done(msg_count):
+            if msg_count:
+                self.last_notified = now
+            else:
+                # no message was sent, so release the claim.
+                AlertCondition.objects.filter(pk=self.pk, last_notified=now).update(last_notified=prior_notified)
+
+        if dispatcher is not None:
+            dispatcher.add(recipients, subject, msg, self.priority, done)
+            return 0
+        dispatcher = notifications.Dispatcher()
+        dispatcher.add(recipients, subject, msg, self.priority, done)
+        return dispatcher.send()
+
     def wait_satisfied(self):
         '''Returns True if there has been enough wait between the last notification
         for this condition and now.
@@ -871,10 +885,15 @@ class PeriodicScript(models.Model):
     description = models.CharField('Optional Description', max_length=80, blank=True)
 
     # How often the script should be run, in units of seconds.
-    # Use defined choices; choices must be a multiple of 5 minutes, as that is
-    # how frequently the main cron procedure runs.
+    # Use defined choices.  Periods shorter than 5 minutes are only honored by the
+    # run_scheduler management command; the main cron procedure runs every 5 minutes,
+    # so it runs those scripts every 5 minutes.
     PERIOD_CHOICES = (
         (0, 'Disabled'),
+        (10, '10 sec'),
+        (30, '30 sec'),
+        (60, '1 min'),
+        (120, '2 min'),
         (300, '5 min'),
         (600, '10 min'),
         (900, '15 min'),
@@ -901,6 +920,27 @@ class PeriodicScript(models.Model):
     def __str__(self):
         return '%s -- %s' % (self.script_file_name, self.script_parameters.replace('\n', ', '))
 
+class PeriodicScriptState(models.Model):
+    """A value saved by a Periodic Script for use by its later runs, stored in a compact
+    binary (pickle) form.  Each value is read and written separately; see the ScriptState
+    class in scripts/run_periodic_scripts.py.
+    """
+
+    # the Periodic Script that saved the value
+    script = models.ForeignKey(PeriodicScript, on_delete=models.CASCADE)
+
+    # the name of the value
+    key = models.CharField(max_length=80)
+
+    # the pickled value
+    value = models.BinaryField()
+
+    def __str__(self):
+        return '%s: %s' % (self.script.script_file_name, self.key)
+
+    class Meta:
+        unique_together = ('script', 'key')
+
 class CustomReport(models.Model):
     """Defines a custom report with text and widgets defined by the user.
     """
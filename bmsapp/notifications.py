@@ -0,0 +1,243 @@
+'''
+Sends Alert notifications to Alert recipients by email (including text messages
+sent through cell phone email gateways) and through the Pushover service.
+
+Notifications are queued in a Dispatcher and sent together: all of the email
+messages are sent over one SMTP connection, Pushover messages with the same content
+are combined into one request, and the Pushover requests are made concurrently
+through a pooled HTTPS session, so one slow request does not hold up the others.
+Failed sends are retried a few times.
+'''
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+# Make a logger for this module
+_logger = logging.getLogger('bms.' + __name__)
+
+PUSHOVER_URL = 'https://api.pushover.net/1/messages.json'
+
+# the maximum number of user keys in one Pushover request
+PUSHOVER_MAX_USERS = 50
+
+# the number of Pushover requests made at once
+PUSHOVER_WORKERS = 4
+
+# the number of tries made to send a message, and the seconds to wait before the
+# second try; the wait doubles for each following try.
+MAX_TRIES = 3
+RETRY_WAIT_SECS = 2.0
+
+# the seconds to wait for a response from the Pushover service
+PUSHOVER_TIMEOUT_SECS = 20
+
+_session_lock = threading.Lock()
+_session = None
+
+def _pushover_session():
+    '''Returns the requests Session shared by all Pushover requests in this process, so
+    that HTTPS connections are reused.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=PUSHOVER_WORKERS)
+            _session.mount('https://', adapter)
+        return _session
+
+def _with_retries(send_func, description, final_errors=()):
+    '''Calls 'send_func' until it returns without raising an error, up to MAX_TRIES times.
+    Returns the value returned by 'send_func', or raises the last error.  Errors of the
+    types in the tuple 'final_errors' are raised without retrying.  'description' 
+    describes the message for the log.
+    '''
+    wait = RETRY_WAIT_SECS
+    for try_num in range(1, MAX_TRIES + 1):
+        try:
+            return send_func()
+        except final_errors:
+            raise
+        except:
+            if try_num == MAX_TRIES:
+                raise
+            _logger.warning('Error sending %s, retrying.' % description, exc_info=True)
+            time.sleep(wait)
+            wait *= 2
+
+
+class PushoverError(Exception):
+    '''A message rejected by the Pushover service; it is not retried.
+    '''
+    pass
+
+
+class Dispatcher:
+    '''Queues notifications for Alert recipients and sends them together.  Add the
+    notifications with add(), then call send().
+    '''
+
+    def __init__(self):
+        self._count_lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        '''Empties the queue of notifications.
+        '''
+        self.emails = []       # list of (EmailMessage, index of its notification)
+        self.pushovers = {}    # (priority, title, message): list of (user key, index of its notification)
+        self.done_funcs = []   # the 'done' function of each notification
+        self.sent_counts = []  # the number of messages sent for each notification
+
+    def add(self, recipients, subject, message, pushover_priority, done=None):
+        '''Queues the notification with the 'subject' and 'message' for the list of
+        AlertRecipient objects 'recipients', each being sent by the means enabled for
+        that recipient.  For the Pushover notification service, 'pushover_priority'
+        gives the priority string for the message (e.g. '0', '1', etc.).  If given,
+        'done' is called after send() with the number of messages successfully sent
+        for this notification.
+        '''
+        ix = len(self.done_funcs)
+        self.done_funcs.append(done)
+        self.sent_counts.append(0)
+
+        # The FROM email address
+        from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', '')
+
+        # Get the Pushover API key out of the settings file, setting it to None
+        # if it is not present in the file.
+        pushover_api_key = getattr(settings, 'BMSAPP_PUSHOVER_APP_TOKEN', None)
+
+        for recip in recipients:
+            if not recip.active:
+                continue
+
+            email_addrs = []
+            if recip.notify_email:
+                email_addrs.append(recip.email_address)
+            if recip.notify_cell:
+                email_addrs.append('%s@%s' % (recip.cell_number, recip.cell_sms_gateway))
+
+            if email_addrs:
+                if from_email:
+                    self.emails.append((EmailMessage(subject, message, from_email, email_addrs), ix))
+                else:
+                    _logger.error('No From Email address configured in Settings file.')
+
+            if recip.notify_pushover:
+                if pushover_api_key:
+                    key = (pushover_priority, subject, message)
+                    self.pushovers.setdefault(key, []).append((recip.pushover_id, ix))
+                else:
+                    _logger.error('No Pushover API Token Key configured in Settings file.')
+
+    def _count_sent(self, ix, count):
+        with self._count_lock:
+            self.sent_counts[ix] += count
+
+    def _send_emails(self):
+        '''Sends the queued email messages over one SMTP connection, reconnecting
+        if an error occurs.  Returns a list of the seconds taken by each message.
+        '''
+        latencies = []
+        connection = get_connection()
+        try:
+            for email, ix in self.emails:
+                email.connection = connection
+                start = time.time()
+                def send_one():
+                    try:
+                        connection.open()    # does nothing if the connection is open
+                        return email.send()
+                    except:
+                        # start over with a new connection
+                        connection.close()
+                        raise
+                try:
+                    if _with_retries(send_one, 'email to %s' % ', '.join(email.to)):
+                        self._count_sent(ix, len(email.to))
+                except:
+                    _logger.exception('Error sending mail to alert recipients.')
+                latencies.append(time.time() - start)
+        finally:
+            connection.close()
+        return latencies
+
+    def _send_pushover(self, key, users):
+        '''Sends one Pushover message to the list of (user key, notification index)
+        'users'.  'key' is the (priority, title, message) of the message.  Returns the
+        seconds taken.
+        '''
+        start = time.time()
+        pushover_priority, subject, message = key
+        payload = {'token': getattr(settings, 'BMSAPP_PUSHOVER_APP_TOKEN', None),
+            'user': ','.join(user for user, ix in users),
+            'priority': pushover_priority,
+            'title': subject,
+            'message': message}
+        if pushover_priority=='2':
+            # emergency priority requires a retry and expire parameter
+            payload['retry'] = 300
+            payload['expire'] = 7200
+
+        def send_one():
+            resp = _pushover_session().post(PUSHOVER_URL, data=payload, timeout=PUSHOVER_TIMEOUT_SECS)
+            if resp.status_code >= 500 or resp.status_code == 429:
+                # the service is having trouble; try again
+                resp.raise_for_status()
+            result = resp.json()
+            if result['status'] == 0:
+                raise PushoverError(', '.join(result.get('errors', [])))
+
+        try:
+            _with_retries(send_one, 'Pushover message', (PushoverError,))
+            for user, ix in users:
+                self._count_sent(ix, 1)
+        except PushoverError as e:
+            _logger.error('Pushover message rejected: %s' % e)
+        except:
+            _logger.exception('Error sending Pushover message.')
+        return time.time() - start
+
+    def send(self):
+        '''Sends the queued notifications, calls the 'done' function of each, and clears
+        the queue.  Returns the total number of messages successfully sent.
+        '''
+        # group the Pushover messages into requests of up to PUSHOVER_MAX_USERS users.
+        pushover_reqs = []
+        for key, users in self.pushovers.items():
+            for i in range(0, len(users), PUSHOVER_MAX_USERS):
+                pushover_reqs.append((key, users[i:i + PUSHOVER_MAX_USERS]))
+
+        # The emails are sent one after another over their connection while the
+        # Pushover requests are made.
+        email_latencies = []
+        pushover_latencies = []
+        if self.emails or pushover_reqs:
+            with ThreadPoolExecutor(max_workers=PUSHOVER_WORKERS + 1) as pool:
+                email_future = pool.submit(self._send_emails) if self.emails else None
+                pushover_latencies = list(pool.map(lambda req: self._send_pushover(*req), pushover_reqs))
+                if email_future:
+                    email_latencies = email_future.result()
+
+        for channel, latencies in (('email', email_latencies), ('Pushover', pushover_latencies)):
+            if latencies:
+                _logger.info('%s %s sends, average %.2f seconds, maximum %.2f seconds' %
+                             (len(latencies), channel, sum(latencies) / len(latencies), max(latencies)))
+
+        for done, count in zip(self.done_funcs, self.sent_counts):
+            if done:
+                try:
+                    done(count)
+                except:
+                    _logger.exception('Error finishing a notification.')
+
+        total = sum(self.sent_counts)
+        self._clear()
+        return total
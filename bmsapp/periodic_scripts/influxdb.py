@@ -1,12 +1,42 @@
 ﻿'''
 Script to send new sensor readings to an InfluxDB time-series database.
+
+The Sensor, Building and Sensor Group information is loaded with one query, and the
+tags of each Sensor / Building combination are encoded once per run.  The readings
+of each sensor are read as arrays and encoded in InfluxDB line protocol directly into
+large batches, which are gzip-compressed and posted through a keep-alive HTTP session,
+several at a time.
 '''
 import time
+import gzip
 import string
+import threading
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import requests
 from bmsapp.readingdb import bmsdata
-from bmsapp.models import Sensor, Building, BldgToSensor
+from bmsapp.models import BldgToSensor
+
+# the number of batches posted at once
+UPLOAD_WORKERS = 4
+
+_session_lock = threading.Lock()
+_session = None
+
+def _influx_session():
+    '''Returns the requests Session shared by all InfluxDB posts in this process, so that
+    HTTP connections are reused.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=UPLOAD_WORKERS)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
 
 def run(influx_url= '', 
         database_name='',
@@ -17,6 +47,8 @@ def run(influx_url= '',
         last_rec={},
         reach_back=14,      # days
         ignore_last_rec=False,
+        batch_size=5000,
+        script_state=None,
         **kwargs):
     """
     Parameters
@@ -36,7 +68,9 @@ def run(influx_url= '',
         name.
     value_field:  The name of the InfluxDB field used to hold the sensor value.
     last_rec: A dictionary keyed on a tuple of (Sensor Object id, BldgToSensor Object ID)
-        that gives the timestamp of the last record sent to InfluxDB.
+        that gives the timestamp of the last record sent to InfluxDB.  When run as a 
+        Periodic Script, this dictionary is kept in the 'script_state' store instead;
+        this parameter is only read if the store does not have it yet.
     reach_back:  If a BMON sensor has not been posted to the InfluxDB database before,
          this parameter determines how much history of sensor readings are sent to the
          database.  The parameter is measured in days.  For example, if the parameter is
@@ -52,6 +86,9 @@ def run(influx_url= '',
         After that run which will post a large amount of historical records, you can set 
         this 'ignore_last_rec' parameter to False and continue forward with only posting new
         BMON sensor readings.
+    batch_size:  The maximum number of records posted to InfluxDB in one request.
+    script_state:  The run_periodic_scripts.ScriptState object passed to Periodic Scripts,
+        or None if not run as a Periodic Script.
     """
 
     # tracks errors that occur in the sending process
@@ -63,36 +100,46 @@ def run(influx_url= '',
     # blank out last record dictionary if it should be ignored
     if ignore_last_rec:
         last_rec_dict = {}
+    elif script_state is not None:
+        last_rec_dict = script_state.get('last_rec', last_rec)
     else:
         last_rec_dict = last_rec
 
+    post_url = influx_url
+    post_params = {'db': database_name, 'u': username, 'p': password, 'precision': 's'}
+
+    def post_batch(body):
+        r = _influx_session().post(post_url, params=post_params, data=gzip.compress(body),
+                                   headers={'Content-Encoding': 'gzip'})
+        if r.status_code != 204:
+            raise ValueError('Error occurred while storing in InfluxDB.  Status Code: %s, Error: %s' % (r.status_code, r.json()['error']))
+
     try:
-        for recs, batch_last_ts in new_records(last_rec_dict, reach_back):
-            # Create the InfluxDB line protocol string including all of the records.
-            # Replace spaces and special characters in tags and tag values.
-            lines = ''
-            batch_rec_count = 0
-            for tags, ts, value in recs:
-                lin = measurement     # line protocol starts with the measurement name
-                for tag, tag_value in sorted(tags.items()):
-                    # Underbar is the replacement character for tag names, and dash is replacement
-                    # character for tag values.
-                    lin += ',%s=%s' % (clean_string(str(tag), '_'), clean_string(str(tag_value), '-'))
-                # Only using integer second timestamp precision
-                lin += ' %s=%s %d' % (value_field, value, int(ts))
-                lines += '%s\n' % lin
-                batch_rec_count += 1
-
-            # post the records
-            r = requests.post('%s?db=%s&u=%s&p=%s&precision=s' % (influx_url, database_name, username, password), 
-                              data=lines)
-            if r.status_code == 204:
-                # success
+        # The batches are posted several at a time, but their results are checked in order,
+        # so the last record timestamps are only advanced past batches that were stored.
+        # The number of batches waiting is limited to bound memory use.
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            pending = deque()
+
+            def finish_oldest():
+                nonlocal records_sent
+                fut, batch_rec_count, batch_last_ts = pending.popleft()
+                fut.result()     # raises the error of a failed post
                 records_sent += batch_rec_count
                 # update dictionary tracking latest record sent for a sensor/building combo
                 last_rec_dict.update(batch_last_ts)
-            else:
-                raise ValueError('Error occurred while storing in InfluxDB.  Status Code: %s, Error: %s' % (r.status_code, r.json()['error']))
+
+            try:
+                for body, batch_rec_count, batch_last_ts in line_batches(last_rec_dict, reach_back, measurement,
+                                                                          value_field, batch_size):
+                    pending.append((pool.submit(post_batch, body), batch_rec_count, batch_last_ts))
+                    while len(pending) > UPLOAD_WORKERS * 2 or (pending and pending[0][0].done()):
+                        finish_oldest()
+                while pending:
+                    finish_oldest()
+            finally:
+                for fut, batch_rec_count, batch_last_ts in pending:
+                    fut.cancel()
 
     except:
         # Store information about the error that occurred
@@ -103,27 +150,49 @@ def run(influx_url= '',
         results['script_errors'] = errors
         results['records_sent'] = records_sent
         # we don't show the returned dictionary of last timestamps posted.
-        results['hidden'] = {'last_rec': last_rec_dict}
+        if script_state is not None:
+            script_state.set('last_rec', last_rec_dict)
+        else:
+            results['hidden'] = {'last_rec': last_rec_dict}
         return results
 
 
-def new_records(last_rec={}, reach_back=14, chunk_size=500):
-    """A Python generator function that yields a list of new sensor readings from the BMON 
-    reading database and a dictionary indicating the time of the most recent reading for each
-    sensor in the return records.  So the function return is a two-element tuple:
-        (sensor reading list), (dictionary of timestamps of the last readings in the sensor
-        reading list)
-    First, here is a description of the sensor reading list element of the return value.
-    This is a list of 3-element tuples, with each tuple being of the format:
-        (tags, ts, value)
-    where 'tags' is a dictionary of metadata about the sensor reading; for example 
-    {'sensor_id': 'homer_18234', 'bldg': 'Homer-Strawbale'}.  These tags are created from
-    BMON properties of the Sensor and the associated Building(s) objects. 'ts' is the Unix Epoch
-    timestamp of the reading, and 'value' is the sensor reading value.
-    The second element of the function return value is a dictionary that gives the Unix Epoch 
-    timestamp of the most current reading for each sensor in the returned sensor reading list.
-    The dictionary is keyed on a 2-tuple of the object ID of the BMON Sensor and the BMON
-    BldgToSensor link object.
+def sensor_links():
+    """Returns a list of (Sensor, list of BldgToSensor links) tuples, one for each Sensor
+    associated with a building, with the related Sensor, Building, Unit and Sensor Group
+    objects loaded in one query.
+    """
+    links = {}
+    sensors = {}
+    for link in BldgToSensor.objects.select_related('sensor__unit', 'building', 'sensor_group').order_by('sensor_id', 'id'):
+        sensors[link.sensor_id] = link.sensor
+        links.setdefault(link.sensor_id, []).append(link)
+    return [(sensors[sensor_pk], sensor_link_list) for sensor_pk, sensor_link_list in links.items()]
+
+def line_prefix(measurement, value_field, tags):
+    """Returns the start of an InfluxDB line protocol line for the 'measurement' and the
+    dictionary of 'tags', up to the '=' following the 'value_field' name.  Spaces and
+    special characters in tags and tag values are replaced.
+    """
+    lin = measurement     # line protocol starts with the measurement name
+    for tag, tag_value in sorted(tags.items()):
+        # Underbar is the replacement character for tag names, and dash is replacement
+        # character for tag values.
+        lin += ',%s=%s' % (clean_string(str(tag), '_'), clean_string(str(tag_value), '-'))
+    return '%s %s=' % (lin, value_field)
+
+def line_batches(last_rec={}, reach_back=14, measurement='reading', value_field='value', batch_size=5000):
+    """A Python generator function that yields batches of new sensor readings from the BMON
+    reading database, encoded in InfluxDB line protocol.  Each batch is a three-tuple:
+        (line protocol bytes, number of records, dictionary of timestamps of the last
+        readings in the batch)
+    The tags of each reading are created from BMON properties of the Sensor and the
+    associated Building, plus the Sensor Group; for example
+    {'sensor_id': 'homer_18234', 'building_title': 'Homer-Strawbale', ...}.  A reading
+    is sent once for each Building the Sensor is associated with.  Timestamps are integer
+    seconds.  The dictionary of timestamps gives the Unix Epoch timestamp of the most
+    current reading for each sensor in the batch, keyed on a 2-tuple of the object ID of
+    the BMON Sensor and the BMON BldgToSensor link object.
     
     Input Parameters
     ----------------
@@ -135,13 +204,14 @@ def new_records(last_rec={}, reach_back=14, chunk_size=500):
     reach_back:  If the 'last_rec' dictionary does not contain a key for a sensor, then this 'reach_back'
         parameter determines how many days of sensor readings will be returned by this function.  If
         'reach_back' is set to 0, all historical readings will be included.
-    chunk_size: This is the maximum number of records (3-element tuples) that will be yielded by
-        this function at one time.  If there are 1200 sensor reading in total and 'chunk_size' is set
-        to 500, the function will yield three times, yielding 500 records, 500 records, and 200 records.
+    measurement:  The InfluxDB measurement name of the readings.
+    value_field:  The name of the InfluxDB field holding the reading value.
+    batch_size: This is the maximum number of records in one batch.
     """
 
-    rd_list = []     # list of sensor readings to return
-    last_ts = {}     # tracks timestamp of last record yielded
+    buf = bytearray()    # the line protocol of the batch
+    rec_count = 0        # the number of records in the batch
+    last_ts = {}         # tracks timestamp of last record in the batch
 
     # starting timestamp to use if a sensor is not in last_ts.
     if reach_back != 0:
@@ -152,47 +222,63 @@ def new_records(last_rec={}, reach_back=14, chunk_size=500):
 
     # the database object that allows access to the sensor reading database
     read_db = bmsdata.BMSdata()
-    
-    # Loop through every sensor
 
-    for sensor in Sensor.objects.all():
+    # the tags of each building, which are used with many sensors
+    bldg_tags_cache = {}
+
+    for sensor, links in sensor_links():
 
         # the list of tags for this sensor
         sensor_tags = sensor.key_properties()
 
-        # loop through all buildings associated with this sensor.  We will send the 
-        # sensor readings multiple times if there are multiple associated buildings.
-        for bl_sens_link in BldgToSensor.objects.filter(sensor=sensor):
-            
+        # read the sensor readings needed by all of the building links at once.
+        # Adding one to the starting timestamps cuz database call is inclusive.
+        start_times = [last_rec.get((sensor.id, link.id), reach_back_ts) + 1 for link in links]
+        db_ts, db_vals = read_db.arraysForOneID(sensor.sensor_id, start_tm=min(start_times))
+
+        # We will send the sensor readings multiple times if there are multiple associated
+        # buildings.
+        for link, start_ts in zip(links, start_times):
+            ix = np.searchsorted(db_ts, start_ts)
+            if ix == len(db_ts):
+                continue
+
             # the list of tags for the associated building
-            bldg_tags = bl_sens_link.building.key_properties()
+            if link.building_id not in bldg_tags_cache:
+                bldg_tags_cache[link.building_id] = link.building.key_properties()
+            bldg_tags = bldg_tags_cache[link.building_id].copy()
 
             # add a tag to this set for the Sensor Group that the sensor is in
-            bldg_tags['sensor_group'] = bl_sens_link.sensor_group.title
+            bldg_tags['sensor_group'] = link.sensor_group.title
 
             # combine the sensor and building tags together for the final set of tags
             # for this sensor/building combo.
             final_tags = sensor_tags.copy()
             final_tags.update(bldg_tags)
+            prefix = line_prefix(measurement, value_field, final_tags)
 
-            # get the starting timestamp for this sensor
-            start_ts = last_rec.get((sensor.id, bl_sens_link.id), reach_back_ts) + 1    # adding one cuz database call is inclusive
-
-            # loop through all the sensor readings
-            for rec in read_db.rowsForOneID(sensor.sensor_id, start_tm = start_ts):
-                ts = int(rec['ts'])
-                rd_list.append( (final_tags, ts, rec['val']) )
-                last_ts[(sensor.id, bl_sens_link.id)] = ts
-                if len(rd_list) == chunk_size:
-                    yield rd_list, last_ts
-                    rd_list = []
+            # add the readings to the batch, yielding each full batch
+            ts_list = db_ts[ix:].tolist()
+            val_list = db_vals[ix:].tolist()
+            pos = 0
+            while pos < len(ts_list):
+                end = min(pos + batch_size - rec_count, len(ts_list))
+                buf += ''.join(['%s%s %d\n' % (prefix, val, ts) for ts, val in zip(ts_list[pos:end], val_list[pos:end])]).encode('utf-8')
+                rec_count += end - pos
+                last_ts[(sensor.id, link.id)] = ts_list[end - 1]
+                pos = end
+                if rec_count == batch_size:
+                    yield bytes(buf), rec_count, last_ts
+                    buf = bytearray()
+                    rec_count = 0
                     last_ts = {}
 
     # if any remaining records, yield them
-    if len(rd_list):
-        yield rd_list, last_ts
+    if rec_count:
+        yield bytes(buf), rec_count, last_ts
 
 def clean_string(s, sep_char='-'):
+
     """Function that "cleans" a string by substituting a particular character for whitepace,
     commas, and equal signs.  These are special characters to InfluxDB; they could be escaped
     but it was decided to substitute a character for them. After that substitution is make, 
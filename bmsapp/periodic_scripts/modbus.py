@@ -1,15 +1,118 @@
 """Script to import data from a device that supports MODBUS TCP.
 Multiple registers can be read and returned as new BMON sensor readings.
+
+The registers of each port are read with the fewest block reads that stay within
+the MODBUS limit of MAX_REGISTERS registers per read, and the ports are read at the
+same time.  The MODBUS connections are kept open in a pool keyed on (host, port,
+device ID) and reused by later runs when the process stays running (see the
+run_scheduler management command).  Different hosts are polled at the same time by
+the Periodic Script scheduler.
 """
 
    # needed for transform functions
 import time
 from math import *       # make available for transform functions
+import threading
 import traceback
 import struct
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import modbus_tk.defines as cst
 from modbus_tk import modbus_tcp
+from modbus_tk.exceptions import ModbusError
+
+# the maximum number of holding registers read in one MODBUS request
+MAX_REGISTERS = 125
+
+# the number of ports of a host read at once
+PORT_WORKERS = 4
+
+# a pooled connection unused for this many seconds is reopened before its next use, as
+# the device has likely dropped it.
+IDLE_SECS = 600.0
+
+# seconds to wait for a response from a MODBUS device
+TIMEOUT_SECS = 5.0
+
+
+class _Connection:
+    """A pooled connection to one MODBUS device.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.master = None
+        self.last_use = 0.0
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.master:
+            self.master.close()
+        self.master = None
+
+
+_pool_lock = threading.Lock()
+_connections = {}    # (host, port, device ID): _Connection
+
+def execute(host, port, device_id, function_code, start_address, count):
+    """Executes a MODBUS request on the device 'device_id' at 'host', 'port' through a
+    pooled connection, and returns the result.  If a reused connection fails, the
+    request is tried again on a new connection.
+    """
+    key = (host, port, device_id)
+    with _pool_lock:
+        if key not in _connections:
+            _connections[key] = _Connection(host, port)
+        conn = _connections[key]
+
+    with conn.lock:
+        while True:
+            if conn.master and time.time() - conn.last_use > IDLE_SECS:
+                conn.close()
+            new_connection = conn.master is None
+            if new_connection:
+                conn.master = modbus_tcp.TcpMaster(host=host, port=port, timeout_in_sec=TIMEOUT_SECS)
+            try:
+                res = conn.master.execute(device_id, function_code, start_address, count)
+                conn.last_use = time.time()
+                return res
+            except ModbusError:
+                # the device answered with an error; the connection is fine.
+                conn.last_use = time.time()
+                raise
+            except:
+                conn.close()
+                if new_connection:
+                    raise
+
+def register_blocks(addresses, max_count=MAX_REGISTERS):
+    """Returns the fewest (start address, register count) blocks that include all of
+    the register 'addresses', with no block having more than 'max_count' registers.
+    """
+    blocks = []
+    for adr in sorted(set(addresses)):
+        if blocks and adr < blocks[-1][0] + max_count:
+            blocks[-1][1] = adr - blocks[-1][0] + 1
+        else:
+            blocks.append([adr, 1])
+    return [tuple(block) for block in blocks]
+
+def read_registers(host, port, device_id, addresses):
+    """Returns a dictionary of the values of the holding registers at 'addresses' of the
+    device 'device_id' at 'host', 'port', keyed on address, and a string describing the
+    errors of any blocks of registers that could not be read.
+    """
+    values = {}
+    errors = ''
+    for start_address, addr_count in register_blocks(addresses):
+        try:
+            res = execute(host, port, device_id, cst.READ_HOLDING_REGISTERS, start_address, addr_count)
+            values.update(zip(range(start_address, start_address + addr_count), res))
+        except:
+            errors += '\nError reading port %s, addresses %s - %s:\n%s' % \
+                      (port, start_address, start_address + addr_count - 1, traceback.format_exc())
+    return values, errors
 
 def run(site_id='', host='', device_id=1, holding_registers=[], **kwargs):
     """This function is called by the Periodic Script controller. The
@@ -42,83 +145,15 @@ def run(site_id='', host='', device_id=1, holding_registers=[], **kwargs):
         else:
             df.columns = ['port', 'address', 'sensor_name', 'transform']
 
-        # loop through each port and read sensor values
-
         ts = time.time()     # use common timestamp for all readings.
 
-        groups = df.groupby('port')
-        for port, dfg in groups:
-            try:
-                # find range of addresses to read
-                # Need to account for fact that an address entry can be a list of
-                # addresses in cases where multiple MODBUS registers are combined
-                # to make a large number.
-                addresses = []
-                for it in dfg.address.values:
-                    if type(it)==list:
-                        for adr in it:
-                            if type(adr)==int:
-                                addresses.append(adr)
-                    else:
-                        addresses.append(it)
-                start_address = min(addresses)
-                end_address = max(addresses)
-                addr_count = end_address - start_address + 1
-                if addr_count > 127:
-                    raise Exception('Error processing port %s. Code is currently limited to addresses with a span of 127 registers or less.' % port)
-
-                # read the range of addresses from this port
-                master = modbus_tcp.TcpMaster(host=host, port=port, timeout_in_sec=5.0)
-                res = master.execute(device_id, cst.READ_HOLDING_REGISTERS, start_address, addr_count)
-                master.close()
-
-                # process each sensor
-                for ix, row in dfg.iterrows():
-                    try:
-                        addr = row['address']
-                        if type(addr)==list:
-                            # multiple addresses in a list.  Combine the values
-                            # MSB first, so start from the back. 16-bits in each digit.
-
-                            # The last element in the list may be a string indicating that this
-                            # is not an integer value and needs further conversion.  Don't use
-                            # that last string element when calculating the number.
-                            num_digits = len(addr)
-                            if type(addr[-1])==str:
-                                num_digits -= 1
-
-                            # reverse the addresses so LSB is first
-                            rev_addr = list(reversed(addr[:num_digits]))
-                            mult = 1
-                            val = 0
-                            for ad in rev_addr:
-                                val += mult * res[ad - start_address]
-                                mult *= 2**16
-
-                            # If the last entry in the list was a string, that indicates
-                            # that further conversion is needed.
-                            if addr[-1]=='f':
-                                # the number is really a single-precision floating point number;
-                                # convert it.
-                                s = struct.pack('i', val)
-                                val = struct.unpack('f', s)[0]
-
-                        else:
-                            # single address, just read the value
-                            val = res[addr - start_address]
-
-                        if row['transform']:
-                            val = eval(row['transform'])
-                        sensor_id = '%s_%s' % (site_id, row['sensor_name'])
-                        readings.append((ts, sensor_id, val))
-
-                    except Exception as e:
-                        errors += '\nError processing %s: %s' % (row['sensor_name'], str(e))
-                        continue   # to next sensor
-
-            except:
-                errors += '\n' + traceback.format_exc()
-                continue   # to next port
+        # read the ports at the same time
+        with ThreadPoolExecutor(max_workers=PORT_WORKERS) as pool:
+            futures = [pool.submit(read_port, host, port, device_id, site_id, dfg, ts) for port, dfg in df.groupby('port')]
+            for fut in futures:
+                port_readings, port_errors = fut.result()
+                readings += port_readings
+                errors += port_errors
 
     except:
         # Store information about the error that occurred
@@ -128,3 +163,80 @@ def run(site_id='', host='', device_id=1, holding_registers=[], **kwargs):
                'script_errors': errors}
 
     return results
+
+def read_port(host, port, device_id, site_id, dfg, ts):
+    """Reads the holding registers described by the rows of the DataFrame 'dfg' from the
+    device 'device_id' at 'host', 'port'.  Returns a list of (ts, sensor ID, value)
+    readings, all with the timestamp 'ts' and with Sensor IDs starting with 'site_id',
+    and a string describing any errors.
+    """
+    errors = ''
+    readings = []
+    try:
+        # find the addresses to read
+        # Need to account for fact that an address entry can be a list of
+        # addresses in cases where multiple MODBUS registers are combined
+        # to make a large number.
+        addresses = []
+        for it in dfg.address.values:
+            if type(it)==list:
+                for adr in it:
+                    if type(adr)==int:
+                        addresses.append(adr)
+            else:
+                addresses.append(it)
+
+        # read the addresses from this port
+        values, errors = read_registers(host, port, device_id, addresses)
+
+        # process each sensor
+        for ix, row in dfg.iterrows():
+            try:
+                addr = row['address']
+                missing = [ad for ad in (addr if type(addr)==list else [addr]) if type(ad)!=str and ad not in values]
+                if missing:
+                    raise ValueError('register(s) %s could not be read' % missing)
+                if type(addr)==list:
+                    # multiple addresses in a list.  Combine the values
+                    # MSB first, so start from the back. 16-bits in each digit.
+
+                    # The last element in the list may be a string indicating that this
+                    # is not an integer value and needs further conversion.  Don't use
+                    # that last string element when calculating the number.
+                    num_digits = len(addr)
+                    if type(addr[-1])==str:
+                        num_digits -= 1
+
+                    # reverse the addresses so LSB is first
+                    rev_addr = list(reversed(addr[:num_digits]))
+                    mult = 1
+                    val = 0
+                    for ad in rev_addr:
+                        val += mult * values[ad]
+                        mult *= 2**16
+
+                    # If the last entry in the list was a string, that indicates
+                    # that further conversion is needed.
+                    if addr[-1]=='f':
+                        # the number is really a single-precision floating point number;
+                        # convert it.
+                        s = struct.pack('i', val)
+                        val = struct.unpack('f', s)[0]
+
+                else:
+                    # single address, just read the value
+                    val = values[addr]
+
+                if row['transform']:
+                    val = eval(row['transform'])
+                sensor_id = '%s_%s' % (site_id, row['sensor_name'])
+                readings.append((ts, sensor_id, val))
+
+            except Exception as e:
+                errors += '\nError processing %s: %s' % (row['sensor_name'], str(e))
+                continue   # to next sensor
+
+    except:
+        errors += '\n' + traceback.format_exc()
+
+    return readings, errors
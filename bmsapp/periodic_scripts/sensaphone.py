@@ -2,10 +2,26 @@
 If changes need to be made, it is helpful to download the free MIB browser available at:
 http://www.ireasoning.com/ . To use this properly you have to "Load mib" and then load
 the IMS-4000 MIB available from Sensaphone's website.
+
+Many OIDs are packed into each SNMP request: the address and name of several nodes are
+read with one GET, and the sensor name and value tables of several nodes are walked
+together with GETBULK requests.  One SNMP engine and transport are used for all of the
+requests to a host.  Several Sensaphone hosts can be read by one script, at the same
+time, each within a deadline.
 """
 
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchInstance, NoSuchObject
+
+# the number of Sensaphone hosts read at once
+HOST_WORKERS = 8
+
+# the seconds to wait for a response to an SNMP request, and the number of retries
+SNMP_TIMEOUT = 1.0
+SNMP_RETRIES = 2
 
 class SensaphoneReader():
     """Class to read sensor and status values from an IMS-4000 Sensaphone host unit.
@@ -14,96 +30,136 @@ class SensaphoneReader():
     # The highest valid node
     NODE_MAX = 32
 
-    def __init__(self, host, site_id):
+    # the number of nodes whose address and name are read in one GET request
+    NODES_PER_GET = 8
+
+    # the number of nodes whose sensor tables are walked together
+    NODES_PER_WALK = 4
+
+    # the maximum number of values requested in one GETBULK request
+    MAX_BULK_VALUES = 48
+
+    def __init__(self, host, site_id, deadline=None, snmp_v1=False):
         """The constructor parameters are:
             'host': IP address or hostname of the Sensaphone.
             'site_id': The ID string that will be prepended to all of the
                 readings coming from the Sensaphone to create BMON Sensor IDs.
+            'deadline': If given, the number of seconds allowed for reading the
+                Sensaphone; nodes not read by then are skipped.
+            'snmp_v1': If True, the sensor tables are walked with SNMPv1 GETNEXT
+                requests, for Sensaphones that do not answer SNMPv2c GETBULK requests.
         """
         self.host = host
         self.site_id = site_id
+        self.deadline = deadline
+        self.snmp_v1 = snmp_v1
 
-    def get_value_list(self, oid):
-        '''Reuturns a list of values at the object id, 'oid'.  If an error occurs
-        an empty list is returned.
-        '''
-
-        cmdGen = cmdgen.CommandGenerator()
-
-        errorIndication, errorStatus, errorIndex, varBindTable = cmdGen.bulkCmd(
-            cmdgen.CommunityData('public', mpModel=0),
-            cmdgen.UdpTransportTarget((self.host, 161)),
-            0, 1,
-            oid
-        )
+        # the SNMP engine and transport used for all requests
+        self.cmd_gen = cmdgen.CommandGenerator()
+        self.transport = cmdgen.UdpTransportTarget((self.host, 161), timeout=SNMP_TIMEOUT, retries=SNMP_RETRIES)
 
-        val_list = []
-
-        if errorIndication:
-            self.errors += 'Error reading value list at OID %s: %s\n' % (oid, errorIndication)
-        else:
-            if errorStatus:
-                err_msg = 'Error reading OID %s: %s at %s' % (
-                    oid,
-                    errorStatus.prettyPrint(),
-                    errorIndex and varBinds[int(errorIndex)-1] or '?'
-                    )
-                self.errors += err_msg + '\n'
-            else:
-                for varBindTableRow in varBindTable:
-                    for name, val in varBindTableRow:
-                        if val.prettyPrint().startswith('No more var'):
-                            break
-                        else:
-                            val_list.append(val)
-        return val_list
-
-    def getNodeData(self, node):
-        '''Returns a list of two-tuples (sensor name, value) for a particular
-        'node'.  'node' is a number from 2 to NODE_MAX.
+    def past_deadline(self):
+        '''Returns True, and records an error, if the deadline for reading the host
+        has passed.
         '''
-
-        # Get list of sensor names
-        rd_name_oid = '.1.3.6.1.4.1.8338.1.1.1.%d.8.1.1.2' % node
-        rd_name_list = [val.prettyPrint() for val in self.get_value_list(rd_name_oid)]
-
-        # Get associated values for each sensor
-        rd_val_oid = '.1.3.6.1.4.1.8338.1.1.1.%d.8.1.1.7' % node
-        rd_val_list = [int(val) for val in self.get_value_list(rd_val_oid)]
-
-        return list(zip(rd_name_list, rd_val_list))
-
-    def get1value(self, oid):
-        '''Gets a single value for an object id, 'oid' from the sensaphone unit.
+        if self.deadline and time.time() > self.end_time:
+            self.errors += 'Reading stopped at the deadline of %s seconds.\n' % self.deadline
+            return True
+        return False
+
+    def check_error(self, oids, errorIndication, errorStatus, errorIndex, varBinds):
+        '''Returns True if no error was reported for an SNMP request of the 'oids' list;
+        otherwise records the error and returns False.
+        '''
+        if errorIndication:
+            self.errors += 'Error reading OIDs %s: %s\n' % (', '.join(oids), errorIndication)
+            return False
+        if errorStatus:
+            self.errors += 'Error reading OIDs %s: %s at %s\n' % (
+                ', '.join(oids),
+                errorStatus.prettyPrint(),
+                errorIndex and varBinds[int(errorIndex)-1] or '?'
+                )
+            return False
+        return True
+
+    def get_values(self, oids):
+        '''Gets the values of the list of object ids 'oids' from the sensaphone unit with
+        one request.  Returns a list of the values, with None for OIDs having no value.
         Returns None if an error occurs.
         '''
-
-        cmdGen = cmdgen.CommandGenerator()
-
-        errorIndication, errorStatus, errorIndex, varBinds = cmdGen.getCmd(
+        errorIndication, errorStatus, errorIndex, varBinds = self.cmd_gen.getCmd(
             cmdgen.CommunityData('public'),
-            cmdgen.UdpTransportTarget((self.host, 161)),
-            oid
+            self.transport,
+            *oids
         )
-
-        value = None    # will be overridden unless an error occurs
-
-        # Check for errors and print out results
-        if errorIndication:
-            self.errors += 'Error reading OID %s: %s\n' % (oid, errorIndication)
-        else:
-            if errorStatus:
-                err_msg = 'Error reading OID %s: %s at %s' % (
-                    oid,
-                    errorStatus.prettyPrint(),
-                    errorIndex and varBinds[int(errorIndex)-1] or '?'
-                    )
-                self.errors += err_msg + '\n'
-            else:
-                for name, val in varBinds:
-                    value = val
-
-        return value
+        if not self.check_error(oids, errorIndication, errorStatus, errorIndex, varBinds):
+            return None
+        return [None if isinstance(val, (NoSuchInstance, NoSuchObject, EndOfMibView)) else val
+                for name, val in varBinds]
+
+    def get_value_lists(self, oids):
+        '''Returns a list of the lists of values in the tables at the object ids 'oids',
+        which are walked together.  If an error occurs, empty lists are returned.
+        '''
+        val_lists = [[] for oid in oids]
+        errorIndication, errorStatus, errorIndex, varBindTable = self.cmd_gen.bulkCmd(
+            cmdgen.CommunityData('public', mpModel=0 if self.snmp_v1 else 1),
+            self.transport,
+            0, max(self.MAX_BULK_VALUES // len(oids), 1),
+            *oids
+        )
+        if not self.check_error(oids, errorIndication, errorStatus, errorIndex, varBindTable):
+            return val_lists
+
+        for varBindTableRow in varBindTable:
+            for val_list, (name, val) in zip(val_lists, varBindTableRow):
+                # a table that ended before the others has end of MIB markers
+                if not isinstance(val, (EndOfMibView, NoSuchInstance, NoSuchObject)):
+                    val_list.append(val)
+        return val_lists
+
+    def find_nodes(self):
+        '''Returns a list of (node number, node name) of the nodes present, in node order.
+        '''
+        nodes = []
+        # Note: the range starts at 2 because there is nothing at zero, and 1 is the number for the Host unit, which
+        # only has sensors for the battery and sound.
+        all_nodes = list(range(2, SensaphoneReader.NODE_MAX + 1))
+        for i in range(0, len(all_nodes), self.NODES_PER_GET):
+            if self.past_deadline():
+                break
+            batch = all_nodes[i:i + self.NODES_PER_GET]
+            oids = []
+            for node in batch:
+                oids.append('.1.3.6.1.4.1.8338.1.1.1.%s.10.1.0' % node)    # IP address of the node
+                oids.append('.1.3.6.1.4.1.8338.1.1.1.%s.10.2.0' % node)    # plain text name of the node
+            values = self.get_values(oids)
+            if values is None:
+                break
+            for node, node_ip, node_name in zip(batch, values[::2], values[1::2]):
+                if node_ip is None or node_ip.prettyPrint() == '0.0.0.0':
+                    # no more nodes to read if we got a 0.0.0.0 IP address or
+                    # the node is missing.
+                    return nodes
+                nodes.append((node, node_name))
+        return nodes
+
+    def getNodeData(self, nodes):
+        '''Returns a list of lists of two-tuples (sensor name, value), one list for each
+        node in the list 'nodes'.  The nodes are numbers from 2 to NODE_MAX.
+        '''
+        oids = []
+        for node in nodes:
+            oids.append('.1.3.6.1.4.1.8338.1.1.1.%d.8.1.1.2' % node)    # sensor names
+            oids.append('.1.3.6.1.4.1.8338.1.1.1.%d.8.1.1.7' % node)    # sensor values
+        val_lists = self.get_value_lists(oids)
+
+        node_data = []
+        for rd_names, rd_vals in zip(val_lists[::2], val_lists[1::2]):
+            node_data.append(list(zip([val.prettyPrint() for val in rd_names],
+                                      [int(val) for val in rd_vals])))
+        return node_data
 
     def read(self):
         '''Reads in the values from all nodes on a sensaphone with the given host ip.
@@ -115,46 +171,63 @@ class SensaphoneReader():
         # Used to track errors that occur during the process
         self.errors = ''
 
-        # Note: the range starts at 2 because there is nothing at zero, and 1 is the number for the Host unit, which
-        # only has sensors for the battery and sound.
-        for node in range(2, SensaphoneReader.NODE_MAX + 1):
-
-            node_ip_oid = '.1.3.6.1.4.1.8338.1.1.1.%s.10.1.0' % node
-            node_ip = self.get1value(node_ip_oid)
-            if node_ip == '0.0.0.0' or node_ip is None:
-                # no more nodes to read if we got a 0.0.0.0 IP address or
-                # an Error occurred.
-                # we're all done.
-                break
+        if self.deadline:
+            self.end_time = time.time() + self.deadline
 
-            # Get the plain text name of this node
-            node_name_oid = '.1.3.6.1.4.1.8338.1.1.1.%s.10.2.0' % node
-            node_name = self.get1value(node_name_oid)
-
-            ts = int(time.time())     # use the same timestamp for all the readings from this node
-            name_val_tuples = self.getNodeData(node)
-            for rd_name, rd_val in name_val_tuples:
-                # create a unique Sensor ID for this sensor
-                sensor_id = '%s_%s_%s' % (self.site_id,
-                                          node_name,
-                                          rd_name)
-                # replace spaces with underscore in the Sensor ID
-                sensor_id = sensor_id.replace(' ', '_')
-
-                readings.append((ts, sensor_id, rd_val))
+        nodes = self.find_nodes()
+        for i in range(0, len(nodes), self.NODES_PER_WALK):
+            if self.past_deadline():
+                break
+            batch = nodes[i:i + self.NODES_PER_WALK]
+            ts = int(time.time())     # use the same timestamp for all the readings from these nodes
+            node_data = self.getNodeData([node for node, node_name in batch])
+            for (node, node_name), name_val_tuples in zip(batch, node_data):
+                for rd_name, rd_val in name_val_tuples:
+                    # create a unique Sensor ID for this sensor
+                    sensor_id = '%s_%s_%s' % (self.site_id,
+                                              node_name,
+                                              rd_name)
+                    # replace spaces with underscore in the Sensor ID
+                    sensor_id = sensor_id.replace(' ', '_')
+
+                    readings.append((ts, sensor_id, rd_val))
 
         return readings, self.errors
 
 
-def run(host='', site_id='', **kwargs):
-    """This function is called by the Periodic Script controller. The Required
+def run(host='', site_id='', hosts=[], deadline=60, snmp_v1=False, **kwargs):
+    """This function is called by the Periodic Script controller. The
     parameters are:
         'site_id': The string to prepend to each Sensaphone sensor name to create
             a BMON Sensor ID.
         'host': The IP address or host name of the Sensaphone.
+        'hosts': (optional) A list of [host, site_id] pairs, to read several Sensaphones
+            at the same time, in addition to or instead of 'host' and 'site_id'.
+        'deadline': (optional, defaults to 60) The number of seconds allowed for
+            reading each Sensaphone.
+        'snmp_v1': (optional, defaults to False) Set to True if the Sensaphones do not
+            answer SNMPv2c GETBULK requests.
     """
-    reader = SensaphoneReader(host, site_id)
-    readings, errors = reader.read()
+    host_list = ([[host, site_id]] if host else []) + list(hosts)
+
+    def read_host(host_site):
+        try:
+            reader = SensaphoneReader(host_site[0], host_site[1], deadline, snmp_v1)
+            readings, errors = reader.read()
+        except:
+            readings, errors = [], traceback.format_exc()
+        if errors and len(host_list) > 1:
+            errors = ''.join('%s: %s\n' % (host_site[0], err) for err in errors.splitlines())
+        return readings, errors
+
+    readings = []
+    errors = ''
+    if host_list:
+        with ThreadPoolExecutor(max_workers=HOST_WORKERS) as pool:
+            for host_readings, host_errors in pool.map(read_host, host_list):
+                readings += host_readings
+                errors += host_errors
+
     results = {'readings': readings,
                'script_errors': errors}
 
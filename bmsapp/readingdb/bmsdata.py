@@ -6,9 +6,11 @@ import sys
 import os.path
 import time
 import logging
+import threading
 import shutil
-import subprocess
+import gzip
 import glob
+import itertools
 import calendar
 import pytz
 from dateutil import parser
@@ -22,142 +24,359 @@ _logger = logging.getLogger('bms.' + __name__)
 DEFAULT_DB = os.path.join(os.path.dirname(__file__), 'data', 'bms_data.sqlite')
 
 
+# The maximum number of SELECT statements combined into one compound SELECT.  The
+# SQLite limit defaults to 500.
+MAX_COMPOUND_SELECT = 400
+
+# The number of database pages copied in each step of a backup.
+BACKUP_PAGES_PER_STEP = 4096
+
+# The maximum number of parameters used in one SQL statement.  Older SQLite versions
+# limit the number to 999.
+MAX_SQL_PARAMS = 900
+
+# The number of seconds in each rollup period.  Rollup periods start on the hour, UTC.
+ROLLUP_SECS = 3600
+
+# SQL to create the tables that do not hold sensor readings, keyed on table name.
+# These tables are created when the database is opened, if they are not present.
+SPECIAL_TABLE_SQL = {
+
+    # Stores last raw reading for cumulative counter sensors.  Make the value field a 
+    # real instead of integer in case this table is needed for non counter
+    # sensors in the future.
+    '_last_raw': 'CREATE TABLE IF NOT EXISTS [_last_raw] (id varchar(50) primary key, ts integer, val real)',
+
+    # Hourly statistics for each sensor: the ts is the start of the hour.  'ts_sum' is
+    # the sum of the reading timestamps, used to find the average timestamp.  The IDs are
+    # case insensitive like table names; see upgrade_rollup_tables() for databases whose
+    # rollup tables were created with case sensitive IDs.
+    '_rollup_hourly': '''CREATE TABLE IF NOT EXISTS [_rollup_hourly] (id varchar(50) collate nocase, ts integer,
+                         count integer, sum real, ts_sum integer, min real, max real,
+                         first real, last real, primary key (id, ts)) WITHOUT ROWID''',
+
+    # Sensors whose rollups cover all of their readings.  Sensors with readings from
+    # before the rollup tables were added are not present until their rollups are rebuilt.
+    '_rollup_built': 'CREATE TABLE IF NOT EXISTS [_rollup_built] (id varchar(50) primary key collate nocase)',
+
+    # The newest reading for each sensor, so the current value of a sensor can be found
+    # without a query of its reading table.  The IDs are case insensitive like table names.
+    # Sensors with readings from before the table was added are filled in by
+    # fill_summaries(); until then, their reading tables are queried.
+    '_latest': 'CREATE TABLE IF NOT EXISTS [_latest] (id varchar(50) primary key collate nocase, ts integer, val real)',
+
+    # A catalog of the sensors in the database with statistics about their readings, kept
+    # up to date as readings are stored.  rescan_sensor_stats() recalculates it, and
+    # fill_summaries() adds the sensors with readings from before the table was added.
+    '_sensor_stats': '''CREATE TABLE IF NOT EXISTS [_sensor_stats] (id varchar(50) primary key collate nocase,
+                        first_ts integer, last_ts integer, count integer, min real, max real)''',
+
+    # For each calculated reading, the last timestamp of each input sensor that has been
+    # processed, so that a calculation can resume where it left off.
+    '_calc_watermark': '''CREATE TABLE IF NOT EXISTS [_calc_watermark] (calc_id varchar(50), input_id varchar(50),
+                          ts integer, primary key (calc_id, input_id))''',
+}
+
+# Names (lower case) of tables in the database that do not hold sensor readings.
+SPECIAL_TABLES = {tbl.lower() for tbl in SPECIAL_TABLE_SQL} | {'_junk'}
+
+
+class _TableCatalog:
+    """The set of table names in one reading database, shared by all of the BMSdata
+    objects in the process.  'schema_version' is the SQLite schema version that the
+    table names were read at; the names are reloaded when the version changes.
+    """
+
+    def __init__(self):
+        self.schema_version = None
+        self.tables = set()
+        self.tables_lower = {}    # lower case table name: table name
+
+# Table catalogs keyed on database file name, and a lock to protect them.
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+# Open database connections, one per thread and database file.
+_thread_conns = threading.local()
+
+def _get_connection(fname):
+    """Returns a connection to the SQLite database 'fname' for the current thread,
+    opening one if there is not one already.  Connections are not shared with
+    processes forked from this one.
+    """
+    if getattr(_thread_conns, 'pid', None) != os.getpid():
+        _thread_conns.pid = os.getpid()
+        _thread_conns.conns = {}
+    conn = _thread_conns.conns.get(fname)
+    if conn is None:
+        conn = sqlite3.connect(fname)
+
+        # Write-ahead logging lets readers, such as a backup, proceed while readings are
+        # being stored.  The setting is saved in the database file.
+        conn.execute('PRAGMA journal_mode=WAL')
+
+        # use the SQLite Row row_factory for all Select queries
+        conn.row_factory = sqlite3.Row
+        _thread_conns.conns[fname] = conn
+
+    return conn
+
+
 class BMSdata:
 
     def __init__(self, fname=DEFAULT_DB):
         """Creates the database object.
         fname: full path to SQLite database file. If the file is not present, 
             it will be created.
+        The database connection is reused by other BMSdata objects created in
+        the same thread.
         """
 
         self.db_fname = fname   # save database filename.
 
-        self.conn = sqlite3.connect(fname)
+        # Last raw readings to be stored with the next readings inserted; see defer_last_raw().
+        self.pending_last_raw = {}
 
-        # use the SQLite Row row_factory for all Select queries
-        self.conn.row_factory = sqlite3.Row
+        self.conn = _get_connection(fname)
 
         # now create a cursor object
         self.cursor = self.conn.cursor()
         
-        # make a set list of all of the tables (sensor IDs + special tables
+        # get the set of all of the tables (sensor IDs + special tables
         # with names starting with underbar) in the database, so
         # that it is fast to determine whether a sensor exists in the current
         # database.
-        recs = self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
-        self.sensor_ids = set([rec['name'] for rec in recs])  # plus special tables
-        
-        # Check to see if the table that stores last raw reading for cumulative
-        # counter sensors exists.  If not, make it.  Make the value field a 
-        # real instead of integer in case this table is needed for non counter
-        # sensors in the future.
-        if '_last_raw' not in self.sensor_ids:
-            self.cursor.execute("CREATE TABLE [_last_raw] (id varchar(50) primary key, ts integer, val real)")
-            self.conn.commit()
-            self.sensor_ids.add('_last_raw')
-
-        # because SQLite has case insensitive table names, make a sensor ID set with lower-case names
-        self.sensor_ids_lower = {tbl.lower() for tbl in self.sensor_ids}
+        self._load_table_names()
+
+        # Check to see if the special tables, such as the table that stores the last raw
+        # reading for cumulative counter sensors, exist.  If not, make them.  The summary
+        # tables are not filled in here for the sensors already in the database, as that
+        # can take minutes; see fill_summaries().
+        for table_name, table_sql in SPECIAL_TABLE_SQL.items():
+            if table_name not in self.sensor_ids:
+                self.cursor.execute(table_sql)
+                self.conn.commit()
+                self._add_table_name(table_name)
 
     def __del__(self):
-        """Used to ensure that database is closed when this object is destroyed.
+        """Used to ensure that the database cursor is closed when this object is destroyed.
         """
-        self.close()
+        try:
+            self.cursor.close()
+        except sqlite3.ProgrammingError:
+            # object was destroyed in a different thread than it was created in.
+            pass
         
     def close(self):
-        """Closes this database object.  This is called in the destructor for this object.
+        """Closes this database object, discarding any uncommitted changes.  The
+        underlying connection stays open for reuse by other BMSdata objects in this
+        thread.
+        """
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        self.cursor.close()
+
+    def _load_table_names(self):
+        """Sets the sets of table names for this object from the shared table catalog.
+        The catalog is only read from the database when the schema has changed since
+        it was last read by this process.
+        """
+        schema_version = self.cursor.execute('PRAGMA schema_version').fetchone()[0]
+        with _catalog_lock:
+            catalog = _catalogs.setdefault(self.db_fname, _TableCatalog())
+            if catalog.schema_version != schema_version:
+                recs = self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+                catalog.tables = set([rec['name'] for rec in recs])  # plus special tables
+
+                # because SQLite has case insensitive table names, index the names by their
+                # lower-case versions
+                catalog.tables_lower = {tbl.lower(): tbl for tbl in catalog.tables}
+                catalog.schema_version = schema_version
+            self._catalog = catalog
+
+        # These are shared with other BMSdata objects, so they are replaced, not
+        # modified, when a table is added.
+        self.sensor_ids = catalog.tables
+        self.sensor_ids_lower = catalog.tables_lower
+        self.schema_version = schema_version
+
+    def _tables_changed(self):
+        """Returns True if tables have been added to or dropped from the database, by
+        this or another connection, since the table names of this object were loaded.
         """
-        self.conn.close()
+        return self.cursor.execute('PRAGMA schema_version').fetchone()[0] != self.schema_version
 
     def sensor_id_exists(self, sensor_id):
         """Returns True if 'sensor_id' exists in the reading database, False
         otherwise.  SQLite has case insensitive table names, no need to check
-        lower case version of the ID name.
+        lower case version of the ID name.  If the sensor is not in the table names
+        of this object, the names are reloaded if the database schema has changed,
+        as another thread or process may have created the sensor's table.
+        """
+        id_lower = sensor_id.lower()
+        if id_lower in SPECIAL_TABLES:
+            return False
+        if id_lower not in self.sensor_ids_lower and self._tables_changed():
+            self._load_table_names()
+        return id_lower in self.sensor_ids_lower
+
+    def _table_name(self, sensor_id):
+        """Returns the name of the reading table of 'sensor_id', which can differ from
+        'sensor_id' in case.  The summary tables use this name, so the IDs stored in them
+        do not change when readings are posted using a different case.
+        """
+        return self.sensor_ids_lower.get(sensor_id.lower(), sensor_id)
+
+    def _add_table_name(self, table_name):
+        """Adds 'table_name' to the sets of table names for this object and causes
+        the shared table catalog to be reloaded by the next BMSdata object created.
         """
-        return (sensor_id.lower() in self.sensor_ids_lower - {'_last_raw', '_junk'})
+        self.sensor_ids = self.sensor_ids | {table_name}
+        self.sensor_ids_lower = dict(self.sensor_ids_lower)
+        self.sensor_ids_lower[table_name.lower()] = table_name
+        with _catalog_lock:
+            self._catalog.schema_version = None
 
     def add_sensor_table(self, sensor_id):
         """Adds a table to hold readings from a sensor with the id 'sensor_id'.  Also
         adds the id to the set that holds sensor ids.
         """
-        self.cursor.execute("CREATE TABLE [%s] (ts integer primary key, val real)" % sensor_id)
+        self._create_sensor_table(sensor_id)
         self.conn.commit()
-        self.sensor_ids.add(sensor_id)
-        self.sensor_ids_lower.add(sensor_id.lower())
+
+    def _create_sensor_table(self, sensor_id):
+        """Creates the reading table for 'sensor_id' without committing, so that the
+        table creation can be part of a larger transaction.  Also adds the id to the
+        set that holds sensor ids.
+        """
+        self.cursor.execute("CREATE TABLE [%s] (ts integer primary key, val real)" % sensor_id)
+        self._add_table_name(sensor_id)
+
+        # a new sensor's rollups are complete, as they are updated with each insert.
+        self.cursor.execute('INSERT OR IGNORE INTO [_rollup_built] (id) VALUES (?)', (self._table_name(sensor_id),))
+
+        # add the sensor to the catalog
+        self.cursor.execute('INSERT OR REPLACE INTO [_sensor_stats] (id, count) VALUES (?, 0)', (sensor_id,))
 
     def insert_reading(self, ts, id, val):
         """Inserts a record or records into the database.  'ts', 'id', and
         'val' can either be lists or single values.  If 'ts' is None, it is
         replaced with the current time.
         If val is None, the record is not stored in the database and it is recorded as an exception.
+        The records are stored with the bulk method, insert_readings_bulk().
         """
         try:
             recs = list(zip(ts, id, val))
         except:
             # they were single values, not lists
             recs = [(ts, id, val)]
-        
-        rejected_count = 0
-        success_count = 0
+
+        counts = self.insert_readings_bulk(recs)
+        success_count = sum(ct[0] for ct in counts.values())
+        rejected_count = sum(ct[1] for ct in counts.values())
+
+        msg = '%s readings stored successfully, %s rejected.' % (success_count, rejected_count)
+        return msg
+
+    def insert_readings_bulk(self, recs):
+        """Inserts a list of (ts, id, val) reading tuples into the database.  The
+        readings are grouped by sensor and each sensor's readings are written with one
+        'executemany' statement.  A reading already present (same ID and ts) is replaced
+        with the new value.  All the sensors are written in one transaction; if a sensor's
+        readings cannot be written, none of them are stored and the other sensors' readings
+        are still stored.  Readings with a None or non-finite value are skipped and not counted.  If a
+        reading's ts is None, it is replaced with the current time.
+        Returns a dictionary keyed on sensor ID; each value is a two-element list of
+        [count of readings stored, count of readings rejected].
+        """
+        # group the readings by sensor, converting to the types stored in the database.
+        by_sensor = {}
+        counts = {}
+        now = time.time()
         for one_ts, one_id, one_val in recs:
 
             # If value is None, don't insert
             if one_val is None:
                 continue
 
-            # Sometimes infinite values or NaNs result from calculations.  Do not insert
-            # into database.
-            if not np.isfinite(one_val):
-                continue
-
             # make sure sensor ID is a string
             one_id = str(one_id)
+            sensor_counts = counts.setdefault(one_id, [0, 0])
+
+            try:
+                # convert value to a float. SQLite gives error if you insert
+                # an integer.
+                one_val = float(one_val)
 
-            # convert value to a float. SQLite gives error if you insert
-            # an integer.
-            one_val = float(one_val)
+                # Sometimes infinite values or NaNs result from calculations.  Do not insert
+                # into database.
+                if not np.isfinite(one_val):
+                    continue
 
-            if one_ts is None:
-                # substitute current time
-                one_ts = time.time()
+                # convert time to integer, substituting current time if not present.
+                one_ts = int(now if one_ts is None else one_ts)
 
-            # convert time to integer
-            one_ts = int(one_ts)
+            except:
+                sensor_counts[1] += 1
+                _logger.warning('Error storing reading %s, %s, %s: %s' % (one_ts, one_id, one_val, sys.exc_info()[1]))
+                continue
 
+            by_sensor.setdefault(one_id, []).append((one_ts, one_val))
+
+        # Take the write lock before storing anything, so that a busy database raises an
+        # error for the whole batch instead of rejecting the readings of each sensor.
+        if by_sensor and not self.conn.in_transaction:
+            self.cursor.execute('BEGIN IMMEDIATE')
+
+        for one_id, sensor_recs in by_sensor.items():
+            # A savepoint lets the sensor's readings be undone if they are not all
+            # written, so the rejected count is accurate.
+            self.cursor.execute('SAVEPOINT sensor_readings')
             try:
                 # Check to see if sensor table exists.  If not, create it.
                 if not self.sensor_id_exists(one_id):
-                    self.add_sensor_table(one_id)
-                if one_val is not None:    # don't store None values.
-                    self.cursor.execute("INSERT INTO [%s] (ts, val) VALUES (?, ?)" % one_id, (one_ts, one_val))
-                    success_count += 1
-                else:
-                    # No need for logger warning because one was generated earlier when
-                    # the None value was created.
-                    rejected_count += 1
-            except sqlite3.IntegrityError:
-                # this record already exists (same ID and ts).  Replace the old value.
-                try:
-                    self.cursor.execute('UPDATE [%s] SET val=? WHERE ts=?' % one_id, (one_val, one_ts))
-                    # This occurs a lot with, for example, the Sunny Boy portal scraper.  Make is
-                    # a debug message so that it doesn't overwhelm the log file.
-                    _logger.debug('Reading already in DB, updated to: ts=%s, id=%s, val=%s' % (one_ts, one_id, one_val))
-                    success_count += 1
-                except:
-                    rejected_count += 1
-                    _logger.exception('Problem updating reading already in DB: ts=%s, id=%s, val=%s' % (one_ts, one_id, one_val))
+                    self._create_sensor_table(one_id)
+                stats = self._stats_after_insert(one_id, sensor_recs)
+                # Replaces any reading already in the DB with the same ts.  This occurs
+                # a lot with, for example, the Sunny Boy portal scraper.
+                self.cursor.executemany('INSERT OR REPLACE INTO [%s] (ts, val) VALUES (?, ?)' % one_id, sensor_recs)
+                if one_id in self.pending_last_raw:
+                    self._store_last_raw(one_id, *self.pending_last_raw.pop(one_id))
+                self.cursor.execute('RELEASE sensor_readings')
+                counts[one_id][0] += len(sensor_recs)
+            except:
+                self.cursor.execute('ROLLBACK TO sensor_readings')
+                self.cursor.execute('RELEASE sensor_readings')
+                # the readings will be transformed again if they are stored again.
+                self.pending_last_raw.pop(one_id, None)
+                # a table created for the sensor was removed by the rollback.
+                self._load_table_names()
+                counts[one_id][1] += len(sensor_recs)
+                _logger.warning('Error storing %s readings for %s: %s' % (len(sensor_recs), one_id, sys.exc_info()[1]))
+                continue
 
+            try:
+                if stats:
+                    self.cursor.execute('INSERT OR REPLACE INTO [_sensor_stats] VALUES (?, ?, ?, ?, ?, ?)', (self._table_name(one_id),) + stats)
+                else:
+                    self._rescan_stats(one_id)
+                self._update_latest(one_id)
+                self._update_rollups(one_id, [rec[0] for rec in sensor_recs])
             except:
-                rejected_count += 1
-                _logger.warn('Error storing reading %s, %s, %s: %s' % (one_ts, one_id, one_val, sys.exc_info()[1]))
+                _logger.exception('Error updating the summary tables for %s' % one_id)
+
+        # the last raw readings of sensors whose readings were all rejected by the transform
+        for one_id, (one_ts, one_val) in self.pending_last_raw.items():
+            self._store_last_raw(one_id, one_ts, one_val)
+        self.pending_last_raw = {}
 
-        # Commits take a lot of time, but Sqlite does not allow an open database reference to be
-        # shared across threads.  The web server uses multiple threads to handle requests.
+        # Commits take a lot of time, so there is only one per batch of readings.
+        # Sqlite does not allow an open database reference to be shared across threads,
+        # and the web server uses multiple threads to handle requests, so the commit
+        # cannot be deferred past this call.
         self.conn.commit()
-        
-        msg = '%s readings stored successfully, %s rejected.' % (success_count, rejected_count)
-        return msg
-        
+
+        return counts
 
     def last_read(self, sensor_id, read_count=1):
         """Returns the last reading for a particular sensor,
@@ -172,13 +391,224 @@ class BMSdata:
         if not self.sensor_id_exists(sensor_id):
             return None
 
-        self.cursor.execute('SELECT * FROM [%s] ORDER BY ts DESC LIMIT %s' % (sensor_id, read_count))
         if read_count==1:
+            self.cursor.execute('SELECT ts, val FROM [_latest] WHERE id = ?', (sensor_id,))
             row = self.cursor.fetchone()
+            if row is None:
+                # the sensor has no readings, or is not yet in the '_latest' table.
+                self.cursor.execute('SELECT ts, val FROM [%s] ORDER BY ts DESC LIMIT 1' % sensor_id)
+                row = self.cursor.fetchone()
             return dict(row) if row else None
         else:
+            self.cursor.execute('SELECT * FROM [%s] ORDER BY ts DESC LIMIT %s' % (sensor_id, read_count))
             return [dict(row) for row in self.cursor.fetchall()]
 
+    def last_reads(self, sensor_ids=None):
+        """Returns the last reading for each of the sensors in the 'sensor_ids' list, or for
+        all sensors in the database if 'sensor_ids' is not provided.  The return value is a
+        dictionary keyed on sensor ID; the values are row dictionaries with 'ts' and 'val'
+        keys.  Sensors without readings are not included in the dictionary.
+        """
+        reads = self._rows_by_id('_latest', ('ts', 'val'), sensor_ids)
+
+        # Sensors missing from the '_latest' table have no readings, or have not yet been
+        # added by fill_summaries(); read them from their reading tables.
+        if sensor_ids is None:
+            sensor_ids = self._table_sensor_ids()
+        found = {sensor_id.lower() for sensor_id in reads}
+        missing = [str(sensor_id) for sensor_id in sensor_ids 
+                   if str(sensor_id).lower() not in found and self.sensor_id_exists(str(sensor_id))]
+        reads.update({sensor_id: recs[0] for sensor_id, recs in self._newest_reads(missing, 1).items()})
+
+        return reads
+
+    def recent_reads(self, read_counts):
+        """Returns the most recent readings of several sensors.  'read_counts' is a dictionary
+        keyed on sensor ID giving the number of readings wanted for each sensor.  The return
+        value is a dictionary keyed on sensor ID; the values are lists of row dictionaries
+        with 'ts' and 'val' keys, newest first.  Sensors without readings are not included.
+        The readings are read with few queries, however many sensors are requested.
+        """
+        recent = {sensor_id: [rec] for sensor_id, rec in 
+                  self.last_reads([sensor_id for sensor_id, ct in read_counts.items() if ct <= 1]).items()}
+
+        multi_ids = [str(sensor_id) for sensor_id, ct in read_counts.items() if ct > 1 and self.sensor_id_exists(str(sensor_id))]
+        recent.update(self._newest_reads(multi_ids, read_counts))
+
+        return recent
+
+    def _newest_reads(self, sensor_ids, read_counts):
+        """Returns the newest readings of the sensors in the 'sensor_ids' list, which must
+        exist, read from their reading tables.  'read_counts' is the number of readings
+        wanted for every sensor, or a dictionary of the number wanted keyed on sensor ID.
+        The return value is like that of recent_reads().
+        """
+        # Read the sensors with compound queries; each row is tagged with the position of
+        # its sensor in the list.
+        selects = ['SELECT %s, ts, val FROM (SELECT ts, val FROM [%s] ORDER BY ts DESC LIMIT %s)' % 
+                   (ix, sensor_id, int(read_counts[sensor_id] if isinstance(read_counts, dict) else read_counts)) 
+                   for ix, sensor_id in enumerate(sensor_ids)]
+        recent = {}
+        cursor = self.conn.cursor()
+        cursor.row_factory = None     # plain tuples are much faster than Row objects
+        for i in range(0, len(selects), MAX_COMPOUND_SELECT):
+            for ix, ts, val in cursor.execute(' UNION ALL '.join(selects[i:i + MAX_COMPOUND_SELECT])):
+                recent.setdefault(sensor_ids[ix], []).append({'ts': ts, 'val': val})
+        cursor.close()
+        for recs in recent.values():
+            recs.sort(key=lambda rec: rec['ts'], reverse=True)
+
+        return recent
+
+    def sensor_stats(self, sensor_ids=None):
+        """Returns statistics about the readings of each sensor in the 'sensor_ids' list,
+        or of all sensors in the database if 'sensor_ids' is not provided.  The statistics
+        come from the '_sensor_stats' catalog, so no reading table is scanned.  The return
+        value is a dictionary keyed on sensor ID; the values are dictionaries with 
+        'first_ts', 'last_ts', 'count', 'min' and 'max' keys.  Sensors not in the 
+        database are not included in the dictionary.
+        """
+        return self._rows_by_id('_sensor_stats', ('first_ts', 'last_ts', 'count', 'min', 'max'), sensor_ids)
+
+    def _rows_by_id(self, table_name, columns, sensor_ids=None):
+        """Returns the rows of the special table 'table_name' for the sensors in the 
+        'sensor_ids' list, or for all sensors if 'sensor_ids' is None.  The return value
+        is a dictionary keyed on sensor ID; the values are dictionaries holding the
+        'columns' of the row.
+        """
+        sql = 'SELECT id, %s FROM [%s]' % (', '.join(columns), table_name)
+        if sensor_ids is None:
+            self.cursor.execute(sql)
+            return {row['id']: {col: row[col] for col in columns} for row in self.cursor.fetchall()}
+
+        sensor_ids = [str(sensor_id) for sensor_id in sensor_ids]
+        rows = {}    # keyed on lower case sensor ID
+        for i in range(0, len(sensor_ids), MAX_SQL_PARAMS):
+            chunk = sensor_ids[i:i + MAX_SQL_PARAMS]
+            self.cursor.execute(sql + ' WHERE id IN (%s)' % ', '.join('?' * len(chunk)), chunk)
+            for row in self.cursor.fetchall():
+                rows[row['id'].lower()] = {col: row[col] for col in columns}
+
+        return {sensor_id: rows[sensor_id.lower()] for sensor_id in sensor_ids if sensor_id.lower() in rows}
+
+    def _stats_after_insert(self, sensor_id, recs):
+        """Returns the (first_ts, last_ts, count, min, max) statistics that 'sensor_id' will
+        have after the list of (ts, val) readings 'recs' is stored, or None if the statistics
+        must be rescanned after storing the readings.  Call before storing the readings, so
+        that readings that will be replaced are accounted for.
+        """
+        self.cursor.execute('SELECT first_ts, last_ts, count, min, max FROM [_sensor_stats] WHERE id = ?', (sensor_id,))
+        row = self.cursor.fetchone()
+        if row is None or row['count'] is None:
+            return None
+        first_ts, last_ts, count, min_val, max_val = tuple(row)
+
+        new_vals = dict(recs)    # the last reading with a timestamp is the one stored
+        new_first, new_last = min(new_vals), max(new_vals)
+
+        # find the stored readings that will be replaced.  Usually, the new readings are
+        # all after the last stored reading.
+        replaced = []
+        if count and new_first <= last_ts:
+            self.cursor.execute('SELECT ts, val FROM [%s] WHERE ts >= ? AND ts <= ?' % sensor_id, (new_first, new_last))
+            replaced = [row['val'] for row in self.cursor.fetchall() if row['ts'] in new_vals]
+            # if the minimum or maximum value could be replaced, it is not known anymore.
+            if min_val in replaced or max_val in replaced:
+                return None
+
+        if count:
+            return (min(first_ts, new_first), max(last_ts, new_last), count + len(new_vals) - len(replaced),
+                    min(min_val, min(new_vals.values())), max(max_val, max(new_vals.values())))
+        else:
+            return (new_first, new_last, len(new_vals), min(new_vals.values()), max(new_vals.values()))
+
+    def replace_readings(self, sensor_id, start_ts, end_ts, ts, vals):
+        """Replaces the readings of 'sensor_id' having timestamps greater than 'start_ts'
+        and less than or equal to 'end_ts' with the readings in the 'ts' and 'vals' lists, 
+        which must fall in that range.  This is done in one transaction, and the summary 
+        tables are updated.
+        """
+        sensor_id = str(sensor_id)   # make sure ID is a string
+        start_ts, end_ts = int(start_ts), int(end_ts)
+
+        if not self.conn.in_transaction:
+            self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if not self.sensor_id_exists(sensor_id):
+                self._create_sensor_table(sensor_id)
+            self.cursor.execute('DELETE FROM [%s] WHERE ts > ? AND ts <= ?' % sensor_id, (start_ts, end_ts))
+            self.cursor.executemany('INSERT OR REPLACE INTO [%s] (ts, val) VALUES (?, ?)' % sensor_id,
+                                    [(int(t), float(v)) for t, v in zip(ts, vals) if np.isfinite(v)])
+            self._rescan_stats(sensor_id)
+            self._update_latest(sensor_id)
+
+            # rebuild the rollups of each hour in the range, as some may no longer have readings.
+            start_hr = (start_ts + 1) // ROLLUP_SECS * ROLLUP_SECS
+            end_hr = end_ts // ROLLUP_SECS * ROLLUP_SECS
+            self.cursor.execute('DELETE FROM [_rollup_hourly] WHERE id = ? AND ts >= ? AND ts <= ?',
+                                (self._table_name(sensor_id), start_hr, end_hr))
+            self._update_rollups(sensor_id, np.arange(start_hr, end_hr + 1, ROLLUP_SECS))
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    def _rescan_stats(self, sensor_id):
+        """Recalculates the '_sensor_stats' row for 'sensor_id' from its readings.  Does not
+        commit.
+        """
+        self.cursor.execute('INSERT OR REPLACE INTO [_sensor_stats] SELECT ?, MIN(ts), MAX(ts), COUNT(*), MIN(val), MAX(val) FROM [%s]' % sensor_id,
+                            (self._table_name(sensor_id),))
+
+    def rescan_sensor_stats(self, sensor_ids=None):
+        """Recalculates the '_sensor_stats' catalog and the '_latest' table from the reading
+        tables, for the sensors in the 'sensor_ids' list, or for all sensors if 'sensor_ids'
+        is not provided.  Sensors that are no longer in the database are removed from the
+        catalog.  Each sensor is committed separately, so other writers are not locked out
+        for long.
+        """
+        if sensor_ids is None:
+            sensor_ids = self._table_sensor_ids()
+            self.cursor.execute('SELECT id FROM [_sensor_stats]')
+            gone_ids = [row['id'] for row in self.cursor.fetchall() if not self.sensor_id_exists(row['id'])]
+            self.cursor.executemany('DELETE FROM [_sensor_stats] WHERE id = ?', [(gone_id,) for gone_id in gone_ids])
+            self.conn.commit()
+        for sensor_id in sensor_ids:
+            if self.sensor_id_exists(str(sensor_id)):
+                self._rescan_stats(str(sensor_id))
+                self._update_latest(str(sensor_id))
+                self.conn.commit()
+
+    def summaries_missing(self):
+        """Returns a list of the Sensor IDs that have a reading table but are not in the
+        '_sensor_stats' catalog, such as sensors with readings from before the catalog was
+        added.  Their '_sensor_stats' and '_latest' rows are added by fill_summaries().
+        """
+        self.cursor.execute('SELECT id FROM [_sensor_stats]')
+        cataloged = {row['id'].lower() for row in self.cursor.fetchall()}
+        return [sensor_id for sensor_id in self._table_sensor_ids() if sensor_id.lower() not in cataloged]
+
+    def fill_summaries(self, max_secs=None):
+        """Adds the '_sensor_stats' and '_latest' rows of the sensors returned by
+        summaries_missing(), committing each sensor separately.  If 'max_secs' is given,
+        no sensor is started after that many seconds; the rest are filled by a later call.
+        Returns the number of sensors filled.
+        """
+        start = time.time()
+        filled = 0
+        for sensor_id in self.summaries_missing():
+            if max_secs is not None and time.time() - start > max_secs:
+                break
+            self.rescan_sensor_stats([sensor_id])
+            filled += 1
+        return filled
+
+    def _update_latest(self, sensor_id):
+        """Stores the newest reading of 'sensor_id' in the '_latest' table.  Does not commit.
+        """
+        self.cursor.execute('INSERT OR REPLACE INTO [_latest] (id, ts, val) SELECT ?, ts, val FROM [%s] ORDER BY ts DESC LIMIT 1' % sensor_id,
+                            (self._table_name(sensor_id),))
+
     def rowsForOneID(self, sensor_id, start_tm=None, end_tm=None):
         """Returns a list of dictionaries, each dictionary having a 'ts' and 'val' key.  The
         rows are for a particular sensor ID, and can be further limited by a time range.
@@ -201,6 +631,35 @@ class BMSdata:
         self.cursor.execute(sql)
         return [dict(r) for r in self.cursor.fetchall()]
 
+    def arraysForOneID(self, sensor_id, start_tm=None, end_tm=None):
+        """Returns the readings for a particular sensor ID as a two-tuple of NumPy arrays:
+        (int64 array of timestamps, float64 array of values).  The readings can be further
+        limited by a time range. 'start_tm' and 'end_tm' are UNIX timestamps.  If either
+        are not provided, no limit is imposed.  The readings are returned in timestamp order.
+        The arrays are filled directly from the database cursor, so this is much faster
+        than rowsForOneID() for large numbers of readings.
+        """
+        sensor_id = str(sensor_id)   # make sure ID is a string
+
+        # address case where sensor id does not exist
+        if not self.sensor_id_exists(sensor_id):
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        sql = 'SELECT ts, val FROM [%s] WHERE 1' % sensor_id
+        if start_tm is not None:
+            sql += ' AND ts>=%s' % int(start_tm)
+        if end_tm is not None:
+            sql += ' AND ts<=%s' % int(end_tm)
+        sql += ' ORDER BY ts'
+
+        cursor = self.conn.cursor()
+        cursor.row_factory = None     # plain tuples are much faster than Row objects
+        cursor.execute(sql)
+        flat = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.float64)
+        cursor.close()
+        flat = flat.reshape(-1, 2)
+        return flat[:, 0].astype(np.int64), flat[:, 1].copy()
+
     def dataframeForOneID(self, sensor_id, start_ts=None, end_ts=None, tz=None):
         """Returns a pandas dataframe having a 'ts' and 'val' columns.  The
         rows are for a particular sensor ID, and can be further limited by a time range.
@@ -247,18 +706,38 @@ class BMSdata:
         """
         # make a list of column names
         col_names = column_names if column_names else sensor_id_list
+        col_names = [str(col_name) for col_name in col_names]
 
-        # loop through the requested sensors, creating a dataframe and merging into the
-        # final frame.
-        df_final = None
-        for sensor_id, col_name in zip(sensor_id_list, col_names):
-            df = self.dataframeForOneID(sensor_id, start_ts, end_ts)
-            df.drop('ts', axis=1, inplace=True)    # get rid of ts column
-            df.rename(columns={'val': str(col_name)}, inplace=True)
-            if df_final is None:
-                df_final = df
-            else:
-                df_final = pd.merge(df_final, df, how='outer', left_index=True, right_index=True)
+        time_filter = ''
+        if start_ts is not None:
+            time_filter += ' AND ts>=%s' % int(start_ts)
+        if end_ts is not None:
+            time_filter += ' AND ts<=%s' % int(end_ts)
+
+        # Read all of the requested sensors in one query; each row is tagged with the
+        # position of its sensor in the list.  Sensors not present in the database
+        # will have a column of NaN values.
+        selects = []
+        for ix, sensor_id in enumerate(sensor_id_list):
+            if self.sensor_id_exists(str(sensor_id)):
+                selects.append('SELECT %s, ts, val FROM [%s] WHERE 1%s' % (ix, sensor_id, time_filter))
+        # The rows are put directly into arrays from the cursor, as in arraysForOneID().
+        cursor = self.conn.cursor()
+        cursor.row_factory = None     # plain tuples are much faster than Row objects
+        rec_arrays = [np.empty(0)]
+        for i in range(0, len(selects), MAX_COMPOUND_SELECT):
+            cursor.execute(' UNION ALL '.join(selects[i:i + MAX_COMPOUND_SELECT]))
+            rec_arrays.append(np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.float64))
+        cursor.close()
+        recs = np.concatenate(rec_arrays).reshape(-1, 3)
+
+        # Make one sorted set of timestamps for all the sensors, and put each sensor's
+        # values into its column at the rows for its timestamps.
+        stamps, row_ix = np.unique(recs[:, 1].astype(np.int64), return_inverse=True)
+        data = np.full((len(stamps), len(col_names)), np.nan)
+        data[row_ix, recs[:, 0].astype(np.int64)] = recs[:, 2]
+        index = pd.DatetimeIndex(pd.to_datetime(stamps, unit='s'), name='ts')
+        df_final = pd.DataFrame(data, index=index, columns=col_names)
 
         # convert the timezone of the index if requested
         if tz and len(df_final) > 0:
@@ -269,19 +748,178 @@ class BMSdata:
 
         return df_final
 
+    def _hourly_rows(self, ts, vals):
+        """Returns a list of hourly rollup rows for the timestamp ordered readings in the
+        NumPy arrays 'ts' and 'vals'.  Each row is a tuple of (hour start ts, count, sum,
+        ts_sum, min, max, first, last), matching the columns of the '_rollup_hourly' table.
+        """
+        if len(ts) == 0:
+            return []
+        hours = ts // ROLLUP_SECS * ROLLUP_SECS
+        starts = np.flatnonzero(np.r_[True, hours[1:] != hours[:-1]])
+        ends = np.r_[starts[1:], len(ts)]
+        return list(zip(hours[starts].tolist(),
+                        (ends - starts).tolist(),
+                        np.add.reduceat(vals, starts).tolist(),
+                        np.add.reduceat(ts, starts).tolist(),
+                        np.minimum.reduceat(vals, starts).tolist(),
+                        np.maximum.reduceat(vals, starts).tolist(),
+                        vals[starts].tolist(),
+                        vals[ends - 1].tolist()))
+
+    def _update_rollups(self, sensor_id, stamps):
+        """Recalculates the hourly rollups for 'sensor_id' for each of the hours containing
+        the timestamps in the list 'stamps'.  Does not commit.
+        """
+        hours = np.unique(np.asarray(stamps, dtype=np.int64) // ROLLUP_SECS)
+        rollup_id = self._table_name(sensor_id)
+
+        # read the readings for each run of consecutive hours at once.
+        for run in np.split(hours, np.flatnonzero(np.diff(hours) > 1) + 1):
+            ts, vals = self.arraysForOneID(sensor_id, run[0] * ROLLUP_SECS, (run[-1] + 1) * ROLLUP_SECS - 1)
+            rows = [(rollup_id,) + row for row in self._hourly_rows(ts, vals)]
+            self.cursor.executemany('INSERT OR REPLACE INTO [_rollup_hourly] VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def rebuild_rollups(self, sensor_id, start_ts=None, end_ts=None, chunk_days=30):
+        """Recalculates the hourly rollups for 'sensor_id' from its readings.  Only the hours
+        holding 'start_ts' through 'end_ts' are rebuilt; if either are not provided, no limit
+        is imposed.  If all of the sensor's rollups are rebuilt, the sensor is marked as
+        having complete rollups.  The readings are processed 'chunk_days' at a time.
+        """
+        sensor_id = str(sensor_id)   # make sure ID is a string
+        if not self.sensor_id_exists(sensor_id):
+            return
+
+        rollup_id = self._table_name(sensor_id)
+        first_ts, last_ts = self.cursor.execute('SELECT MIN(ts), MAX(ts) FROM [%s]' % sensor_id).fetchone()
+        if first_ts is None:
+            # no readings, so there should be no rollups.
+            self.cursor.execute('DELETE FROM [_rollup_hourly] WHERE id = ?', (rollup_id,))
+        else:
+            start_hr = (first_ts if start_ts is None else int(start_ts)) // ROLLUP_SECS * ROLLUP_SECS
+            end_hr = (last_ts if end_ts is None else int(end_ts)) // ROLLUP_SECS * ROLLUP_SECS
+            self.cursor.execute('DELETE FROM [_rollup_hourly] WHERE id = ? AND ts >= ? AND ts <= ?', (rollup_id, start_hr, end_hr))
+            chunk_secs = chunk_days * 24 * 3600
+            for chunk_start in range(start_hr, end_hr + 1, chunk_secs):
+                chunk_end = min(chunk_start + chunk_secs, end_hr + ROLLUP_SECS) - 1
+                ts, vals = self.arraysForOneID(sensor_id, chunk_start, chunk_end)
+                rows = [(rollup_id,) + row for row in self._hourly_rows(ts, vals)]
+                self.cursor.executemany('INSERT OR REPLACE INTO [_rollup_hourly] VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        if start_ts is None and end_ts is None:
+            self.cursor.execute('INSERT OR IGNORE INTO [_rollup_built] (id) VALUES (?)', (rollup_id,))
+        self.conn.commit()
+
+    def rollups_built(self, sensor_id):
+        """Returns True if the hourly rollups for 'sensor_id' cover all of its readings.
+        """
+        self.cursor.execute('SELECT id FROM [_rollup_built] WHERE id = ?', (self._table_name(str(sensor_id)),))
+        return self.cursor.fetchone() is not None
+
+    def upgrade_rollup_tables(self):
+        """Recreates the rollup tables with case insensitive IDs if they were created with
+        case sensitive IDs by an earlier version.  The rollups of a sensor stored under more
+        than one case of its ID can be stale, so they are dropped, and are rebuilt by
+        rebuild_rollups().  Returns True if the tables were recreated.
+        """
+        self.cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='_rollup_built'")
+        if 'nocase' in self.cursor.fetchone()['sql'].lower():
+            return False
+
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for table_name in ('_rollup_hourly', '_rollup_built'):
+                self.cursor.execute('ALTER TABLE [%s] RENAME TO [%s_old]' % (table_name, table_name))
+                self.cursor.execute(SPECIAL_TABLE_SQL[table_name])
+            mixed_sql = '''SELECT lower(id) FROM (SELECT DISTINCT id FROM [_rollup_hourly_old])
+                           GROUP BY lower(id) HAVING COUNT(*) > 1'''
+            self.cursor.execute('INSERT INTO [_rollup_hourly] SELECT * FROM [_rollup_hourly_old] WHERE lower(id) NOT IN (%s)' % mixed_sql)
+            self.cursor.execute('INSERT OR IGNORE INTO [_rollup_built] SELECT id FROM [_rollup_built_old] WHERE lower(id) NOT IN (%s)' % mixed_sql)
+            self.cursor.execute('DROP TABLE [_rollup_hourly_old]')
+            self.cursor.execute('DROP TABLE [_rollup_built_old]')
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self._load_table_names()
+        return True
+
+    def rollupDataframeForOneID(self, sensor_id, start_ts=None, end_ts=None, tz=None):
+        """Returns a pandas DataFrame of hourly rollups for a particular sensor ID, limited
+        to readings with timestamps from 'start_ts' through 'end_ts' (UNIX timestamps, no 
+        limit imposed if not provided).  The columns are 'count', 'sum', 'ts_sum', 'min', 
+        'max', 'first' and 'last'.  The index is the start of each hour, naive UTC, unless
+        a pytz timezone 'tz' is passed in; if so, the index is expressed in that timezone
+        and is naive.  Partial hours at the ends of the time range are calculated from the
+        readings, so the rollups exactly match the readings in the range.
+        Returns None if the sensor does not have complete rollups, or if the timezone 
+        does not have a whole hour offset from UTC, as hourly rollups cannot be used to
+        average readings in that case.
+        """
+        sensor_id = str(sensor_id)   # make sure ID is a string
+        if not self.sensor_id_exists(sensor_id) or not self.rollups_built(sensor_id):
+            return None
+
+        start_ts = None if start_ts is None else int(start_ts)
+        end_ts = None if end_ts is None else int(end_ts)
+
+        # The hours fully within the time range come from the rollup table.  'full_end' is
+        # the end of the last full hour, exclusive.
+        full_start = None if start_ts is None else -(-start_ts // ROLLUP_SECS) * ROLLUP_SECS
+        full_end = None if end_ts is None else (end_ts + 1) // ROLLUP_SECS * ROLLUP_SECS
+
+        rows = []
+        if (full_start is None) or (full_end is None) or (full_start < full_end):
+            sql = 'SELECT ts, count, sum, ts_sum, min, max, first, last FROM [_rollup_hourly] WHERE id = ?'
+            params = [self._table_name(sensor_id)]
+            if full_start is not None:
+                sql += ' AND ts >= ?'
+                params.append(full_start)
+            if full_end is not None:
+                sql += ' AND ts < ?'
+                params.append(full_end)
+            cursor = self.conn.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(sql, params).fetchall()
+            cursor.close()
+
+            # Partial hours at the ends of the range
+            if (start_ts is not None) and (full_start > start_ts):
+                rows += self._hourly_rows(*self.arraysForOneID(sensor_id, start_ts, full_start - 1))
+            if (end_ts is not None) and (full_end <= end_ts):
+                rows += self._hourly_rows(*self.arraysForOneID(sensor_id, full_end, end_ts))
+        else:
+            # the time range is within one hour
+            rows = self._hourly_rows(*self.arraysForOneID(sensor_id, start_ts, end_ts))
+
+        df = pd.DataFrame(rows, columns=['ts', 'count', 'sum', 'ts_sum', 'min', 'max', 'first', 'last'])
+        df = df.sort_values('ts')
+        df.index = pd.DatetimeIndex(pd.to_datetime(df.ts, unit='s'))
+        if tz:
+            df.index = df.index.tz_localize('UTC').tz_convert(tz).tz_localize(None)
+            if (df.index.minute != 0).any():
+                return None
+        df.drop('ts', axis=1, inplace=True)
+
+        return df
+
     def readingCount(self, startTime=0):
         """Returns the number of readings in the reading table inserted after the specified
         'startTime' (Unix seconds) and before now (in case erroneously timestamped readings
         are in the file).
         """
+        # The '_sensor_stats' catalog is used for sensors with all of their readings in the
+        # requested time range; the readings of other sensors are counted.
+        now = time.time()
         rec_ct = 0
-        for id in self.sensor_ids:
-            try:
-                self.cursor.execute('SELECT COUNT(*) FROM [%s] WHERE ts > ? and ts < ?' % id, (startTime, time.time()))
+        for id, stats in self.sensor_stats().items():
+            if not stats['count'] or stats['last_ts'] <= startTime:
+                continue
+            if stats['first_ts'] > startTime and stats['last_ts'] < now:
+                rec_ct += stats['count']
+            else:
+                self.cursor.execute('SELECT COUNT(*) FROM [%s] WHERE ts > ? and ts < ?' % id, (startTime, now))
                 rec_ct += self.cursor.fetchone()[0]
-            except:
-                # not all tables are reading tables and may error out cause no 'ts' column
-                pass
         return rec_ct
         
     def replaceLastRaw(self, sensor_id, ts, val):
@@ -311,6 +949,63 @@ class BMSdata:
             self.conn.commit()
             return None, None   # no prior values
 
+    def set_last_raw(self, sensor_id, ts, val):
+        """Stores 'ts' and 'val' as the last raw reading in the '_last_raw' table
+        for 'sensor_id', replacing any prior values.
+        """
+        self._store_last_raw(sensor_id, ts, val)
+        self.conn.commit()
+
+    def defer_last_raw(self, sensor_id, ts, val):
+        """Stores 'ts' and 'val' as the last raw reading for 'sensor_id' in the same
+        transaction as the readings passed to the next call of insert_readings_bulk(), so
+        the last raw reading is not changed if the readings are not stored.  Until then,
+        last_raw() returns these values.
+        """
+        self.pending_last_raw[str(sensor_id)] = (ts, val)
+
+    def _store_last_raw(self, sensor_id, ts, val):
+        """Writes the last raw reading of 'sensor_id' to the '_last_raw' table without
+        committing.
+        """
+        self.cursor.execute('INSERT OR REPLACE INTO [_last_raw] (id, ts, val) VALUES (?, ?, ?)', (str(sensor_id), ts, val))
+
+    def calc_watermarks(self, calc_id):
+        """Returns a dictionary, keyed on input Sensor ID, of the last input timestamp 
+        processed by the calculated reading 'calc_id'.
+        """
+        self.cursor.execute('SELECT input_id, ts FROM [_calc_watermark] WHERE calc_id = ?', (str(calc_id),))
+        return {row['input_id']: row['ts'] for row in self.cursor.fetchall()}
+
+    def set_calc_watermarks(self, calc_id, watermarks):
+        """Stores the last input timestamps processed by the calculated reading 'calc_id'.
+        'watermarks' is a dictionary keyed on input Sensor ID; inputs not in the dictionary
+        keep their prior values.
+        """
+        self.cursor.executemany('INSERT OR REPLACE INTO [_calc_watermark] (calc_id, input_id, ts) VALUES (?, ?, ?)',
+                                [(str(calc_id), str(input_id), int(ts)) for input_id, ts in watermarks.items()])
+        self.conn.commit()
+
+    def prior_reading_ts(self, sensor_id, ts):
+        """Returns the timestamp of the last reading of 'sensor_id' at or before 'ts',
+        or None if there is no such reading.
+        """
+        sensor_id = str(sensor_id)   # make sure ID is a string
+        if not self.sensor_id_exists(sensor_id):
+            return None
+        self.cursor.execute('SELECT MAX(ts) FROM [%s] WHERE ts <= ?' % sensor_id, (int(ts),))
+        return self.cursor.fetchone()[0]
+
+    def next_reading_ts(self, sensor_id, ts):
+        """Returns the timestamp of the first reading of 'sensor_id' at or after 'ts',
+        or None if there is no such reading.
+        """
+        sensor_id = str(sensor_id)   # make sure ID is a string
+        if not self.sensor_id_exists(sensor_id):
+            return None
+        self.cursor.execute('SELECT MIN(ts) FROM [%s] WHERE ts >= ?' % sensor_id, (int(ts),))
+        return self.cursor.fetchone()[0]
+
     def last_raw(self, sensor_id):
         """Returns the last raw reading stored in the '_last_raw' table for
         the sensor with a Sensor ID of 'sensor_id'.  A two-tuple is returned:
@@ -318,6 +1013,8 @@ class BMSdata:
         are returned if there is no last reading present.
         """
         sensor_id = str(sensor_id)  # make sure ID is a string
+        if sensor_id in self.pending_last_raw:
+            return self.pending_last_raw[sensor_id]
 
         self.cursor.execute('SELECT * FROM [_last_raw] WHERE id = ?', (sensor_id,))
         rec = self.cursor.fetchone()
@@ -330,43 +1027,61 @@ class BMSdata:
         """Returns a list of Sensor IDs that are present in the Reading
         database.  The returned list is sorted by ID.  This includes unassigned sensors
         (sensors that are in the Django Sensor object list.
+        The IDs are the reading table names, so sensors not yet in the '_sensor_stats'
+        catalog are included.
+        """
+        return sorted(self._table_sensor_ids())
+
+    def _table_sensor_ids(self):
+        """Returns a list of the Sensor IDs that have a reading table in the database.
         """
+        if self._tables_changed():
+            self._load_table_names()
         # Don't return IDs that start with underbar.
-        id_list = [sens_id for sens_id in self.sensor_ids if sens_id[0]!='_']
-        return sorted(id_list)
+        return [sens_id for sens_id in self.sensor_ids if sens_id[0]!='_']
 
     def backup_db(self, days_to_retain):
         """Backs up the database and compresses the backup.  Deletes old backup
         files that were created more than 'days_to_retain' ago.
+        The database pages are copied in steps with the SQLite backup API from one read
+        transaction, so the backup is a consistent snapshot and readings can continue
+        to be stored while it runs.
         """
-        # make backup filename with current date time in 'bak' subdirectory
-        fname = os.path.join(os.path.dirname(self.db_fname), 'bak', time.strftime('%Y-%m-%d-%H%M%S') + '.sqlite')
+        bak_dir = os.path.join(os.path.dirname(self.db_fname), 'bak')
 
-        # Before copying the database file, need to force a lock on it so that no
-        # write operations occur during the copying process
+        # make backup filename with current date time in 'bak' subdirectory
+        fname = os.path.join(bak_dir, time.strftime('%Y-%m-%d-%H%M%S') + '.sqlite')
 
-        # create a dummy table to write into.
+        start = time.time()
+        src = sqlite3.connect(self.db_fname, isolation_level=None)
+        dest = sqlite3.connect(fname)
         try:
-            self.cursor.execute('CREATE TABLE _junk (x integer)')
-        except:
-            # table already existed
-            pass
-
-        # write a value into the table to create a lock on the database
-        self.cursor.execute('INSERT INTO _junk VALUES (1)')
-
-        # now copy database
-        shutil.copy(self.db_fname, fname)
-
-        # Rollback the Insert as we don't really need it.
-        self.conn.rollback()
+            # Hold one read transaction for the whole backup.  Otherwise, the backup restarts
+            # whenever a reading is stored between steps.
+            src.execute('BEGIN')
+            src.execute('SELECT COUNT(*) FROM sqlite_master')
+            src.backup(dest, pages=BACKUP_PAGES_PER_STEP)
+            src.execute('COMMIT')
+        finally:
+            dest.close()
+            src.close()
+        copy_secs = time.time() - start
+        db_size = os.path.getsize(fname)
 
         # gzip the backup file
-        subprocess.call(['gzip', fname])
+        start = time.time()
+        with open(fname, 'rb') as f_in, gzip.open(fname + '.gz', 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.remove(fname)
+        gzip_secs = time.time() - start
+
+        mb = db_size / 1e6
+        _logger.info('Reading database backup: copied %.1f MB in %.1f s (%.1f MB/s), compressed to %.1f MB in %.1f s (%.1f MB/s).' % \
+            (mb, copy_secs, mb / max(copy_secs, 0.001), os.path.getsize(fname + '.gz') / 1e6, gzip_secs, mb / max(gzip_secs, 0.001)))
 
         # delete any backup files more than 'days_to_retain' old.
         cutoff_time = time.time() - days_to_retain * 24 *3600.0
-        for fn in glob.glob(os.path.join(os.path.dirname(self.db_fname), 'bak', '*.gz')):
+        for fn in glob.glob(os.path.join(bak_dir, '*.gz')):
             if os.path.getmtime(fn) < cutoff_time:
                 os.remove(fn)
 
@@ -399,6 +1114,7 @@ class BMSdata:
 
         first_row = True
         vals_stored = 0
+        stored_stamps = {}    # timestamps stored for each sensor, for updating rollups
         cur_line = 0    # current line number being processed
         for lin in open(filename):
 
@@ -440,8 +1156,14 @@ class BMSdata:
                         if float_val is not None:     # sometimes find "nan" in data
                             self.cursor.execute("INSERT INTO [%s] (ts, val) VALUES (?, ?)" % s_id, (ts, float(val)))
                             vals_stored += 1
+                            stored_stamps.setdefault(s_id, []).append(ts)
                 except Exception as e:
                     errors.append("Problem storing %s: %s=%s at line %s: %s" % (datestr, s_id, val, cur_line, e))
 
+        for s_id, stamps in stored_stamps.items():
+            self._rescan_stats(s_id)
+            self._update_latest(s_id)
+            self._update_rollups(s_id, stamps)
+
         self.conn.commit()
         return vals_stored, errors
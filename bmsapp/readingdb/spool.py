@@ -0,0 +1,213 @@
+"""A durable, append-only spool of sensor readings waiting to be stored in the
+reading database.  Readings posted to the web server are appended to the spool
+and acknowledged right away; a writer later drains the spool into the reading
+database in large batches.
+
+The spool is a directory of segment files.  Each line of a segment file is a JSON
+list of [ts, id, val] readings.  Each process appends to its own segment for the
+current time period, so a segment is closed once its time period has passed.
+Only closed segments are drained, and a segment is deleted only after its readings
+have been stored, so readings are delayed, not lost, when the reading database
+is busy.  A segment that has failed MAX_FAILURES times, over at least SET_ASIDE_SECS
+seconds, for errors other than a busy or unavailable database, is renamed with a
+'.bad' extension so it does not hold up the rest of the spool; rename it back to
+'.seg' to store it again.
+"""
+
+import os
+import glob
+import json
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+
+# Make a logger for this module
+_logger = logging.getLogger('bms.' + __name__)
+
+# The path to the default spool directory.
+DEFAULT_SPOOL_DIR = os.path.join(os.path.dirname(__file__), 'data', 'spool')
+
+# The number of seconds covered by each segment file.
+SEGMENT_SECS = 5
+
+# The maximum number of readings passed to the store function in one batch.  A
+# segment is not split, so batches can be larger.
+MAX_BATCH_READINGS = 20000
+
+# A segment is set aside after it has failed to be stored MAX_FAILURES times and
+# SET_ASIDE_SECS seconds have passed since its first failure.  Errors of the types
+# passed to drain() as 'transient_errors', such as a busy or locked database, are not
+# counted.
+MAX_FAILURES = 5
+SET_ASIDE_SECS = 3600
+
+# serializes appends from the threads of this process
+_append_lock = threading.Lock()
+
+
+def _segment_name(spool_dir, period):
+    """Returns the path to this process's segment file for the time period 'period'.
+    """
+    return os.path.join(spool_dir, '%012d-%d.seg' % (period, os.getpid()))
+
+def append(recs, spool_dir=DEFAULT_SPOOL_DIR):
+    """Durably appends the list of (ts, id, val) readings 'recs' to the spool.  The
+    readings are on disk when this function returns.
+    """
+    if not recs:
+        return
+    line = json.dumps([list(rec) for rec in recs]) + '\n'
+
+    with _append_lock:
+        os.makedirs(spool_dir, exist_ok=True)
+        while True:
+            fname = _segment_name(spool_dir, int(time.time() // SEGMENT_SECS))
+            with open(fname, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # If the segment was drained and deleted before the lock was obtained,
+                # start a new segment.
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+                return
+
+def pending_segments(spool_dir=DEFAULT_SPOOL_DIR):
+    """Returns the number of segment files in the spool, including open ones.
+    """
+    return len(glob.glob(os.path.join(spool_dir, '*.seg')))
+
+def _read_segments(seg_names):
+    """Opens and locks the segment files 'seg_names', so no reading is appended while
+    they are being stored.  Returns the list of open files and the list of their readings.
+    """
+    files = []
+    recs = []
+    for seg_name in seg_names:
+        f = open(seg_name, 'r')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        files.append(f)
+        for lin in f:
+            try:
+                recs += json.loads(lin)
+            except ValueError:
+                # a partial line from an interrupted append
+                _logger.warning('Skipped a bad line in spool segment %s' % f.name)
+    return files, recs
+
+def _store_segments(store_func, seg_names):
+    """Stores the readings of the segment files 'seg_names' with 'store_func' and deletes
+    the files.  Returns the number of readings stored; raises the error of 'store_func'.
+    """
+    files, recs = _read_segments(seg_names)
+    try:
+        if recs:
+            store_func(recs)
+        for f in files:
+            os.remove(f.name)
+        return len(recs)
+    finally:
+        for f in files:
+            f.close()
+
+def _record_failure(spool_dir, seg_name, error, transient_errors):
+    """Counts a failed try to store the segment 'seg_name', given the 'error' raised,
+    and sets the segment aside once it has failed MAX_FAILURES times over at least
+    SET_ASIDE_SECS seconds.  Errors that are instances of 'transient_errors' are not
+    counted.  The counts, with the time of the first failure, are kept in a file in
+    the spool directory.  Returns True if the segment was set aside.
+    """
+    if isinstance(error, transient_errors):
+        # a busy or unavailable database; the segment is not at fault
+        return False
+
+    counts_file = os.path.join(spool_dir, 'failures.json')
+    try:
+        with open(counts_file) as f:
+            counts = json.load(f)
+    except (OSError, ValueError):
+        counts = {}
+    seg_base = os.path.basename(seg_name)
+    now = time.time()
+    try:
+        fail_count, first_fail = counts.get(seg_base, [0, now])
+    except TypeError:
+        fail_count, first_fail = 0, now      # a count from an older version of this module
+    fail_count += 1
+    counts[seg_base] = [fail_count, first_fail]
+    set_aside = fail_count >= MAX_FAILURES and now - first_fail >= SET_ASIDE_SECS
+    if set_aside:
+        os.rename(seg_name, seg_name[:-len('.seg')] + '.bad')
+        _logger.error('Spool segment %s failed %s times over %.0f seconds and was renamed to .bad' %
+                      (seg_base, fail_count, now - first_fail))
+    # drop the counts of segments that are gone
+    counts = {nm: ct for nm, ct in counts.items() if os.path.exists(os.path.join(spool_dir, nm))}
+    with open(counts_file, 'w') as f:
+        json.dump(counts, f)
+    return set_aside
+
+def drain(store_func, spool_dir=DEFAULT_SPOOL_DIR, transient_errors=(sqlite3.OperationalError,)):
+    """Passes the readings in the closed segments of the spool to 'store_func', oldest
+    first, in batches of about MAX_BATCH_READINGS readings.  'store_func' takes a list
+    of (ts, id, val) readings.  Segments are deleted after 'store_func' returns.  If it
+    raises an error, the batch's segments are stored one at a time to find the failing
+    segment, which is kept and retried on the next call, and draining stops.  A segment
+    that keeps failing is set aside (see _record_failure()) and draining goes on.
+    'transient_errors' is a tuple of the error types that are not the segment's fault,
+    such as a busy database; they never cause a segment to be set aside.
+    Only one process drains the spool at a time; if another is draining, this function
+    returns right away.
+    Returns the number of readings drained.
+    """
+    if not os.path.isdir(spool_dir):
+        return 0
+
+    drained = 0
+    with open(os.path.join(spool_dir, 'drain.lock'), 'a') as drain_lock:
+        try:
+            fcntl.flock(drain_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+
+        # Segments of the current and prior time period could still be written to.
+        cutoff_period = int(time.time() // SEGMENT_SECS) - 1
+        seg_names = [fn for fn in sorted(glob.glob(os.path.join(spool_dir, '*.seg')))
+                     if int(os.path.basename(fn).split('-')[0]) < cutoff_period]
+
+        while seg_names:
+            # gather a batch of segments, using the file sizes to estimate the number
+            # of readings; about 40 bytes per reading.
+            batch = []
+            batch_bytes = 0
+            while seg_names and batch_bytes < MAX_BATCH_READINGS * 40:
+                batch.append(seg_names.pop(0))
+                batch_bytes += os.path.getsize(batch[-1])
+
+            try:
+                drained += _store_segments(store_func, batch)
+                continue
+            except Exception as e:
+                if len(batch) == 1:
+                    _logger.exception('Error storing spool segment %s; it will be retried.' % batch[0])
+                    if _record_failure(spool_dir, batch[0], e, transient_errors):
+                        continue
+                    break
+                _logger.warning('Error storing %s spool segments; storing them one at a time.' % len(batch), exc_info=True)
+
+            # store the batch's segments one at a time
+            stop = False
+            for seg_name in batch:
+                try:
+                    drained += _store_segments(store_func, [seg_name])
+                except Exception as e:
+                    _logger.exception('Error storing spool segment %s; it will be retried.' % seg_name)
+                    if not _record_failure(spool_dir, seg_name, e, transient_errors):
+                        stop = True
+                        break
+            if stop:
+                break
+
+    return drained
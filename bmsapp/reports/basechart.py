@@ -188,6 +188,25 @@ class BaseChart(object):
 
         return st_ts, end_ts
 
+    def averaged_readings(self, sensor_id, st_ts, end_ts, tz, averaging_hours):
+        """
+        Returns a DataFrame of readings for 'sensor_id' from 'st_ts' through 'end_ts',
+        with 'ts' and 'val' columns and a naive datetime index in the timezone 'tz'.
+        The readings are averaged across 'averaging_hours' intervals, unless 
+        'averaging_hours' is 0.  Whole hour averages are computed from the
+        hourly rollups in the reading database when they are available, so that 
+        long time ranges do not require reading every reading.
+        """
+        df = None
+        if averaging_hours >= 1 and averaging_hours == int(averaging_hours):
+            df = self.reading_db.rollupDataframeForOneID(sensor_id, st_ts, end_ts, tz)
+        if df is None:
+            df = self.reading_db.dataframeForOneID(sensor_id, st_ts, end_ts, tz)
+
+        if averaging_hours and not df.empty:
+            df = bmsapp.data_util.resample_timeseries(df, averaging_hours)
+        return df
+
     def get_chart_options(self, chart_type='plotly'):
         """
         Returns a configuration object for the chart.  Must make a
@@ -67,13 +67,14 @@ class Dashboard(basechart.BaseChart):
                 except Exception as e:
                     pass
 
-                db_recs = self.reading_db.rowsForOneID(dash_item.sensor.sensor.sensor_id, minTime, maxTime)
-
-                if db_recs:
-                    for rec in db_recs:
-                        times.append(datetime.fromtimestamp(rec['ts'],tz).strftime('%Y-%m-%d %H:%M:%S'))
-                        values.append(bmsapp.data_util.round4(rec['val']))
-                        labels.append(datetime.fromtimestamp(rec['ts'],tz).strftime('%I:%M %p').lstrip('0') + '</br>' + format_function(rec['val']) + ' ' + dash_item.sensor.sensor.unit.label)
+                db_ts, db_vals = self.reading_db.arraysForOneID(dash_item.sensor.sensor.sensor_id, minTime, maxTime)
+
+                if len(db_ts):
+                    for rec_ts, rec_val in zip(db_ts.tolist(), db_vals.tolist()):
+                        rec_dt = datetime.fromtimestamp(rec_ts, tz)
+                        times.append(rec_dt.strftime('%Y-%m-%d %H:%M:%S'))
+                        values.append(bmsapp.data_util.round4(rec_val))
+                        labels.append(rec_dt.strftime('%I:%M %p').lstrip('0') + '</br>' + format_function(rec_val) + ' ' + dash_item.sensor.sensor.unit.label)
                     minAxis = min(minAxis, min(values))
                     maxAxis = max(maxAxis, max(values))
                     if dash_item.sensor.sensor.unit.label not in ['code','1=On 0=Off']:
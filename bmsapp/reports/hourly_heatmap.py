@@ -23,14 +23,12 @@ class HourlyHeatMap(basechart.BaseChart):
         # determine the start time for selecting records and loop through the selected
         # records to get the needed dataset
         st_ts, end_ts = self.get_ts_range()
-        db_recs = self.reading_db.rowsForOneID(the_sensor.sensor_id, st_ts, end_ts)
-        recs = []
-        for rec in db_recs:
-            dt = bmsapp.data_util.ts_to_datetime(rec['ts'])
-            recs.append({'da': dt.weekday(), 'hr': dt.hour, 'val': rec['val']})
+        db_ts, db_vals = self.reading_db.arraysForOneID(the_sensor.sensor_id, st_ts, end_ts)
+        dts = pd.to_datetime(db_ts, unit='s').tz_localize('UTC').tz_convert(bmsapp.data_util.default_tz)
+        recs = pd.DataFrame({'da': dts.weekday, 'hr': dts.hour, 'val': db_vals})
 
         if len(recs):
-            df = pd.DataFrame(recs)
+            df = recs
             z_list = []
             text_list = []
             for da in range(0,7):
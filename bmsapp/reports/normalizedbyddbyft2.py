@@ -62,20 +62,18 @@ class NormalizedByDDbyFt2(basechart.BaseChart):
             bldg_params = yaml.load(bldg_info.parameters, Loader=yaml.FullLoader)
 
             # get the value records and average into one hour intervals
-            df = self.reading_db.dataframeForOneID(bldg_params['id_value'], st_ts, end_ts, self.timezone)
+            df = self.averaged_readings(bldg_params['id_value'], st_ts, end_ts, self.timezone, 1)
             if len(df)==0:
                 continue
-            df.drop('ts', 1, inplace=True)        # delete ts column
+            df.drop('ts', axis=1, inplace=True)        # delete ts column
             df.columns = ['value']                # rename to value
-            df = bmsapp.data_util.resample_timeseries(df, 1)    # do one hour averaging
 
             # get outdoor temp data and average into one hour intervals.  
-            df_temp = self.reading_db.dataframeForOneID(bldg_params['id_out_temp'], st_ts, end_ts, self.timezone)
+            df_temp = self.averaged_readings(bldg_params['id_out_temp'], st_ts, end_ts, self.timezone, 1)
             if len(df_temp)==0:
                 continue
-            df_temp.drop('ts', 1, inplace=True)        # delete ts column
+            df_temp.drop('ts', axis=1, inplace=True)        # delete ts column
             df_temp.columns = ['temp']            # rename to temp
-            df_temp = bmsapp.data_util.resample_timeseries(df_temp, 1)    # do one hour averaging
 
             # inner join, matching timestamps
             df = df.join(df_temp, how='inner') 
@@ -52,21 +52,20 @@ class NormalizedByFt2(basechart.BaseChart):
             bldg_params = yaml.load(bldg_info.parameters, Loader=yaml.FullLoader)
 
             # get the value records
-            db_recs = self.reading_db.rowsForOneID(bldg_params['id_value'], st_ts, end_ts)
-            if len(db_recs)==0:
+            db_ts, db_vals = self.reading_db.arraysForOneID(bldg_params['id_value'], st_ts, end_ts)
+            if len(db_ts)==0:
                 continue
 
             # make sure the data spans at least 80% of the requested interval.
             # if not, skip this building.
-            actual_span = db_recs[-1]['ts'] - db_recs[0]['ts']
+            actual_span = db_ts[-1] - db_ts[0]
             if actual_span / float(end_ts - st_ts) < 0.8:
                 continue
 
-            # make a list of the values
-            val_list = [rec['val'] for rec in db_recs]
-            ct = len(val_list)
+            # average the values
+            ct = len(db_vals)
             if ct > 0:
-                normalized_val = sum(val_list) / float(ct) / bldg_params['floor_area'] * multiplier
+                normalized_val = float(db_vals.sum()) / float(ct) / bldg_params['floor_area'] * multiplier
                 bldg_names.append(bldg_name)
                 values.append( round( normalized_val, 2) )
 
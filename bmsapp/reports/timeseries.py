@@ -45,14 +45,10 @@ class TimeSeries(basechart.BaseChart):
         line_width = 1 if len(sensor_list) > 1 else 2
         for sensor in sensor_list:
 
-            # get the database records
-            df = self.reading_db.dataframeForOneID(sensor.sensor_id, st_ts, end_ts,tz)
+            # get the database records, averaged if requested
+            df = self.averaged_readings(sensor.sensor_id, st_ts, end_ts, tz, averaging_hours)
 
             if not df.empty:
-                # perform average (if requested)
-                if averaging_hours:
-                    df = bmsapp.data_util.resample_timeseries(df,averaging_hours)
-
                 # create lists for plotly
                 if np.absolute(df.val.values).max() < 10000:
                     values = np.char.mod('%.4g',df.val.values).astype(float).tolist()
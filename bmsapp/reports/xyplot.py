@@ -41,15 +41,12 @@ class XYplot(basechart.BaseChart):
         series = []
 
         # get the X and Y sensor records and perform the requested averaging
-        dfX = self.reading_db.dataframeForOneID(sensorX.sensor_id, st_ts, end_ts, tz)
-        dfY = self.reading_db.dataframeForOneID(sensorY.sensor_id, st_ts, end_ts, tz)
+        dfX = self.averaged_readings(sensorX.sensor_id, st_ts, end_ts, tz, averaging_hours)
+        dfY = self.averaged_readings(sensorY.sensor_id, st_ts, end_ts, tz, averaging_hours)
 
-        if not dfX.empty and not dfY.empty:  # both sensors have some data, so proceed to average the data points
-            
-            dfX = bmsapp.data_util.resample_timeseries(dfX,averaging_hours)
-            dfX.rename(columns = {'val':'X'}, inplace = True)
+        if not dfX.empty and not dfY.empty:  # both sensors have some data, so proceed
 
-            dfY = bmsapp.data_util.resample_timeseries(dfY,averaging_hours)
+            dfX.rename(columns = {'val':'X'}, inplace = True)
             dfY.rename(columns = {'val':'Y','ts':'tsY'}, inplace = True)
 
             # Join the X and Y values for the overlapping time intervals and make
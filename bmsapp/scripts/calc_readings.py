@@ -1,5 +1,5 @@
 '''Determines and inserts the calculated sensor values into the sensor
-reading database.  This script is usually run via a cron job every half 
+reading database.  This script is usually run via a cron job every half
 hour.
 
 This script is set up to run through use of the django-extensions runscript
@@ -9,35 +9,200 @@ for this application.  The script is run by:
     manage.py runscript calc_readings
 
 This script is also called from the main_cron.py script.
+
+The calculated readings are run in a pool of worker threads.  A calculated reading
+that uses another calculated reading as an input is not started until that input
+is done.  A calculated reading is skipped if none of its input sensors have
+readings newer than the last ones it processed.  Input sensor readings are read
+through a cache shared by all of the calculated readings in the run.
+
+Calculated readings are only created for the last REACH_BACK_MINS minutes.  To
+recalculate the past readings of calculated sensors, for example after changing
+a calculation, run:
+
+    manage.py runscript calc_readings --script-args recalc <start date> <end date> <sensor ID> ...
+
+The readings of the sensors from the start date through the end date are replaced.
 '''
 
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from django.db import close_old_connections, connections
 from bmsapp.readingdb import bmsdata
 from bmsapp.calcs import calcreadings, calcfuncs01
 import bmsapp.models
+import bmsapp.data_util
+
+# make a logger object
+logger = logging.getLogger('bms.calc_readings')
+
+# the number of calculated readings processed at once
+CALC_WORKERS = 4
+
+# Only allow calculated readings within the last 60 days.
+REACH_BACK_MINS = 60*24*60
+
+# When recalculating past readings, the time range is split into chunks of this many
+# days, which are calculated by a pool of RECALC_PROCESSES processes.
+RECALC_CHUNK_DAYS = 30
+RECALC_PROCESSES = 4
+
+# Each worker thread has its own CalculateReadings object, as the calculation objects
+# hold the ID of the calculated reading being processed.
+_thread_data = threading.local()
+
+def get_calc():
+    '''Returns the CalculateReadings object for the current thread.
+    '''
+    if not hasattr(_thread_data, 'calc'):
+        # get a BMSdata object for the sensor reading database and then make a Calculate
+        # Readings object.  Other calculated reading classes in addition to CalcReadingFuncs_01
+        # can be added to the list and they will be search for matching function names.
+        _thread_data.calc = calcreadings.CalculateReadings([calcfuncs01.CalcReadingFuncs_01, ], bmsdata.BMSdata(), REACH_BACK_MINS)
+    return _thread_data.calc
 
+def has_new_input(db, calc_id, input_ids):
+    '''Returns True if any of the sensors in 'input_ids' have a reading newer than
+    the watermark stored for that input by the calculated reading 'calc_id', which is
+    the last reading of the input processed, or, if there is no watermark, newer than
+    the last reading of 'calc_id'.  'db' is the reading database.
+    '''
+    marks = db.calc_watermarks(calc_id)
+    last_calc = db.last_read(calc_id)
+    last_calc_ts = last_calc['ts'] if last_calc else None
+    for input_id, rec in db.last_reads(input_ids).items():
+        threshold = marks.get(input_id, last_calc_ts)
+        if threshold is None or rec['ts'] > threshold:
+            return True
+    return False
+
+def process(calc_sensor, input_ids, input_cache):
+    '''Calculates and inserts the new readings for the calculated Sensor 'calc_sensor',
+    whose input sensors are 'input_ids'.  Input readings are read through the 
+    calcreadings.InputCache 'input_cache'.
+    '''
+    try:
+        calc = get_calc()
+        calc.set_input_cache(input_cache)
+        if input_ids and not has_new_input(calc.db, calc_sensor.sensor_id, input_ids):
+            logger.debug('%s skipped, no new input readings' % calc_sensor.sensor_id)
+            return
+        rec_count = calc.processCalc(calc_sensor.sensor_id, calc_sensor.tran_calc_function, calc_sensor.function_parameters)
+        logger.debug( '%s %s readings calculated and inserted' % (rec_count, calc_sensor.sensor_id) )
+    except:
+        logger.exception('Error calculating %s readings' % calc_sensor.sensor_id)
+    finally:
+        # the worker threads do not end with the request, so release the Django connection
+        close_old_connections()
 
-def run():
-    '''This method is called by the 'runscript' command.
+def recalc_chunk(calc_sensor, start_ts, end_ts):
+    '''Returns a list of timestamps and a list of values of the readings of the calculated
+    Sensor 'calc_sensor' recalculated for timestamps greater than 'start_ts' and less than
+    or equal to 'end_ts'.  This is run in the worker processes of recalculate().
     '''
+    try:
+        return get_calc().calcValues(calc_sensor.sensor_id, calc_sensor.tran_calc_function, calc_sensor.function_parameters,
+                                     calc_range=(start_ts, end_ts))
+    finally:
+        close_old_connections()
 
-    # make a logger object
-    logger = logging.getLogger('bms.calc_readings')
+def recalculate(sensor_ids, start_ts, end_ts, chunk_days=RECALC_CHUNK_DAYS, processes=RECALC_PROCESSES):
+    '''Recalculates the readings of the calculated sensors in the 'sensor_ids' list having
+    timestamps greater than 'start_ts' and less than or equal to 'end_ts', replacing the
+    stored readings in that range.  The range is split into chunks of 'chunk_days' days,
+    which are calculated by a pool of 'processes' processes; the readings of each chunk 
+    are stored in one transaction.  The sensors are recalculated one after another in 
+    calculation order, so a sensor can use the recalculated readings of another.
+    '''
+    calc_sensors = list(bmsapp.models.Sensor.objects.filter(is_calculated=1, sensor_id__in=sensor_ids).order_by('calculation_order'))
+    missing_ids = set(sensor_ids) - set(calc_sensor.sensor_id for calc_sensor in calc_sensors)
+    if missing_ids:
+        logger.warning('Not calculated sensors, not recalculated: %s' % ', '.join(sorted(missing_ids)))
+
+    chunk_secs = chunk_days * 24 * 3600
+    chunks = [(chunk_start, min(chunk_start + chunk_secs, int(end_ts))) for chunk_start in range(int(start_ts), int(end_ts), chunk_secs)]
+    db = bmsdata.BMSdata()
 
-    # get a BMSdata object for the sensor reading database and then make a Calculate
-    # Readings object.  Other calculated reading classes in addition to CalcReadingFuncs_01
-    # can be added to the list and they will be search for matching function names.
-    # Only allow calculated readings within the last 60 days.
-    reading_db = bmsdata.BMSdata()
-    calc = calcreadings.CalculateReadings([calcfuncs01.CalcReadingFuncs_01, ], reading_db, 60*24*60)
+    # The worker processes must not share the Django database connection of this process.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for calc_sensor in calc_sensors:
+            start = time.time()
+            futures = {pool.submit(recalc_chunk, calc_sensor, chunk_start, chunk_end): (chunk_start, chunk_end)
+                       for chunk_start, chunk_end in chunks}
+            rec_count = 0
+            try:
+                for fut in as_completed(futures):
+                    ts, vals = fut.result()
+                    chunk_start, chunk_end = futures[fut]
+                    db.replace_readings(calc_sensor.sensor_id, chunk_start, chunk_end, ts, vals)
+                    rec_count += len(ts)
+                logger.info('%s %s readings recalculated in %.1f seconds' % (rec_count, calc_sensor.sensor_id, time.time() - start))
+            except:
+                logger.exception('Error recalculating %s readings; %s readings were stored' % (calc_sensor.sensor_id, rec_count))
+                for fut in futures:
+                    fut.cancel()
 
-    # Loop through the calculated sensor readings in the proper calculation order,
-    # inserting the calculated values in the database.
-    for calc_sensor in bmsapp.models.Sensor.objects.filter(is_calculated=1).order_by('calculation_order'):
+def run(*args):
+    '''This method is called by the 'runscript' command.  If the script arguments are 
+    'recalc <start date> <end date> <sensor ID> ...', past readings are recalculated; 
+    otherwise new calculated readings are calculated.
+    '''
+    if args and args[0] == 'recalc':
+        if len(args) < 4:
+            logger.error('The recalc arguments are: recalc <start date> <end date> <sensor ID> ...')
+            return
+        recalculate(args[3:], bmsapp.data_util.datestr_to_ts(args[1]), bmsapp.data_util.datestr_to_ts(args[2]))
+        return
+
+    calc_sensors = list(bmsapp.models.Sensor.objects.filter(is_calculated=1).order_by('calculation_order'))
+    sensors = {calc_sensor.sensor_id: calc_sensor for calc_sensor in calc_sensors}
+
+    # Find the inputs of each calculated reading and build the dependency graph.
+    # 'waiting_on' holds the number of calculated inputs not yet done for each
+    # calculated reading; 'dependents' holds the calculated readings that use each one.
+    inputs = {}
+    waiting_on = {}
+    dependents = {sensor_id: [] for sensor_id in sensors}
+    for sensor_id, calc_sensor in sensors.items():
         try:
-            rec_count = calc.processCalc(calc_sensor.sensor_id, calc_sensor.tran_calc_function, calc_sensor.function_parameters)
-            logger.debug( '%s %s readings calculated and inserted' % (rec_count, calc_sensor.sensor_id) )
+            inputs[sensor_id] = get_calc().inputIDs(calc_sensor.tran_calc_function, calc_sensor.function_parameters)
         except:
-            logger.exception('Error calculating %s readings' % calc_sensor.sensor_id)
+            logger.exception('Error determining the inputs of %s' % sensor_id)
+            inputs[sensor_id] = []
+        calc_inputs = set(inputs[sensor_id]) & set(sensors) - {sensor_id}
+        waiting_on[sensor_id] = len(calc_inputs)
+        for input_id in calc_inputs:
+            dependents[input_id].append(sensor_id)
+
+    # the input readings cache for this run
+    input_cache = calcreadings.InputCache()
+
+    # Run the calculated readings whose inputs are done, in calculation order, until
+    # no more can be started.
+    calc_order = {sensor_id: i for i, sensor_id in enumerate(sensors)}
+    ready = [sensor_id for sensor_id in sensors if waiting_on[sensor_id] == 0]
+    with ThreadPoolExecutor(max_workers=CALC_WORKERS) as pool:
+        running = {}
+        while ready or running:
+            for sensor_id in ready:
+                running[pool.submit(process, sensors[sensor_id], inputs[sensor_id], input_cache)] = sensor_id
+            ready = []
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                for dependent_id in dependents[running.pop(fut)]:
+                    waiting_on[dependent_id] -= 1
+                    if waiting_on[dependent_id] == 0:
+                        ready.append(dependent_id)
+            ready.sort(key=calc_order.get)
+
+    # Calculated readings in or depending on a dependency cycle are never ready; run
+    # them one after another in calculation order.
+    for sensor_id in sensors:
+        if waiting_on[sensor_id] > 0:
+            logger.warning('%s is in or depends on a cycle of calculated readings' % sensor_id)
+            process(sensors[sensor_id], inputs[sensor_id], input_cache)
 
-    reading_db.close()
+    input_cache.log_stats()
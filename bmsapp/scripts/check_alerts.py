@@ -3,13 +3,53 @@ be run with the django-extensions runscript facility:
 
     manage.py runscript check_alerts
 
-This script is also called from the main_cron.py script.    
+This script is also called from the main_cron.py script.
+
+The conditions are checked in a batch: the conditions, their sensors, buildings and
+recipients, and the recent readings of the sensors are loaded with a few queries,
+so the check stays fast with many conditions.  The notifications are sent together
+after all of the conditions are checked.
+
+If the BMSAPP_INGEST_ALERTS setting is True, value conditions are also checked as
+soon as readings are posted (see bmsapp.ingest_alerts).  This script still checks
+them, to send repeat notifications after the wait time and to catch readings that
+are not posted, such as those from periodic scripts and calculated readings.
 '''
 import logging
 import time
-from bmsapp.models import AlertCondition
+from bmsapp.models import AlertCondition, BldgToSensor
 from bmsapp.readingdb.bmsdata import BMSdata
+from bmsapp.notifications import Dispatcher
+
+
+def load_conditions(reading_db):
+    '''Returns a list of the active Alert conditions whose wait time since the last
+    notification is satisfied, a dictionary of the recent readings needed to check them,
+    keyed on Sensor ID, and a dictionary of the titles of the buildings of their sensors,
+    keyed on the Sensor primary key.  'reading_db' is the sensor reading database.
+    '''
+    now = time.time()
+    conditions = [condx for condx in AlertCondition.objects.filter(active=True)
+                  .select_related('sensor__unit', 'only_if_bldg', 'only_if_bldg_mode')
+                  .prefetch_related('recipients')
+                  if now >= condx.last_notified + condx.wait_before_next * 3600.0]
 
+    # the building titles of the sensors having active conditions, in the order used by
+    # the sensor's own query.  A subquery selects the sensors, so there is no limit on
+    # their number.
+    bldg_titles = {}
+    for btos in BldgToSensor.objects.filter(sensor__in=AlertCondition.objects.filter(active=True).values('sensor')) \
+            .select_related('building'):
+        bldg_titles.setdefault(btos.sensor_id, []).append(btos.building.title)
+
+    # the number of recent readings needed for each sensor
+    read_counts = {}
+    for condx in conditions:
+        sensor_id = condx.sensor.sensor_id
+        read_counts[sensor_id] = max(read_counts.get(sensor_id, 1), condx.read_count)
+    recent_reads = reading_db.recent_reads(read_counts)
+
+    return conditions, recent_reads, bldg_titles
 
 def run():
     '''Checks all Alert conditions and notifies Alert recipients for those
@@ -24,31 +64,25 @@ def run():
     reading_db = BMSdata()
 
     total_true_alerts = 0
-    
-    for condx in AlertCondition.objects.all():
 
-        # if the wait time has not been satisfied, don't notify
-        if time.time() < (condx.last_notified + condx.wait_before_next * 3600.0):
-            continue
+    # the notifications of the true conditions, sent after all conditions are checked
+    dispatcher = Dispatcher()
+
+    conditions, recent_reads, bldg_titles = load_conditions(reading_db)
+    for condx in conditions:
 
         try:
-            subject_msg = condx.check_condition(reading_db)
+            subject_msg = condx.check_condition(reading_db,
+                                                recent_reads.get(condx.sensor.sensor_id, []),
+                                                bldg_titles.get(condx.sensor_id, []))
             if subject_msg:
                 total_true_alerts += 1
                 subject, msg = subject_msg
-                msg_count = 0  # tracks # of successful messages sent
-                for recip in condx.recipients.all():
-                    try:
-                        msg_count += recip.notify(subject, msg, condx.priority)
-                    except:
-                        logger.exception('Error notifying recipient %s of an alert.' % recip)
-                if msg_count:
-                    # at least one message was sent so update the field tracking the timestamp
-                    # of the last notification for this condition.
-                    condx.last_notified = time.time()
-                    condx.save()
+                condx.notify_recipients(subject, msg, dispatcher)
 
         except:
-            logger.exception('Error processing alert %s')
+            logger.exception('Error processing alert %s' % condx.pk)
+
+    dispatcher.send()
 
     return total_true_alerts
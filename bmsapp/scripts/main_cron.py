@@ -3,14 +3,24 @@ cron tasks.  It should be run using the django-extensions runscript facility:
 
     manage.py runscript main_cron
 
+The run_scheduler management command runs the same tasks from one long-running
+process and allows Periodic Scripts to run more often than every 5 minutes; use it
+instead of this script, not in addition to it.
+
+Tasks that can run for many minutes, such as building the hourly rollups, are run in
+a separate thread so they do not delay the tasks that run every 5 minutes.  The
+process does not exit until they finish.
 '''
 
 from datetime import datetime
 import time
+import threading
+import bmsapp.storereads
 from . import calc_readings
 from . import daily_status
 from . import backup_django_db
 from . import backup_readingdb
+from . import rebuild_rollups
 from . import check_alerts
 from . import run_periodic_scripts
 
@@ -23,6 +33,14 @@ def suppress_errors(func):
     except:
         return None
 
+def run_in_background(func):
+    '''Runs the function 'func' in a separate thread and suppresses all errors.
+    Returns the Thread object.
+    '''
+    thread = threading.Thread(target=suppress_errors, args=(func,), name=func.__module__)
+    thread.start()
+    return thread
+
 
 def run():
     '''The function executed by runscript.
@@ -44,6 +62,10 @@ def run():
     # which 5 minute period within in the hour, 0-11
     hr_div = int(now.minute / 5)
 
+    # store any readings left in the ingest spool, in case no web server process
+    # is running a spool writer.
+    suppress_errors(bmsapp.storereads.drain_spool)
+
     # run periodic scripts.  They all run on some multiple of five minutes.
     suppress_errors(run_periodic_scripts.run)
 
@@ -67,3 +89,8 @@ def run():
     # run the sensor reading database backup every 3 days
     if (yr_day % 3) == 0 and hr == 2 and hr_div == 6:
         suppress_errors(backup_readingdb.run)
+
+    # build any incomplete hourly rollups in the reading database each night.  This
+    # can take up to rebuild_rollups.MAX_RUN_SECS, so it runs in a separate thread.
+    if hr == 3 and hr_div == 0:
+        run_in_background(rebuild_rollups.run)
@@ -0,0 +1,50 @@
+"""Script to build the hourly rollups in the BMS sensor reading database for
+sensors whose rollups are not complete, such as sensors having readings from
+before the rollup tables were added.  First, rollup tables created with case
+sensitive IDs are recreated, and the sensors missing from the sensor
+statistics catalog and the latest reading table, such as after an upgrade, are added.
+This script is run via the
+django-extensions runscript facility:
+
+    manage.py runscript rebuild_rollups
+
+This script is also run from the main_cron.py script, in a separate thread.
+"""
+import time
+import logging
+import bmsapp.readingdb.bmsdata
+
+# Make a logger for this module
+_logger = logging.getLogger('bms.' + __name__)
+
+MAX_RUN_SECS = 1200    # stop starting new sensors after this many seconds; remaining sensors are built next run
+
+def run():
+    '''Method called by runscript.
+    '''
+    start = time.time()
+    db = bmsapp.readingdb.bmsdata.BMSdata()
+    built_ct = 0
+    try:
+        if db.upgrade_rollup_tables():
+            _logger.info('Recreated the rollup tables with case insensitive IDs.')
+
+        filled_ct = db.fill_summaries(MAX_RUN_SECS)
+        if filled_ct:
+            _logger.info('Added %s sensors to the summary tables in %.1f seconds.' % (filled_ct, time.time() - start))
+
+        for sensor_id in db.sensor_id_list():
+            if time.time() - start > MAX_RUN_SECS:
+                break
+            if db.rollups_built(sensor_id):
+                continue
+            try:
+                db.rebuild_rollups(sensor_id)
+                built_ct += 1
+            except:
+                _logger.exception('Error building rollups for %s' % sensor_id)
+    finally:
+        db.close()
+
+    if built_ct:
+        _logger.info('Built rollups for %s sensors in %.1f seconds.' % (built_ct, time.time() - start))
@@ -0,0 +1,17 @@
+"""Script to recalculate the catalog of sensor reading statistics and the table of
+latest readings in the BMS sensor reading database from the readings themselves.
+Use it if they are suspected to be out of date, for example after readings were
+edited outside of BMON.  Sensors missing from them, such as after an upgrade, are
+added by the rebuild_rollups script without a full rescan.
+This script is run via the django-extensions runscript facility:
+
+    manage.py runscript rescan_sensor_stats
+"""
+import bmsapp.readingdb.bmsdata
+
+def run():
+    '''Method called by runscript.
+    '''
+    db = bmsapp.readingdb.bmsdata.BMSdata()
+    db.rescan_sensor_stats()
+    db.close()
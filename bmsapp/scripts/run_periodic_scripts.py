@@ -10,16 +10,33 @@ for this application.  The script is run by:
     manage.py runscript run_periodic_scripts
 
 This script is also called from the main_cron.py script.
+
+The scripts that are due are run by a scheduler thread using a limited number of
+worker threads, and only a limited number of scripts using the same host run at once.
+A script is not started while it is still running from an earlier pass.  A script
+running longer than its timeout is abandoned so it no longer holds a worker; the
+timeout is the script's period unless a 'script_timeout' parameter, in seconds, is
+given in the Script Parameters.  The queue wait, execution time and any timeout of
+each script are recorded in its results.
+
+Each script is passed a ScriptState object in its 'script_state' parameter, which
+saves values for later runs of the script.  It is better suited to large values than
+the 'hidden' results, which are stored and parsed as one YAML document every run.
 '''
 
+import os
+import fcntl
+import pickle
 import logging
 import threading
 import time
 from datetime import datetime
-import random
+from urllib.parse import urlparse
 import importlib
 import traceback
 import yaml
+from django.conf import settings
+from django.db import close_old_connections
 import bmsapp.storereads
 import bmsapp.models
 
@@ -27,23 +44,201 @@ import bmsapp.models
 # time to run them.
 CRON_PERIOD = 300    # seconds
 
+# The default number of scripts run at once, and the default number of scripts using
+# the same host run at once.  The BMSAPP_PERIODIC_WORKERS and BMSAPP_PERIODIC_HOST_LIMIT
+# settings override these.
+WORKERS = 8
+HOST_LIMIT = 2
+
+# The directory holding the lock files that keep a script from running in two cron
+# passes at once.
+LOCK_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'readingdb', 'data', 'locks')
+
+# make a logger object
+logger = logging.getLogger('bms.run_periodic_scripts')
+
 def run():
     '''This method is called by the 'runscript' command and is the entry point for
     this module.
     '''
 
-    # make a logger object
-    logger = logging.getLogger('bms.run_periodic_scripts')
-
-    # Loop through all of the scripts to run.
-    # Use the same time for all of the scripts to determine if
-    # they should run or not.
+    # Find the scripts to run.  Use the same time for all of the scripts to determine
+    # if they should run or not.
     cron_time = time.time()
+    scripts = []
     for script in bmsapp.models.PeriodicScript.objects.all():
+        # skip disabled scripts and scripts for which it is not the correct time
+        if script.period == 0 or (cron_time % script.period) >= CRON_PERIOD:
+            continue
+        scripts.append(script)
+
+    if scripts:
+        Scheduler(scripts, cron_time).start()
+
+def script_params(script):
+    '''Returns the dictionary of parameters to pass to the models.PeriodicScript 'script'.
+    '''
+    # Assemble the parameter list to pass to the script.  It consists of the
+    # combination of the configuration parameters and saved results from the
+    # last run of the script.  Those sets of parameters are in YAML form.
+    # There are cases where the same parameter may appear in more than one of
+    # these locations.  The highest priority is the Script Parameters, next is
+    # visible Script Results, and last is Hidden script results.  This affects
+    # the order the parameters dictionary is built.
+    param_sources = (script.hidden_script_results,
+                     script.script_results,
+                     script.script_parameters)
+    params = {}
+
+    for param_src in param_sources:
+        new_params = yaml.load(param_src, Loader=yaml.FullLoader)
+        if type(new_params) == dict:
+            # Update only if there was a valid dictionary of hidden script results
+            params.update(new_params)
+
+    return params
+
+def script_host(script, params):
+    '''Returns the name of the host that the models.PeriodicScript 'script' with the
+    parameters 'params' gathers data from: the 'host' parameter, or the host in a URL
+    parameter, or else the script file name, for scripts using a fixed web service.
+    '''
+    if params.get('host'):
+        return str(params['host'])
+    for nm, val in sorted(params.items()):
+        if nm.endswith('url') and urlparse(str(val)).hostname:
+            return urlparse(str(val)).hostname
+    return script.script_file_name.split('.')[0]
+
+
+class ScriptState:
+    '''
+    Key-value store of the values a Periodic Script saves for its later runs.  The values
+    can be any Python objects that can be pickled.  Each value is read from or written to
+    the database when get() or set() is called for its key.
+    '''
+
+    def __init__(self, script):
+        """
+        :param script: the models.PeriodicScript object whose values are stored.
+        """
+        self.script = script
+
+    def get(self, key, default=None):
+        """Returns the value saved for 'key', or 'default' if there is none.
+        """
         try:
-            RunScript(script, cron_time).start()
-        except:
-            logger.exception('Error run %s Periodic Script.' % script.script_file_name)
+            state = bmsapp.models.PeriodicScriptState.objects.get(script=self.script, key=key)
+        except bmsapp.models.PeriodicScriptState.DoesNotExist:
+            return default
+        return pickle.loads(state.value)
+
+    def set(self, key, value):
+        """Saves 'value' for 'key', replacing any value saved before.
+        """
+        bmsapp.models.PeriodicScriptState.objects.update_or_create(script=self.script, key=key,
+                defaults={'value': pickle.dumps(value, pickle.HIGHEST_PROTOCOL)})
+
+    def delete(self, key):
+        """Deletes the value saved for 'key', if any.
+        """
+        bmsapp.models.PeriodicScriptState.objects.filter(script=self.script, key=key).delete()
+
+    def keys(self):
+        """Returns a list of the keys having saved values.
+        """
+        return list(bmsapp.models.PeriodicScriptState.objects.filter(script=self.script).values_list('key', flat=True))
+
+
+class Scheduler(threading.Thread):
+    '''
+    Runs a list of periodic scripts in worker threads, limiting the number of scripts
+    run at once and the number run at once for each host.  A persistent Scheduler keeps
+    running after its scripts are done, so more scripts can be added with add().
+    '''
+
+    def __init__(self, scripts=(), cron_time=None, persistent=False):
+        """
+        :param scripts: list of the models.PeriodicScript objects to run.
+        :param cron_time:  the UNIX epoch timestamp of the time when this batch of
+            scripts was initiated.
+        :param persistent:  if True, the Scheduler runs until the process ends, in a
+            daemon thread.
+        """
+        threading.Thread.__init__(self, name='periodic-scheduler', daemon=persistent)
+        self.persistent = persistent
+        self.workers = getattr(settings, 'BMSAPP_PERIODIC_WORKERS', WORKERS)
+        self.host_limit = getattr(settings, 'BMSAPP_PERIODIC_HOST_LIMIT', HOST_LIMIT)
+
+        # set by a script thread when it finishes, and when scripts are added
+        self.script_done = threading.Event()
+
+        # the RunScript objects not yet started
+        self.queue_lock = threading.Lock()
+        self.queue = []
+        self.add(scripts, cron_time)
+
+    def add(self, scripts, cron_time=None):
+        """Queues the models.PeriodicScript objects in the list 'scripts' to run.
+        'cron_time' is the UNIX timestamp when they were due to run.  A script that is
+        already waiting in the queue is not queued again.
+        """
+        cron_time = cron_time or time.time()
+        with self.queue_lock:
+            queued_ids = set(job.script.pk for job in self.queue)
+            for script in scripts:
+                if script.pk not in queued_ids:
+                    self.queue.append(RunScript(script, cron_time, self.script_done))
+        self.script_done.set()
+
+    def run(self):
+        """Starts the scripts as workers and hosts become available, and abandons scripts
+        that run past their timeout.
+        """
+        running = []
+        host_counts = {}
+        run_ct = 0
+        timed_out_ct = 0
+        skipped_ct = 0
+
+        while self.persistent or self.queue or running:
+            now = time.time()
+
+            # remove the finished scripts, and abandon those past their timeout.
+            for job in list(running):
+                if job.is_alive() and now < job.start_time + job.timeout:
+                    continue
+                if job.is_alive():
+                    job.abandon()
+                    timed_out_ct += 1
+                running.remove(job)
+                host_counts[job.host] -= 1
+
+            # start queued scripts, in order, while workers are free, skipping scripts
+            # whose host is busy.
+            with self.queue_lock:
+                for job in list(self.queue):
+                    if len(running) >= self.workers:
+                        break
+                    if host_counts.get(job.host, 0) >= self.host_limit:
+                        continue
+                    self.queue.remove(job)
+                    if job.lock():
+                        job.queue_wait = now - job.cron_time
+                        job.start()
+                        running.append(job)
+                        host_counts[job.host] = host_counts.get(job.host, 0) + 1
+                        run_ct += 1
+                    else:
+                        logger.warning('%s Periodic Script is still running from an earlier pass, so it was not started.' % job.script.script_file_name)
+                        skipped_ct += 1
+
+            self.script_done.wait(1.0)
+            self.script_done.clear()
+
+        if timed_out_ct or skipped_ct:
+            logger.info('%s Periodic Scripts run, %s timed out, %s not started as still running.' %
+                        (run_ct, timed_out_ct, skipped_ct))
 
 
 class RunScript(threading.Thread):
@@ -51,38 +246,81 @@ class RunScript(threading.Thread):
     This class will run one periodic script in a separate thread.
     '''
 
-    def __init__(self, script, cron_time=time.time()):
+    def __init__(self, script, cron_time=time.time(), done_event=None):
         """
         :param script: the models.PeriodicScript object containing info about the
             script to run.
         :param cron_time:  the UNIX epoch timestamp of the time when this batch of
-            scripts was initiated.  This time is used to determine whether it is the
-            proper time to run the script.
+            scripts was initiated.
+        :param done_event:  an optional threading.Event set when the script finishes.
         """
-        threading.Thread.__init__(self)
+        # A daemon thread, so a script abandoned after its timeout does not keep the
+        # process running.
+        threading.Thread.__init__(self, daemon=True)
         self.script = script
         self.cron_time = cron_time
+        self.done_event = done_event
 
-    def run(self):
-        """This function is run in a new thread and runs the desired script if the time is correct
-        """
+        # The parameters are needed to find the host and timeout.  If they cannot be
+        # read, the error is recorded when the script is run.
+        try:
+            self.params = script_params(script)
+        except:
+            self.params = None
+        params = self.params or {}
+        self.host = script_host(script, params)
+        try:
+            self.timeout = float(params.get('script_timeout', script.period))
+        except:
+            self.timeout = float(script.period)
 
-        # check to see if script is disabled, and exit if so.
-        if self.script.period == 0:
-            return
+        self.queue_wait = 0.0      # seconds from the start of the pass to the start of the script
+        self.start_time = None
+        self.timed_out = False
+        self.lock_file = None
 
-        if (self.cron_time % self.script.period) >= CRON_PERIOD:
-            # Not the correct time to run script, so exit.
-            return
+    def lock(self):
+        """Obtains the lock that keeps this script from running more than once at the
+        same time, in this or another process.  Returns False if the lock is held by
+        another run of the script.  The lock is released when the script finishes.
+        """
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        f = open(os.path.join(LOCK_DIR, 'script_%s.lock' % self.script.pk), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self.lock_file = f
+        return True
 
-        # in order to minimize coincident requests on resources due to multiple scripts
-        # starting at the same time, introduce a random delay, up to 10 seconds.
-        time.sleep(random.random() * 10.0)
+    def start(self):
+        self.start_time = time.time()
+        threading.Thread.start(self)
 
+    def abandon(self):
+        """Records that the script has run past its timeout.  The script thread cannot
+        be stopped; if it finishes later, its results are saved then.
+        """
+        self.timed_out = True
+        logger.error('%s Periodic Script timed out after %s seconds.' % (self.script.script_file_name, self.timeout))
+        try:
+            results = {'script_start_time': datetime.utcfromtimestamp(self.start_time).strftime("%Y-%m-%d %H:%M:%S UTC"),
+                       'script_queue_wait': round(self.queue_wait, 2),
+                       'script_error': 'Script timed out after %s seconds.' % self.timeout}
+            self.script.script_results = yaml.dump(results, default_flow_style=False)
+            bmsapp.models.PeriodicScript.objects.filter(pk=self.script.pk).update(script_results=self.script.script_results)
+        except:
+            logger.exception('Error recording the timeout of %s.' % self.script.script_file_name)
+
+    def run(self):
+        """This function is run in a new thread and runs the desired script.
+        """
         try:
             # Start a dictionary that holds info about this script run and the
             # results of the script.
-            results ={'script_start_time': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")}
+            results ={'script_start_time': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC"),
+                      'script_queue_wait': round(self.queue_wait, 2)}
 
             # Start a dictionary that holds results that are not shown in the Admin interface.
             hidden_results = {}
@@ -92,23 +330,9 @@ class RunScript(threading.Thread):
             script_mod_base = self.script.script_file_name.split('.')[0]
             logger = logging.getLogger('bms.run_periodic_scripts.' + script_mod_base)
 
-            # Assemble the parameter list to pass to the script.  It consists of the
-            # combination of the configuration parameters and saved results from the
-            # last run of the script.  Those sets of parameters are in YAML form.
-            # There are cases where the same parameter may appear in more than one of
-            # these locations.  The highest priority is the Script Parameters, next is
-            # visible Script Results, and last is Hidden script results.  This affects
-            # the order the parameters dictionary is built.
-            param_sources = (self.script.hidden_script_results,
-                             self.script.script_results,
-                             self.script.script_parameters)
-            params = {}
-
-            for param_src in param_sources:
-                new_params = yaml.load(param_src, Loader=yaml.FullLoader)
-                if type(new_params) == dict:
-                    # Update only if there was a valid dictionary of hidden script results
-                    params.update(new_params)
+            # The parameters to pass to the script.
+            params = self.params if self.params is not None else script_params(self.script)
+            params['script_state'] = ScriptState(self.script)
 
             # import the periodic script module, but first strip off any extension that
             # the user may have appended
@@ -159,10 +383,18 @@ class RunScript(threading.Thread):
             results['script_error'] = traceback.format_exc()
 
         finally:
+            if self.timed_out:
+                results['script_timed_out'] = True
+
             # Store the results back into the model script object so they are
             # viewable in the Admin interface and are available for the next call.
-            self.script.script_results = yaml.dump(results, default_flow_style=False)
-            self.script.hidden_script_results = yaml.dump(hidden_results, default_flow_style=False)
-            self.script.save()
-
-
+            try:
+                self.script.script_results = yaml.dump(results, default_flow_style=False)
+                self.script.hidden_script_results = yaml.dump(hidden_results, default_flow_style=False)
+                self.script.save()
+            finally:
+                if self.lock_file:
+                    self.lock_file.close()    # releases the lock
+                close_old_connections()
+                if self.done_event:
+                    self.done_event.set()
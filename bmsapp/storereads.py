@@ -4,12 +4,20 @@ Module used to store incoming sensor readings in the database.
 
 import dateutil.parser
 import calendar
+import os
+import sqlite3
 import re
 import time
 import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, DatabaseError
 
 from . import models
+from . import ingest_alerts
 from .readingdb import bmsdata
+from .readingdb import spool
 from .calcs import transforms
 
 # Make a logger for this module
@@ -25,18 +33,24 @@ def convert_val(ts, reading_id, val, db):
     transformed by the transform function.
     """
 
-    # get the Sensor object, if available, to see if there is a transform function
-    sensors = models.Sensor.objects.filter( sensor_id=reading_id )
-    if len(sensors)>0:
-        # Take first sensor in list ( should be only one ) and get transform function & parameters
-        transform_func = sensors[0].tran_calc_function
-        transform_params = sensors[0].function_parameters
-    else:
-        # no sensor with the requested ID was found.  Therefore, no transform function and parameters.
-        transform_func = ''
-        transform_params = ''
+    # get the transform function & parameters for the sensor, if available.  These
+    # are cached so that the Sensor object is not queried for every reading.
+    transform_func, transform_params = transforms.get_transform(reading_id)
 
     # If val is a string, decode it into a float value
+    val = decode_val(val)
+
+    # if there is a transform function passed, use it to convert the reading values
+    if len(transform_func.strip()):
+        trans = transforms.Transformer(db)
+        ts, reading_id, val = trans.transform_parsed(ts, reading_id, val, transform_func, transform_params)
+
+    return ts, reading_id, val
+
+def decode_val(val):
+    """If 'val' is a string, it is decoded into a float value and returned.
+    Other values are returned unchanged.
+    """
     if type(val) in (str, str):
         if ('True' in val) or ('Closed' in val) or ('On' in val) or (val.startswith('Motion') or (val.startswith('Light')) or (val.startswith('Voltage'))):
             val = 1.0
@@ -47,10 +61,73 @@ def convert_val(ts, reading_id, val, db):
             parts = re.match(r'(-?\d+)\.?(\d+)?', val).groups('0')
             val = float( parts[0] + '.' + parts[1] )
 
-    # if there is a transform function passed, use it to convert the reading values
-    if len(transform_func.strip()):
-        trans = transforms.Transformer(db)
-        ts, reading_id, val = trans.transform_value(ts, reading_id, val, transform_func, transform_params)
+    return val
+
+def convert_many(recs, db):
+    """Converts a list of raw (ts, reading_id, val) readings into a form suitable
+    for storage in the reading database.  This does the same conversion as convert_val(),
+    but the readings are grouped by reading_id and each sensor's transform function
+    is applied to all of its readings in one batch.  'db' is a bmsdata.BMSdata reading
+    database object.
+    Returns three lists: timestamps, reading IDs, and values.
+    """
+    # group the decoded readings by ID, keeping the order of arrival.
+    by_id = {}
+    for ts, reading_id, val in recs:
+        try:
+            val = decode_val(val)
+            if val is not None:
+                by_id.setdefault(reading_id, ([], []))
+                by_id[reading_id][0].append(ts)
+                by_id[reading_id][1].append(val)
+        except Exception as e:
+            _logger.exception('Error storing %s, %s, %s' % (ts, reading_id, val))
+
+    ts_lst = []
+    reading_id_lst = []
+    val_lst = []
+    trans = transforms.Transformer(db)
+    for reading_id, (stamps, vals) in by_id.items():
+        try:
+            transform_func, transform_params = transforms.get_transform(reading_id)
+        except DatabaseError:
+            # Not caught, so that the readings are not lost if the Django database is
+            # unavailable.
+            raise
+        except Exception as e:
+            # a problem with the Sensor, such as bad YAML parameters, only rejects the
+            # readings of that sensor.
+            _logger.exception('Error getting the transform for %s; %s readings rejected' % (reading_id, len(stamps)))
+            continue
+        try:
+            if len(transform_func.strip()):
+                stamps, ids, vals = trans.transform_batch(reading_id, stamps, vals, transform_func, transform_params)
+                stamps = stamps.tolist()
+                vals = vals.tolist()
+            else:
+                ids = [reading_id] * len(stamps)
+            ts_lst += stamps
+            reading_id_lst += ids
+            val_lst += vals
+        except Exception as e:
+            _logger.exception('Error storing %s readings for %s' % (len(stamps), reading_id))
+
+    return ts_lst, reading_id_lst, val_lst
+
+def parse_reading(reading_id, request_data):
+    """Returns the raw (ts, reading_id, val) reading described by 'reading_id' and 
+    'request_data'; see store() for the contents of 'request_data'.
+    """
+    # parse the date into a datetime object and then into Unix seconds. Convert to
+    # integer.
+    if 'ts' in request_data:
+        ts = int( calendar.timegm(dateutil.parser.parse(request_data['ts']).timetuple()) )
+    else:
+        # no timestamp in query parameters, so assume the timestamp is now.
+        ts = int(time.time())
+
+    # Get the value from the request
+    val = request_data['val']
 
     return ts, reading_id, val
 
@@ -67,20 +144,9 @@ def store(reading_id, request_data):
 
     # open the database 
     db = bmsdata.BMSdata()
-    
-    # parse the date into a datetime object and then into Unix seconds. Convert to
-    # integer.
-    if 'ts' in request_data:
-        ts = int( calendar.timegm(dateutil.parser.parse(request_data['ts']).timetuple()) )
-    else:
-        # no timestamp in query parameters, so assume the timestamp is now.
-        ts = int(time.time())
-
-    # Get the value from the request
-    val = request_data['val']
 
     # Convert/transform the fields for storage.
-    ts, reading_id, val = convert_val(ts, reading_id, val, db)
+    ts, reading_id, val = convert_val(*parse_reading(reading_id, request_data), db)
     
     # The transformed value could be None, but the database insert method
     # will ignore it.
@@ -90,21 +156,47 @@ def store(reading_id, request_data):
 
 def store_many(req_data):
     """Stores a list of readings into the database.  'req_data' is a dictionary
-    holding the reading information.  Currently, the 'format' item in 'req_data'
-    determines the format of the data:
+    holding the reading information; see parse_many() for the formats supported.
+    Returns the message returned by the database insert method.
+    """
+    return store_recs(parse_many(req_data))
+
+def store_recs(recs):
+    """Converts/transforms the list of raw (ts, reading_id, val) readings 'recs' and
+    stores them in the reading database.  If the BMSAPP_INGEST_ALERTS setting is True,
+    the Alert conditions of the sensors are then checked.  Returns the message returned
+    by the database insert method.
+    """
+    # open the reading database 
+    db = bmsdata.BMSdata()
+
+    # Convert/transform the readings for storage, one batch per sensor.
+    ts_lst, reading_id_lst, val_lst = convert_many(recs, db)
+
+    # insert the readings into the database
+    msg = db.insert_reading(ts_lst, reading_id_lst, val_lst)
+
+    if ingest_alerts.enabled():
+        try:
+            ingest_alerts.readings_stored(db, ts_lst, reading_id_lst, val_lst)
+        except:
+            _logger.exception('Error checking alerts for stored readings.')
+    db.close()
+
+    return msg
+
+def parse_many(req_data):
+    """Returns a list of raw (ts, reading_id, val) readings from 'req_data', a
+    dictionary holding the reading information.  Currently, the 'format' item in
+    'req_data' determines the format of the data:
 
     'format' key not present: Format used by the Mini-Monitor
     'format' = 'monnit': format used by Webhooks generated by the iMonnit
     server used by Monnit wireless sensors.
     'format' = 'particle': format used by Webhook calls generated by Particle
     Photon and Electron devices.
-
-    Returns the message returned by the database insert method.
     """
 
-    # open the reading database 
-    db = bmsdata.BMSdata()
-
     ts_lst = []
     reading_id_lst = []
     val_lst = []
@@ -116,15 +208,13 @@ def store_many(req_data):
         #     1:  Unix timestamp of the reading.
         #         If None, the current time is substituted.
         #     2:  The reading id.
-        #     3:  The reading value.  convert_val() is used to convert/transform
+        #     3:  The reading value.  convert_many() is used to convert/transform
         #         the value before storage.
 
         for ts, reading_id, val in req_data['readings']:
             try:
                 ts = int(ts) if ts is not None else int(time.time())
 
-                # Convert/transform the fields for storage.
-                ts, reading_id, val = convert_val(ts, reading_id, val, db)
                 ts_lst.append(ts)
                 reading_id_lst.append(reading_id)
                 val_lst.append(val)  # could be None, but insert_reading() will ignore it
@@ -148,9 +238,6 @@ def store_many(req_data):
 
                     reading_id = reading['sensorID']
 
-                    # apply any requested conversions
-                    ts, reading_id, val = convert_val(ts, reading_id, val, db)
-
                     ts_lst.append(ts)
                     val_lst.append(val)
                     reading_id_lst.append(reading_id)
@@ -214,8 +301,6 @@ def store_many(req_data):
                     ts = ts_base
                     val = float(val)
 
-                # Convert/transform the fields for storage.
-                ts, reading_id, val = convert_val(ts, reading_id, val, db)
                 ts_lst.append(ts)
                 reading_id_lst.append(reading_id)
                 val_lst.append(val)  # could be None, but insert_reading() will ignore it
@@ -223,8 +308,58 @@ def store_many(req_data):
             except Exception as e:
                 _logger.exception('Error storing %s, %s' % (reading_id, val))
 
-    # insert the readings into the database
-    msg = db.insert_reading(ts_lst, reading_id_lst, val_lst)
-    db.close()
+    return list(zip(ts_lst, reading_id_lst, val_lst))
 
-    return msg
+def spool_recs(recs):
+    """Queues the list of raw (ts, reading_id, val) readings 'recs' for storage in the
+    reading database and returns a message right away.  The readings are appended to
+    the ingest spool and stored by a background writer thread, unless the
+    BMSAPP_SPOOL_READINGS setting is False or the spool cannot be written; in those
+    cases, the readings are stored before returning.
+    """
+    if getattr(settings, 'BMSAPP_SPOOL_READINGS', True):
+        try:
+            spool.append(recs)
+            start_spool_writer()
+            return '%s readings stored successfully, queued for the database.' % len(recs)
+        except:
+            _logger.exception('Error spooling readings; storing them directly.')
+
+    return store_recs(recs)
+
+def drain_spool():
+    """Stores the readings waiting in the ingest spool in the reading database.
+    Returns the number of readings drained.  Errors of the reading database or the
+    Django database, such as a locked database, never cause a segment to be set aside.
+    """
+    try:
+        return spool.drain(store_recs, transient_errors=(sqlite3.OperationalError, DatabaseError))
+    finally:
+        # this can run in a long-lived thread, so don't hold Django database connections.
+        close_old_connections()
+
+# seconds between passes of the spool writer thread
+SPOOL_WRITER_SECS = 2.0
+
+_writer_lock = threading.Lock()
+_writer_pid = None    # the process that started the spool writer thread
+
+def _spool_writer():
+    """Drains the ingest spool every few seconds.  Runs in a daemon thread.
+    """
+    while True:
+        try:
+            drain_spool()
+        except:
+            _logger.exception('Error draining the ingest spool.')
+        time.sleep(SPOOL_WRITER_SECS)
+
+def start_spool_writer():
+    """Starts the thread that drains the ingest spool, if it is not already running
+    in this process.
+    """
+    global _writer_pid
+    with _writer_lock:
+        if _writer_pid != os.getpid():
+            _writer_pid = os.getpid()
+            threading.Thread(target=_spool_writer, name='spool-writer', daemon=True).start()
@@ -0,0 +1,128 @@
+'''Tests of the sensor reading database, bmsapp.readingdb.bmsdata.  Run with:
+
+    manage.py test bmsapp.tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bmsapp.readingdb import bmsdata
+
+
+class BMSdataTestCase(unittest.TestCase):
+    '''Gives each test a new, empty reading database in 'self.db'.
+    '''
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db = bmsdata.BMSdata(os.path.join(self.db_dir, 'test.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+
+class MixedCaseIDTests(BMSdataTestCase):
+    '''SQLite table names are case insensitive, so readings posted with IDs differing
+    only in case are stored in the same table.
+    '''
+
+    def test_summary_ids_unchanged(self):
+        self.db.insert_reading([100, 200], ['abc', 'abc'], [1.0, 2.0])
+        self.db.insert_reading([300], ['ABC'], [3.0])
+        self.db.insert_reading([400], ['Abc'], [4.0])
+
+        self.assertEqual(self.db.sensor_id_list(), ['abc'])
+        self.assertEqual(list(self.db.sensor_stats()), ['abc'])
+        self.assertEqual(self.db.sensor_stats()['abc']['count'], 4)
+        self.assertEqual(self.db.sensor_stats(['ABC'])['ABC']['last_ts'], 400)
+        self.assertEqual(self.db.last_reads(), {'abc': {'ts': 400, 'val': 4.0}})
+        self.assertEqual(self.db.last_read('aBc'), {'ts': 400, 'val': 4.0})
+
+    def test_rescan_ids_unchanged(self):
+        self.db.insert_reading([100], ['abc'], [1.0])
+        self.db.rescan_sensor_stats(['ABC'])
+        self.assertEqual(list(self.db.sensor_stats()), ['abc'])
+        self.assertEqual(list(self.db.last_reads()), ['abc'])
+
+    def test_rollup_ids(self):
+        self.db.insert_reading([7200, 7300], ['abc', 'abc'], [1.0, 2.0])
+        self.db.insert_reading([7400], ['ABC'], [3.0])
+        for sensor_id in ('abc', 'ABC'):
+            df = self.db.rollupDataframeForOneID(sensor_id)
+            self.assertEqual(df['count'].tolist(), [3])
+            self.assertEqual(df['sum'].tolist(), [6.0])
+
+        self.db.rebuild_rollups('aBC')
+        self.assertEqual(self.db.rollupDataframeForOneID('abc')['count'].tolist(), [3])
+
+    def test_upgrade_rollup_tables(self):
+        # rollup tables as created by an earlier version, with case sensitive IDs, and
+        # stale rollups for 'abc' stored under a second case of the ID.
+        self.db.insert_reading([7200, 7300], ['abc', 'xyz'], [1.0, 2.0])
+        self.db.cursor.execute('DROP TABLE [_rollup_hourly]')
+        self.db.cursor.execute('DROP TABLE [_rollup_built]')
+        self.db.cursor.execute('''CREATE TABLE [_rollup_hourly] (id varchar(50), ts integer,
+                                  count integer, sum real, ts_sum integer, min real, max real,
+                                  first real, last real, primary key (id, ts)) WITHOUT ROWID''')
+        self.db.cursor.execute('CREATE TABLE [_rollup_built] (id varchar(50) primary key)')
+        self.db.cursor.executemany('INSERT INTO [_rollup_hourly] VALUES (?, 7200, 1, ?, 7200, ?, ?, ?, ?)',
+                                   [(sensor_id, val, val, val, val, val) for sensor_id, val in
+                                    (('abc', 1.0), ('ABC', 5.0), ('xyz', 2.0))])
+        self.db.cursor.executemany('INSERT INTO [_rollup_built] VALUES (?)', [('abc',), ('xyz',)])
+        self.db.conn.commit()
+
+        self.assertTrue(self.db.upgrade_rollup_tables())
+        self.assertFalse(self.db.upgrade_rollup_tables())
+        self.assertFalse(self.db.rollups_built('abc'))
+        self.assertIsNone(self.db.rollupDataframeForOneID('abc'))
+        self.assertEqual(self.db.rollupDataframeForOneID('XYZ')['sum'].tolist(), [2.0])
+
+        self.db.rebuild_rollups('abc')
+        self.assertEqual(self.db.rollupDataframeForOneID('ABC')['sum'].tolist(), [1.0])
+
+
+class BulkInsertTests(BMSdataTestCase):
+    '''insert_readings_bulk() stores all or none of the readings of each sensor.
+    '''
+
+    def test_failed_sensor_rolled_back(self):
+        self.db.insert_reading([100], ['bad'], [1.0])
+        # reject the third reading of the batch, after two have been written
+        self.db.cursor.execute("""CREATE TRIGGER reject_reading BEFORE INSERT ON [bad]
+                                  WHEN NEW.ts >= 400 BEGIN SELECT RAISE(ABORT, 'rejected'); END""")
+        self.db.conn.commit()
+        self.db.defer_last_raw('bad', 400, 10.0)
+
+        counts = self.db.insert_readings_bulk([(200, 'good', 1.0), (300, 'good', 2.0),
+                                               (200, 'bad', 2.0), (300, 'bad', 3.0), (400, 'bad', 4.0)])
+        self.assertEqual(counts, {'good': [2, 0], 'bad': [0, 3]})
+        self.assertEqual([r['ts'] for r in self.db.rowsForOneID('good')], [200, 300])
+        self.assertEqual([r['ts'] for r in self.db.rowsForOneID('bad')], [100])
+        self.assertEqual(self.db.sensor_stats(['bad'])['bad']['count'], 1)
+        self.assertEqual(self.db.last_read('bad'), {'ts': 100, 'val': 1.0})
+        self.assertEqual(self.db.last_raw('bad'), (None, None))
+        self.assertFalse(self.db.conn.in_transaction)
+
+    def test_failed_new_sensor_removed(self):
+        stats_after_insert = self.db._stats_after_insert
+
+        def fail_new(sensor_id, recs):
+            if sensor_id == 'new':
+                raise ValueError('failed')
+            return stats_after_insert(sensor_id, recs)
+
+        with mock.patch.object(self.db, '_stats_after_insert', side_effect=fail_new):
+            counts = self.db.insert_readings_bulk([(100, 'new', 1.0), (200, 'new', 2.0), (100, 'other', 3.0)])
+        self.assertEqual(counts, {'new': [0, 2], 'other': [1, 0]})
+        self.assertFalse(self.db.sensor_id_exists('new'))
+        self.assertEqual(self.db.sensor_id_list(), ['other'])
+        self.assertEqual(list(self.db.sensor_stats()), ['other'])
+        self.assertFalse(self.db.rollups_built('new'))
+
+        # the sensor's readings can be stored later
+        self.assertEqual(self.db.insert_readings_bulk([(100, 'new', 1.0)]), {'new': [1, 0]})
+        self.assertEqual(self.db.rowsForOneID('new'), [{'ts': 100, 'val': 1.0}])
@@ -0,0 +1,67 @@
+'''Tests of the calculated reading functions in bmsapp.calcs.calcfuncs01.  Run with:
+
+    manage.py test bmsapp.tests
+'''
+
+import unittest
+
+import numpy as np
+
+from bmsapp.calcs import calcfuncs01
+
+# the timestamp of the first test reading, at the start of a 10 minute interval
+T = 1500000000
+
+
+def sampled_means(ts, vals, interval_seconds):
+    '''Returns the averages found by _interval_means(), calculated by sampling the step
+    function every second.
+    '''
+    seconds = np.arange(ts[0], ts[-1] + 1)
+    samples = np.array(vals, dtype=np.float64)[np.searchsorted(ts, seconds, side='right') - 1]
+    for i in range(1, len(samples)):
+        if np.isnan(samples[i]):
+            samples[i] = samples[i - 1]
+    starts = np.arange(ts[0] // interval_seconds, ts[-1] // interval_seconds + 1) * interval_seconds
+    means = []
+    for start in starts:
+        in_interval = samples[(seconds >= start) & (seconds < start + interval_seconds)]
+        in_interval = in_interval[~np.isnan(in_interval)]
+        means.append(in_interval.mean() if len(in_interval) else np.nan)
+    return starts + interval_seconds / 2, np.array(means)
+
+
+class IntervalMeansTests(unittest.TestCase):
+
+    def assert_matches_sampled(self, ts, vals, interval_seconds):
+        mid_ts, means = calcfuncs01._interval_means(ts, vals, interval_seconds)
+        expected_ts, expected = sampled_means(ts, vals, interval_seconds)
+        np.testing.assert_array_equal(mid_ts, expected_ts)
+        np.testing.assert_allclose(means, expected)
+
+    def test_step_function(self):
+        # On for the first 150 seconds, off for 300, then on to the end of the interval
+        mid_ts, means = calcfuncs01._interval_means([T, T + 150, T + 450, T + 600], [1, 0, 1, 1], 600)
+        np.testing.assert_array_equal(mid_ts, [T + 300, T + 900])
+        np.testing.assert_allclose(means, [0.5, 1.0])
+
+    def test_matches_sampled(self):
+        ts = [T + 17, T + 40, T + 41, T + 700, T + 1300, T + 1310, T + 3000]
+        vals = [2.0, -1.0, 5.0, 3.5, 0.0, 7.0, 4.0]
+        for interval_seconds in (60, 600, 3600):
+            self.assert_matches_sampled(ts, vals, interval_seconds)
+
+    def test_nan_values(self):
+        # a NaN value holds the prior value; leading NaN values are not averaged
+        ts = [T, T + 400, T + 700, T + 900]
+        vals = [np.nan, 2.0, np.nan, 6.0]
+        mid_ts, means = calcfuncs01._interval_means(ts, vals, 300)
+        self.assertTrue(np.isnan(means[0]))
+        np.testing.assert_allclose(means[1:], [2.0, 2.0, 6.0])
+        self.assert_matches_sampled(ts, vals, 300)
+        self.assert_matches_sampled(ts, vals, 1000)
+
+    def test_one_reading(self):
+        mid_ts, means = calcfuncs01._interval_means([T + 10], [3.0], 600)
+        np.testing.assert_array_equal(mid_ts, [T + 300])
+        np.testing.assert_allclose(means, [3.0])
@@ -0,0 +1,84 @@
+'''Tests of the run_scheduler management command.  Run with:
+
+    manage.py test bmsapp.tests
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from bmsapp.management.commands import run_scheduler
+
+# UTC midnight, 2017-07-14
+MIDNIGHT = 1499990400
+
+
+class NextRunTimeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/Anchorage'
+        time.tzset()
+
+    def tearDown(self):
+        if self.orig_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.orig_tz
+        time.tzset()
+
+    def test_utc(self):
+        next_run = run_scheduler.next_run_time
+        self.assertEqual(next_run(300, 0, MIDNIGHT, local=False), MIDNIGHT + 300)
+        self.assertEqual(next_run(300, 0, MIDNIGHT + 299, local=False), MIDNIGHT + 300)
+        self.assertEqual(next_run(1800, 900, MIDNIGHT, local=False), MIDNIGHT + 900)
+        self.assertEqual(next_run(1800, 900, MIDNIGHT + 900, local=False), MIDNIGHT + 2700)
+        self.assertEqual(next_run(86400, 10800, MIDNIGHT + 10800, local=False), MIDNIGHT + 97200)
+        self.assertEqual(next_run(3 * 86400, 9000, MIDNIGHT, local=False) % (3 * 86400), 9000)
+
+    def test_local(self):
+        # 3:00 am in Alaska, which is 8 hours behind UTC in July
+        run_time = run_scheduler.next_run_time(86400, 10800, MIDNIGHT)
+        self.assertEqual(run_time, MIDNIGHT + 11 * 3600)
+        self.assertEqual(datetime.fromtimestamp(run_time).hour, 3)
+        self.assertEqual(run_scheduler.next_run_time(86400, 10800, run_time), run_time + 86400)
+
+    def test_local_dst_change(self):
+        next_run = run_scheduler.next_run_time
+
+        # 3:00 am on the days of the changes to standard time and to daylight saving time
+        for day in (datetime(2017, 11, 5), datetime(2018, 3, 11)):
+            after = day.replace(hour=0, minute=30).timestamp()
+            self.assertEqual(datetime.fromtimestamp(next_run(86400, 10800, after)), day.replace(hour=3))
+
+        # every 5 minutes across the changes, which happen at 2:00 am local time
+        for change in (datetime(2017, 11, 5, 1, 0).timestamp() + 3600, datetime(2018, 3, 11, 2, 0).timestamp()):
+            self.assertEqual(next_run(300, 0, change - 120), change)
+            self.assertEqual(next_run(300, 0, change), change + 300)
+
+
+class TaskStartsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(run_scheduler, 'STATE_FILE', os.path.join(self.state_dir, 'data', 'state.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_save_and_load(self):
+        self.assertEqual(run_scheduler.load_task_starts(), {})
+        run_scheduler.save_task_starts({'check_alerts': MIDNIGHT + 60.5})
+        self.assertEqual(run_scheduler.load_task_starts(), {'check_alerts': MIDNIGHT + 60.5})
+
+    def test_unreadable_file(self):
+        os.makedirs(os.path.dirname(run_scheduler.STATE_FILE))
+        with open(run_scheduler.STATE_FILE, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(run_scheduler.load_task_starts(), {})
@@ -0,0 +1,107 @@
+'''Tests of the ingest spool, bmsapp.readingdb.spool.  Run with:
+
+    manage.py test bmsapp.tests
+'''
+
+import os
+import json
+import time
+import sqlite3
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bmsapp.readingdb import spool
+
+
+class SpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def add_segment(self, periods_ago, recs):
+        '''Writes a closed segment holding the readings 'recs', from 'periods_ago' segment
+        periods in the past.  Returns the segment file name.
+        '''
+        fname = os.path.join(self.spool_dir, '%012d-1.seg' % (self.now // spool.SEGMENT_SECS - periods_ago))
+        with open(fname, 'w') as f:
+            f.write(json.dumps(recs) + '\n')
+        return fname
+
+    def files(self):
+        return sorted(fn for fn in os.listdir(self.spool_dir) if fn.endswith(('.seg', '.bad')))
+
+    def test_append_and_drain(self):
+        spool.append([(self.now, 'a', 1.0), (self.now, 'b', 2.0)], self.spool_dir)
+        self.assertEqual(spool.pending_segments(self.spool_dir), 1)
+
+        # the open segment is not drained
+        stored = []
+        self.assertEqual(spool.drain(stored.extend, self.spool_dir), 0)
+
+        with mock.patch('time.time', return_value=self.now + 3 * spool.SEGMENT_SECS):
+            self.assertEqual(spool.drain(stored.extend, self.spool_dir), 2)
+        self.assertEqual(stored, [[self.now, 'a', 1.0], [self.now, 'b', 2.0]])
+        self.assertEqual(self.files(), [])
+
+    def test_bad_line_skipped(self):
+        fname = self.add_segment(10, [[self.now, 'a', 1.0]])
+        with open(fname, 'a') as f:
+            f.write('[[1, "b", ')
+        stored = []
+        self.assertEqual(spool.drain(stored.extend, self.spool_dir), 1)
+        self.assertEqual(stored, [[self.now, 'a', 1.0]])
+
+    def test_failing_segment_kept(self):
+        self.add_segment(10, [[self.now, 'good', 1.0]])
+        bad_name = self.add_segment(9, [[self.now, 'bad', 1.0]])
+        self.add_segment(8, [[self.now, 'later', 1.0]])
+        stored = []
+        def store(recs):
+            if any(rec[1] == 'bad' for rec in recs):
+                raise ValueError('bad reading')
+            stored.extend(recs)
+
+        # the segments before the failing one are stored; draining stops at it.
+        self.assertEqual(spool.drain(store, self.spool_dir), 1)
+        self.assertEqual(stored, [[self.now, 'good', 1.0]])
+        self.assertEqual(self.files(), [os.path.basename(bad_name), '%012d-1.seg' % (self.now // spool.SEGMENT_SECS - 8)])
+
+    def test_set_aside_after_failures_and_time(self):
+        bad_name = self.add_segment(9, [[self.now, 'bad', 1.0]])
+        self.add_segment(8, [[self.now, 'later', 1.0]])
+        stored = []
+        def store(recs):
+            if any(rec[1] == 'bad' for rec in recs):
+                raise ValueError('bad reading')
+            stored.extend(recs)
+
+        # many quick failures do not set the segment aside
+        for i in range(spool.MAX_FAILURES + 2):
+            spool.drain(store, self.spool_dir)
+        self.assertIn(os.path.basename(bad_name), self.files())
+        self.assertEqual(stored, [])
+
+        # once the failures span SET_ASIDE_SECS, it is set aside and draining goes on
+        with mock.patch('time.time', return_value=self.now + spool.SET_ASIDE_SECS + 1):
+            self.assertEqual(spool.drain(store, self.spool_dir), 1)
+        self.assertEqual(self.files(), [os.path.basename(bad_name)[:-4] + '.bad'])
+        self.assertEqual(stored, [[self.now, 'later', 1.0]])
+
+    def test_transient_errors_not_counted(self):
+        busy_name = self.add_segment(9, [[self.now, 'a', 1.0]])
+        class BusyError(Exception):
+            pass
+        def store(recs):
+            raise BusyError('database is locked')
+
+        for i in range(spool.MAX_FAILURES + 2):
+            spool.drain(store, self.spool_dir, transient_errors=(sqlite3.OperationalError, BusyError))
+        with mock.patch('time.time', return_value=self.now + spool.SET_ASIDE_SECS + 1):
+            spool.drain(store, self.spool_dir, transient_errors=(sqlite3.OperationalError, BusyError))
+        self.assertEqual(self.files(), [os.path.basename(busy_name)])
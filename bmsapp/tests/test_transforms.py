@@ -0,0 +1,75 @@
+'''Tests of the batch transforms of bmsapp.calcs.transforms.  Run with:
+
+    manage.py test bmsapp.tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bmsapp.readingdb import bmsdata
+from bmsapp.calcs import transforms
+
+# the timestamp of the first test reading
+T = 1500000000
+
+
+class TransformBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db = bmsdata.BMSdata(os.path.join(self.db_dir, 'test.sqlite'))
+        self.trans = transforms.Transformer(self.db)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.db_dir)
+
+    def test_expressions(self):
+        ts, ids, vals = self.trans.transform_batch('a', [3, 1, 2], [3.0, -1.0, 2.0], 'val * 2', {})
+        self.assertEqual(ts.tolist(), [1, 2, 3])
+        self.assertEqual(ids, ['a', 'a', 'a'])
+        self.assertEqual(vals.tolist(), [-2.0, 4.0, 6.0])
+
+        # expressions that cannot operate on arrays
+        ts, ids, vals = self.trans.transform_batch('a', [1, 2], [-1.0, 2.0], 'max(val, 0)', {})
+        self.assertEqual(vals.tolist(), [0.0, 2.0])
+        ts, ids, vals = self.trans.transform_batch('a', [1, 2], [-1.0, 2.0], '1 if val > 0 else 0', {})
+        self.assertEqual(vals.tolist(), [0.0, 1.0])
+
+    def test_rate(self):
+        ts, ids, vals = self.trans.transform_batch('c', [T, T + 100, T + 200], [10.0, 20.0, 40.0], 'rate * 100', {})
+        # the first reading has no prior reading to compute a rate
+        self.assertEqual(ts.tolist(), [T + 50, T + 150])
+        self.assertEqual(vals.tolist(), [10.0, 20.0])
+        self.db.insert_reading(ts.tolist(), ids, vals.tolist())
+        self.assertEqual(self.db.last_raw('c'), (T + 200, 40.0))
+
+        ts, ids, vals = self.trans.transform_batch('c', [T + 300], [70.0], 'rate * interval', {})
+        self.assertEqual(vals.tolist(), [30.0])
+
+    def test_last_raw_kept_if_not_stored(self):
+        self.db.set_last_raw('c', T, 10.0)
+
+        # make storing the readings fail
+        self.db.add_sensor_table('c')
+        self.db.cursor.execute("CREATE TRIGGER fail BEFORE INSERT ON [c] BEGIN SELECT RAISE(ABORT, 'failed'); END")
+        self.db.conn.commit()
+        ts, ids, vals = self.trans.transform_batch('c', [T + 100, T + 200], [20.0, 30.0], 'rate', {})
+        self.db.insert_reading(ts.tolist(), ids, vals.tolist())
+        self.assertEqual(self.db.last_raw('c'), (T, 10.0))
+
+        # the readings are transformed the same way when stored again
+        self.db.cursor.execute('DROP TRIGGER fail')
+        self.db.conn.commit()
+        ts, ids, vals = self.trans.transform_batch('c', [T + 100, T + 200], [20.0, 30.0], 'rate', {})
+        self.assertEqual(vals.tolist(), [0.1, 0.1])
+        self.db.insert_reading(ts.tolist(), ids, vals.tolist())
+        self.assertEqual(self.db.last_raw('c'), (T + 200, 30.0))
+
+    def test_last_raw_stored_if_all_rejected(self):
+        ts, ids, vals = self.trans.transform_batch('new', [T + 100], [5.0], 'rate', {})
+        self.assertEqual(len(ts), 0)
+        self.db.insert_reading(ts.tolist(), ids, vals.tolist())
+        self.assertEqual(bmsdata.BMSdata(self.db.db_fname).last_raw('new'), (T + 100, 5.0))
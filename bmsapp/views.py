@@ -224,7 +224,7 @@ def store_reading(request, reading_id):
         storeKey = req_data['storeKey']
         del req_data['storeKey']    # for safety, get the key out of the dictionary
         if store_key_is_valid(storeKey):
-            msg = storereads.store(reading_id, req_data)
+            msg = storereads.spool_recs([storereads.parse_reading(reading_id, req_data)])
             return HttpResponse(msg)
         else:
             _logger.warning('Invalid Storage Key in Reading Post: %s', storeKey)
@@ -240,8 +240,9 @@ def store_readings(request):
     '''
     Stores a set of sensor readings in the sensor reading database.  The readings
     are in the POST data encoded in JSON and there may be additional information in
-    the query string.  See 'storereads.store_many' for details on the data formats
-    supported of the request data.
+    the query string.  See 'storereads.parse_many' for details on the data formats
+    supported of the request data.  The readings are queued in the ingest spool and
+    stored in the database by a background writer.
     '''
     try:
         # The post data is JSON, so decode it.
@@ -257,7 +258,7 @@ def store_readings(request):
             # remove storeKey for security
             del(req_data['storeKey'])
             _logger.debug('Sensor Readings: %s' % req_data)
-            msg = storereads.store_many(req_data)
+            msg = storereads.spool_recs(storereads.parse_many(req_data))
             return HttpResponse(msg)
         else:
             _logger.warning('Invalid Storage Key in Reading Post: %s', storeKey)
@@ -309,7 +310,7 @@ def store_readings_things(request):
             readings.append([ts, f'{hdw_serial}_snr', snr])
             readings.append([ts, f'{hdw_serial}_rssi', rssi])
 
-            msg = storereads.store_many({'readings': readings})
+            msg = storereads.spool_recs(storereads.parse_many({'readings': readings}))
 
             return HttpResponse(msg)
         else:
@@ -365,7 +366,7 @@ def store_readings_radio_bridge(request):
             else:
                 return HttpResponse('No Data')
 
-            msg = storereads.store_many({'readings': readings})
+            msg = storereads.spool_recs(storereads.parse_many({'readings': readings}))
 
             return HttpResponse(msg)
 
@@ -392,7 +393,7 @@ def store_reading_old(request, store_key):
             # pull the reading id out of the request parameters
             reading_id = req_data['id']
 
-            storereads.store(reading_id, req_data)
+            storereads.spool_recs([storereads.parse_reading(reading_id, req_data)])
             return HttpResponse('OK')
 
         else:
@@ -550,6 +551,7 @@ def unassigned_sensors(request):
     """
 
     db = bmsdata.BMSdata()
+    last_reads = db.last_reads()
     sensor_list = []
     for sens_id in db.sensor_id_list():
         sensor_info = {'id': sens_id, 'title': '', 'cur_value': '', 'minutes_ago': ''}
@@ -569,7 +571,7 @@ def unassigned_sensors(request):
                 sensor_info['title'] = sensor.title
 
         if add_sensor:
-            last_read = db.last_read(sens_id)
+            last_read = last_reads.get(sens_id)
             if last_read:
                 val = last_read['val']
                 sensor_info['cur_value'] = '%.5g' % val if abs(val)<1e5 else str(val)
@@ -195,16 +195,18 @@ def sensors(request):
     Returns
     -------
     A JSON response containing an indicator of success or failure, a list of
-    sensors including sensor properties and building association information
-    if available.
+    sensors including sensor properties, building association information
+    if available, and reading statistics (first and last reading timestamps,
+    reading count, minimum and maximum value).
     """
 
     try:
         #------ Check the query parameters
         messages = invalid_query_params(request, ['sensor_id'])
-        # get a list of all the Sensor IDs in the reading database
+        # get the reading statistics of all the Sensor IDs in the reading database
         db = bmsdata.BMSdata()  # reading database
-        all_sensor_ids = db.sensor_id_list()
+        all_stats = db.sensor_stats()
+        all_sensor_ids = sorted(all_stats)
 
         # determine the list of Sensor IDs requested by this call
         sensor_ids = request.GET.getlist('sensor_id')
@@ -272,7 +274,9 @@ def sensors(request):
                 # Use default values
                 sensor_props = default_props.copy()
                 sensor_props['sensor_id'] = sensor_id
-            sensors.append(clean_sensor(sensor_props))
+            sensor_props = clean_sensor(sensor_props)
+            sensor_props['reading_stats'] = all_stats[sensor_id]
+            sensors.append(sensor_props)
 
         result = {
             'status': 'success',